@@ -0,0 +1,98 @@
+"""Sends announcements to a discord channel, batched and within discord's rate limits."""
+import asyncio
+import collections
+import enum
+import logging
+import time
+from typing import Callable, Deque, List, Optional
+
+import discord
+
+import ratelimit
+import util
+
+# Discord won't send messages longer than this.
+MAX_MESSAGE_LENGTH = 2000
+# Discord lets bots send 5 messages per 5 seconds to a channel.
+MESSAGES_PER_SEC = 1
+MESSAGE_BURST = 5
+# How many recent queueing delays to remember.
+DELAY_HISTORY = 1000
+
+
+class Priority(enum.IntEnum):
+    # Lower goes out first. DQs are most time sensitive, since they free up the bracket.
+    DQ = 0
+    WARN = 1
+    CALL = 2
+
+
+class Announcement:
+    def __init__(self, text: str, priority: Priority, on_sent: Callable[[discord.Message], None] = None):
+        self.text = text
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        # The message this was sent in, once it has been. Stays None if sending it failed.
+        self.message: Optional[discord.Message] = None
+        # Called with the message as soon as it's sent, even if the flush has more messages left to send.
+        self.on_sent = on_sent
+
+
+class AnnouncementQueue:
+    """
+    Holds announcements for one channel until they are flushed.
+
+    Flushing packs everything queued into as few messages as will fit,
+    most urgent first, and waits as needed to stay under discord's per-channel
+    rate limit. Anything queued while a flush is waiting goes out in the same flush.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, bucket: ratelimit.TokenBucket = None):
+        self._channel = channel
+        self._bucket = bucket if bucket is not None else ratelimit.TokenBucket(MESSAGES_PER_SEC, MESSAGE_BURST)
+        self._queue: List[Announcement] = []
+        self._flushing = asyncio.Lock()
+        # How long each message's oldest announcement waited to be sent, in seconds.
+        self.queueing_delays: Deque[float] = collections.deque(maxlen=DELAY_HISTORY)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def post(self, text: str, priority: Priority, on_sent: Callable[[discord.Message], None] = None) -> Announcement:
+        """Queues text to be sent on the next flush. on_sent is called with the message it goes out in."""
+        a = Announcement(text, priority, on_sent)
+        self._queue.append(a)
+        return a
+
+    async def flush(self):
+        """Sends everything that has been queued. Returns once it has all been sent (or failed to)."""
+        async with self._flushing:
+            while self._queue:
+                await self._bucket.acquire()
+                await self._send(self._next_batch())
+
+    def _next_batch(self) -> List[Announcement]:
+        """Removes and returns the most urgent announcements that fit in one message."""
+        self._queue.sort(key=lambda a: a.priority)
+        batch = [self._queue.pop(0)]
+        length = len(batch[0].text)
+        while self._queue and length + 1 + len(self._queue[0].text) <= MAX_MESSAGE_LENGTH:
+            length += 1 + len(self._queue[0].text)
+            batch.append(self._queue.pop(0))
+        return batch
+
+    async def _send(self, batch: List[Announcement]):
+        delay = time.monotonic() - min(a.queued_at for a in batch)
+        self.queueing_delays.append(delay)
+        try:
+            with util.discord_call('send'):
+                message = await self._channel.send('\n'.join(a.text for a in batch))
+        except discord.DiscordException:
+            logging.exception(f'Failed to send {len(batch)} announcement(s) to channel {self._channel.id}.')
+            return
+        for a in batch:
+            a.message = message
+            if a.on_sent is not None:
+                a.on_sent(message)
+        logging.info(f'Sent {len(batch)} announcement(s) to channel {self._channel.id} '
+                     f'after queueing for {delay:.2f} seconds.')
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to notice and call open matches, for brackets of various sizes.
+
+Usage: ./bench_monitoring.py [results file] [number of entrants...]
+
+Plays a double elimination bracket out against stub challonge and discord
+objects, so only our own overhead is measured. Between polls, every open
+match is reported, so each poll finds a fresh wave of matches to call.
+
+Two things are driven, each through a whole bracket:
+ * Bracket.fetch_open_matches, on its own.
+ * Tournament.check_matches, which also calls the matches and saves state.
+
+For each, it reports poll latency percentiles, memory allocated while polling
+(traced in a separate run, since tracing slows everything down), bytes written
+by persistent.State, and how many calls went out to challonge and discord.
+Results are also written as JSON to the results file (bench_monitoring.json
+by default), to compare between commits.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest.mock
+from datetime import datetime
+from typing import Dict, List
+
+import discord
+
+import announcements
+import challonge
+import fake_challonge
+import persistent
+from bracket import Bracket
+from main import Tournament
+
+DEFAULT_RESULTS_FILE = 'bench_monitoring.json'
+DEFAULT_ENTRANT_COUNTS = [64, 512, 2048, 8192]
+PERCENTILES = [50, 90, 99]
+
+
+class StubClient:
+    """Stands in for challonge.Client, backed by the bracket engine from fake_challonge."""
+
+    def __init__(self):
+        self.tournament = fake_challonge.FakeTournament(1, 'bench', 'bench', challonge.TourneyType.DOUBLE_ELIM.value,
+                                                        True)
+        self._ids = itertools.count(1)
+        self.calls: Dict[str, int] = collections.Counter()
+
+    def add_players(self, tourney_id, names: List[str]) -> Dict[str, str]:
+        self.calls['add_players'] += 1
+        ids = {}
+        for name in names:
+            ids[name] = next(self._ids)
+            self.tournament.participants[ids[name]] = {'id': ids[name], 'name': name}
+        self.tournament.start(self._ids)
+        return ids
+
+    def list_matches(self, tourney_id: str, if_changed=False) -> List[challonge.Match]:
+        self.calls['list_matches'] += 1
+        return [challonge.Match(m.id, m.players[0], m.players[1]) for m in self.tournament.open_matches()]
+
+    def set_score(self, tourney_id: str, match_id: str, p1_score: int, p2_score: int, winner_id: str):
+        self.calls['set_score'] += 1
+        self.tournament.report(match_id, f'{p1_score}-{p2_score}', winner_id)
+
+    def play_open_matches(self, rng: random.Random) -> int:
+        """Reports a winner for every open match, as the players would. Returns how many there were."""
+        open_matches = self.tournament.open_matches()
+        for m in open_matches:
+            self.tournament.report(m.id, '2-0', rng.choice(m.players))
+        return len(open_matches)
+
+
+class StubMessage:
+    def __init__(self, message_id: int, channel: 'StubChannel'):
+        self.id = message_id
+        self._channel = channel
+
+    async def add_reaction(self, emoji):
+        self._channel.calls['add_reaction'] += 1
+
+
+class StubChannel:
+    """Stands in for the discord channel matches are announced in."""
+
+    def __init__(self):
+        self.id = 1
+        self._message_ids = itertools.count(1)
+        self.calls: Dict[str, int] = collections.Counter()
+
+    async def send(self, text: str) -> StubMessage:
+        self.calls['send'] += 1
+        return StubMessage(next(self._message_ids), self)
+
+
+class FetchOpenMatches:
+    """Polls with Bracket.fetch_open_matches."""
+    name = 'fetch_open_matches'
+
+    def __init__(self, entrants: int, tourney_id: str):
+        self.client = StubClient()
+        self.state = persistent.State(tourney_id)
+        self.bracket = Bracket(self.client, self.state)
+        self.bracket.create_players({discord_id: f'Player {discord_id}' for discord_id in range(1, entrants + 1)})
+
+    def poll(self):
+        self.bracket.fetch_open_matches()
+
+    def calls(self) -> Dict[str, int]:
+        return dict(self.client.calls)
+
+
+class CheckMatches(FetchOpenMatches):
+    """Polls with Tournament.check_matches."""
+    name = 'check_matches'
+
+    def __init__(self, entrants: int, tourney_id: str):
+        super().__init__(entrants, tourney_id)
+        self.channel = StubChannel()
+        self.cog = Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), self.bracket,
+                              self.channel.id, self.channel)
+
+    def poll(self):
+        asyncio.get_event_loop().run_until_complete(self.cog.check_matches())
+
+    def calls(self) -> Dict[str, int]:
+        return {**self.client.calls, **self.channel.calls}
+
+
+def run(scenario_type, entrants: int, trace_allocations: bool) -> dict:
+    """Polls a bracket with the given number of entrants until it's finished, and returns what was measured."""
+    scenario = scenario_type(entrants, f'{scenario_type.name}-{entrants}-{trace_allocations}')
+    rng = random.Random(0)
+    calls_before, bytes_before = scenario.calls(), scenario.state.bytes_written
+    latencies, peaks = [], []
+    if trace_allocations:
+        tracemalloc.start()
+    while True:
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        scenario.poll()
+        latencies.append(time.perf_counter() - start)
+        if trace_allocations:
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        if not scenario.client.play_open_matches(rng):
+            break
+    if trace_allocations:
+        tracemalloc.stop()
+        return {'peak_bytes_per_poll': max(peaks)}
+
+    calls = {k: v - calls_before.get(k, 0) for k, v in scenario.calls().items()}
+    return {
+        'polls': len(latencies),
+        'latency_ms': {
+            **{f'p{p}': round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES},
+            'max': round(max(latencies) * 1000, 3),
+            'total': round(sum(latencies) * 1000, 3),
+        },
+        'state_bytes_written': scenario.state.bytes_written - bytes_before,
+        'calls': {k: v for k, v in calls.items() if v},
+    }
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    results_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_RESULTS_FILE
+    entrant_counts = [int(n) for n in sys.argv[2:]] or DEFAULT_ENTRANT_COUNTS
+    # Measure our own overhead, not discord's rate limit.
+    announcements.MESSAGES_PER_SEC = announcements.MESSAGE_BURST = float('inf')
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    results = []
+    with tempfile.TemporaryDirectory() as backup_dir:
+        persistent.STATE_BACKUP_DIR = backup_dir + '/'
+        for scenario_type in (FetchOpenMatches, CheckMatches):
+            for entrants in entrant_counts:
+                result = run(scenario_type, entrants, trace_allocations=False)
+                result['allocations'] = run(scenario_type, entrants, trace_allocations=True)
+                name = scenario_type.name
+                results.append({'benchmark': name, 'entrants': entrants, **result})
+
+                latency = result['latency_ms']
+                print(f'{name:<20}{entrants:>6} entrants{result["polls"]:>5} polls'
+                      f'  p50 {latency["p50"]:>9.2f}ms  p99 {latency["p99"]:>9.2f}ms'
+                      f'  peak {result["allocations"]["peak_bytes_per_poll"]:>12,}B'
+                      f'  written {result["state_bytes_written"]:>12,}B  calls {result["calls"]}')
+
+    with open(results_file, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'results': results,
+        }, f, indent=2)
+    print(f'Wrote results to {results_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Compares the size of a large tournament's saved state, and the memory it takes
+once loaded, between the old storage format and the current one.
+
+Usage: ./bench_state.py [number of players]
+
+The old format pickled whole Player and Match dataclasses (without __slots__),
+with every match holding its own reference to both players. The current format
+keeps slotted objects in memory, and stores plain tuples with matches referring
+to players by key_id.
+"""
+import os
+import pickle
+import random
+import sys
+import tempfile
+import tracemalloc
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+import data
+import persistent
+
+DEFAULT_PLAYER_COUNT = 2048
+
+
+# What data.Player and data.Match looked like before they were slotted.
+@dataclass
+class LegacyPlayer:
+    discord_id: int
+    challonge_id: str
+    key_id: uuid.UUID
+
+
+@dataclass
+class LegacyMatch:
+    p1: LegacyPlayer
+    p2: LegacyPlayer
+    call_message_id: Optional[int]
+    call_time: Optional[datetime]
+    warn_time: Optional[datetime]
+    dq_time: Optional[datetime]
+    challonge_id: str
+    key_id: uuid.UUID
+
+
+def double_elim_matches(player_count: int):
+    """
+    Returns (p1 index, p2 index, challonge ID) for every match in a double
+    elimination bracket with the given number of players.
+    Who plays who is random, since only the number of matches matters here.
+    """
+    rng = random.Random(0)
+    # Winners bracket, losers bracket, and grand finals with a bracket reset.
+    match_count = (player_count - 1) + (player_count - 2) + 2
+    return [(*rng.sample(range(player_count), 2), str(100000000 + i)) for i in range(match_count)]
+
+
+def build(player_count: int):
+    players = [data.new_player(100000000000000000 + i, str(50000000 + i)) for i in range(player_count)]
+    matches = []
+    start = datetime(2020, 1, 1)
+    for i, (p1, p2, challonge_id) in enumerate(double_elim_matches(player_count)):
+        m = data.new_match(players[p1], players[p2], challonge_id)
+        # Every match has been called by the end of the tournament.
+        m.call_message_id = 700000000000000000 + i
+        m.call_time = start + timedelta(minutes=i)
+        m.warn_time = m.call_time + timedelta(minutes=5)
+        m.dq_time = m.call_time + timedelta(minutes=10)
+        matches.append(m)
+    return players, matches
+
+
+def to_legacy(players, matches):
+    legacy_players = {p.key_id: LegacyPlayer(p.discord_id, p.challonge_id, p.key_id) for p in players}
+    legacy_matches = [
+        LegacyMatch(legacy_players[m.p1.key_id], legacy_players[m.p2.key_id], m.call_message_id,
+                    m.call_time, m.warn_time, m.dq_time, m.challonge_id, m.key_id)
+        for m in matches
+    ]
+    return list(legacy_players.values()), legacy_matches
+
+
+def measure(load):
+    """Returns how many bytes are still allocated after calling load, while its result is alive."""
+    tracemalloc.start()
+    result = load()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main():
+    player_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PLAYER_COUNT
+    players, matches = build(player_count)
+    legacy_players, legacy_matches = to_legacy(players, matches)
+
+    with tempfile.TemporaryDirectory() as backup_dir:
+        persistent.STATE_BACKUP_DIR = backup_dir
+
+        legacy_file_name = os.path.join(backup_dir, 'legacy')
+        with open(legacy_file_name, 'wb') as f:
+            pickle.dump({'called_match_ids': legacy_matches, 'players': legacy_players,
+                         'admin_id': 1, 'tournament_link': 'link'}, f)
+        del legacy_players, legacy_matches
+
+        s = persistent.State('current', 'link', backend=persistent.PICKLE_BACKEND)
+        s.add_players(players)
+        s.set_matches(matches)
+        # Fold the journal into the snapshot, so both sides are a single file.
+        s._backend._save()
+        current_file_name = os.path.join(backup_dir, 'current')
+        del s, players, matches
+
+        def load_legacy():
+            with open(legacy_file_name, 'rb') as f:
+                state = pickle.load(f)
+            # Build the same lookups the pickle backend keeps, so only the format differs.
+            lookups = [{m.challonge_id: i for i, m in enumerate(state['called_match_ids'])}]
+            for field in ('challonge_id', 'discord_id', 'key_id'):
+                lookups.append({getattr(p, field): p for p in state['players']})
+            return state, lookups
+
+        results = [
+            ('old format', os.path.getsize(legacy_file_name), measure(load_legacy)),
+            ('current format', os.path.getsize(current_file_name),
+             measure(lambda: persistent.State('current', backend=persistent.PICKLE_BACKEND))),
+        ]
+
+    print(f'{player_count} players, {len(double_elim_matches(player_count))} matches (double elimination)')
+    print(f'{"":<16}{"snapshot bytes":>16}{"loaded bytes":>16}')
+    for name, snapshot_bytes, loaded_bytes in results:
+        print(f'{name:<16}{snapshot_bytes:>16,}{loaded_bytes:>16,}')
+    (_, old_snapshot, old_loaded), (_, new_snapshot, new_loaded) = results
+    print(f'{"change":<16}{new_snapshot / old_snapshot - 1:>16.1%}{new_loaded / old_loaded - 1:>16.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,41 @@
 #!/usr/bin/env python3
+import asyncio
+import functools
+import itertools
+import logging
 import sys
-from typing import List, Dict
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 
 import challonge
 import data
+import engine
+import match_graph
+import mirror
 import persistent
+import swiss
+
+# Blocking bracket operations (HTTP calls to challonge, writing state to disk)
+# from every tournament share this many threads.
+BLOCKING_IO_WORKERS = 8
+# Operations that change the bracket (reporting scores, adding players) get threads of their own,
+# so they reach challonge's write lane without queueing behind every tournament's polls.
+BLOCKING_WRITE_WORKERS = 4
+
+# How many scores a single tournament submits to challonge at once, when many are due together (e.g. a round of DQs).
+MAX_CONCURRENT_SCORE_SUBMISSIONS = 4
+
+_blocking_io_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix='bracket-io')
+_blocking_write_executor = ThreadPoolExecutor(max_workers=BLOCKING_WRITE_WORKERS, thread_name_prefix='bracket-write')
+# Keeping challonge up to date with brackets played out locally (see mirror.py) happens on these,
+# so nothing waits on challonge while it's slow.
+MIRROR_WORKERS = 4
+_mirror_executor = ThreadPoolExecutor(max_workers=MIRROR_WORKERS, thread_name_prefix='bracket-mirror')
+
+# Local matches get IDs like these, in place of challonge's.
+LOCAL_MATCH_ID_PREFIX = 'local-'
 
 
 def create(api_token: str, name: str, admin_id: int, tournament_type=challonge.TourneyType.DOUBLE_ELIM,
@@ -29,12 +60,49 @@ def resume(api_token: str, tournament_id: str):
     return Bracket(client, persistent.State(tournament_id))
 
 
+async def create_async(api_token: str, name: str, admin_id: int, tournament_type=challonge.TourneyType.DOUBLE_ELIM,
+                       is_unlisted=True) -> 'AsyncBracket':
+    """
+    Same as create, but doesn't block the event loop, and returns an AsyncBracket.
+    """
+    b = await asyncio.get_running_loop().run_in_executor(
+        _blocking_io_executor, create, api_token, name, admin_id, tournament_type, is_unlisted)
+    return AsyncBracket(b)
+
+
 # Represents a bracket in Challonge.
 class Bracket:
     def __init__(self, client: challonge.Client, state: persistent.State):
         self._challonge_client = client
         self._local_state = state
 
+        # Indexes over what's in state. Only ever updated alongside the state,
+        # in _add_players and _put_matches.
+        self._players = list(state.players)
+        self._players_by_challonge_id: Dict[str, data.Player] = {p.challonge_id: p for p in self._players}
+        self._players_by_discord_id: Dict[int, data.Player] = {p.discord_id: p for p in self._players}
+        self._matches_by_challonge_id: Dict[str, data.Match] = {m.challonge_id: m for m in state.known_matches}
+
+        # The open matches as of the last poll, by challonge ID.
+        self._open_matches: Optional[Dict[str, data.Match]] = None
+        self._last_poll_changed = False
+        self._last_poll_not_modified = False
+        # Every match in the bracket, fetched the first time a score is saved. Dropped when it falls behind.
+        self._graph: Optional[match_graph.MatchGraph] = None
+
+        # Set once the bracket is played out locally (see start_locally), instead of by challonge.
+        self._engine: Optional[engine.Engine] = None
+        self._mirror: Optional[mirror.ChallongeMirror] = None
+        # The sync with challonge that's running, if any, and the results it found reported on challonge,
+        # as (local match ID, challonge match ID, winner ID), waiting to be recorded on the next poll.
+        self._sync: Optional[Future] = None
+        self._reported_on_challonge: queue.SimpleQueue = queue.SimpleQueue()
+        # Scores can be submitted from several threads at once.
+        self._engine_lock = threading.Lock()
+        self._results = persistent.ResultLog(self.tourney_id)
+        if self._results.started:
+            self._resume_locally()
+
     @property
     def tourney_id(self) -> str:
         return self._local_state.tournament_id
@@ -43,6 +111,21 @@ class Bracket:
     def link(self) -> str:
         return self._local_state.bracket_link
 
+    @property
+    def is_local(self) -> bool:
+        """Whether the bracket is played out locally, with challonge kept up to date in the background."""
+        return self._engine is not None
+
+    @property
+    def last_poll_changed(self) -> bool:
+        """Whether the last poll found a different set of open matches than the one before."""
+        return self._last_poll_changed
+
+    @property
+    def last_poll_not_modified(self) -> bool:
+        """Whether challonge told us the open matches were unchanged during the last poll."""
+        return self._last_poll_not_modified
+
     @property
     def players(self) -> List[data.Player]:
         # Note that we do not contact challonge to see if any players have been
@@ -51,7 +134,24 @@ class Bracket:
         #       discord ids yet anyway.
         # * If players were removed, they won't have any matches, so it doesn't
         #       really matter if we have a little extra data.
-        return self._local_state.players
+        return list(self._players)
+
+    @property
+    def known_matches(self) -> List[data.Match]:
+        return list(self._matches_by_challonge_id.values())
+
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        return self._players_by_discord_id.get(discord_id)
+
+    def player_by_challonge_id(self, challonge_id: str) -> Optional[data.Player]:
+        return self._players_by_challonge_id.get(challonge_id)
+
+    def match_by_challonge_id(self, challonge_id: str) -> Optional[data.Match]:
+        return self._matches_by_challonge_id.get(challonge_id)
+
+    def is_open(self, challonge_id: str) -> bool:
+        """Whether the given match was open as of the last poll."""
+        return self._open_matches is not None and challonge_id in self._open_matches
 
     # Adds the given players to the tournament bracket.
     # Returns a list of Player objects.
@@ -65,9 +165,29 @@ class Bracket:
             challonge_id = challonge_ids_by_discord_name[name]
             players.append(data.new_player(discord_id, challonge_id))
 
-        self._local_state.add_players(players)
+        self._add_players(players)
         return self.players
 
+    def recover_players(self, names_by_discord_id) -> List[data.Player]:
+        """
+        Records any of the given players that challonge already has, but we don't know about.
+        That happens when adding them failed after challonge had already added them.
+
+        Players are matched up by name. Returns the players that were recovered.
+        """
+        known_ids = {p.challonge_id for p in self._players}
+        challonge_ids_by_name = {name: challonge_id for challonge_id, name in
+                                 self._challonge_client.list_player_names_by_id(self.tourney_id).items()
+                                 if challonge_id not in known_ids}
+        players = [
+            data.new_player(discord_id, challonge_ids_by_name[name])
+            for discord_id, name in names_by_discord_id.items()
+            if name in challonge_ids_by_name and discord_id not in self._players_by_discord_id
+        ]
+        if players:
+            self._add_players(players)
+        return players
+
     def update_username(self, player: data.Player, name: str) -> bool:
         """
         Updates a player's username in challonge.
@@ -79,42 +199,349 @@ class Bracket:
         return self._challonge_client.update_username(self.tourney_id, player, name)
 
     def fetch_open_matches(self) -> List[data.Match]:
-        # Fetch open matches
-        open_match_data = self._challonge_client.list_matches(self.tourney_id)
+        self.poll_open_matches()
+        return list(self._open_matches.values())
 
-        # Register any matches we don't already know about.
-        known_matches_by_id = self._known_matches_by_challonge_id()
-        players_by_challonge_id = {p.challonge_id: p for p in self._local_state.players}
-        for m in open_match_data:
-            if m.id not in known_matches_by_id:
-                p1 = players_by_challonge_id[m.p1_id]
-                p2 = players_by_challonge_id[m.p2_id]
-                known_matches_by_id[m.id] = data.new_match(p1, p2, m.id)
+    def poll_open_matches(self) -> data.OpenMatchDiff:
+        """
+        Fetches open matches, and returns how they changed since the last poll.
+        On the first poll, every open match counts as newly opened.
 
-        self._local_state.set_matches(known_matches_by_id.values())
+        Only matches we haven't seen before are saved, so a poll that finds nothing new doesn't write anything.
+        """
+        if self._engine is not None:
+            return self._poll_locally()
+
+        # Fetch open matches, unless they haven't changed since last time.
+        open_match_data = self._challonge_client.list_matches(self.tourney_id,
+                                                              if_changed=self._open_matches is not None)
+        if open_match_data is None:
+            self._last_poll_not_modified = True
+            self._last_poll_changed = False
+            return data.OpenMatchDiff([], [], list(self._open_matches.values()))
+        self._last_poll_not_modified = False
+        return self._diff(open_match_data)
+
+    def _diff(self, open_match_data: List[challonge.Match]) -> data.OpenMatchDiff:
+        # Register any matches we don't already know about.
+        new_matches = [
+            data.new_match(self._players_by_challonge_id[m.p1_id], self._players_by_challonge_id[m.p2_id], m.id)
+            for m in open_match_data if m.id not in self._matches_by_challonge_id
+        ]
+        if new_matches:
+            self._put_matches(new_matches)
+
+        previously_open = self._open_matches or {}
+        open_matches = {m.id: self._matches_by_challonge_id[m.id] for m in open_match_data}
+        diff = data.OpenMatchDiff(
+            opened=[m for i, m in open_matches.items() if i not in previously_open],
+            closed=[m for i, m in previously_open.items() if i not in open_matches],
+            unchanged=[m for i, m in open_matches.items() if i in previously_open],
+        )
+        if self._graph is not None and not all(self._graph.is_decided(m.challonge_id) for m in diff.closed):
+            # Someone reported a match without us, so we don't know where its players went.
+            self._graph = None
+        self._last_poll_changed = self._open_matches is None or diff.changed
+        self._open_matches = open_matches
+        return diff
+
+    def _poll_locally(self) -> data.OpenMatchDiff:
+        """
+        Records the results the last sync found reported on challonge, starts syncing again in the background,
+        and compares the local bracket's open matches to the last poll.
+        """
+        while True:
+            try:
+                match_id, challonge_id, winner_id = self._reported_on_challonge.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self._record_locally(data.Result(match_id, winner_id), challonge_id)
+            except ValueError:
+                # We recorded a result for it ourselves since then. Ours stands.
+                logging.info(f'Ignoring the result challonge has for match {match_id} in tournament '
+                             f'{self.tourney_id}, which was already recorded.')
+        self._start_sync()
+        self._last_poll_not_modified = False
+        return self._diff(self._local_open_matches())
+
+    def wait_for_sync(self, timeout_in_secs: float = None):
+        """Waits for the sync with challonge that's running in the background, if any, to finish."""
+        if self._sync is not None:
+            self._sync.result(timeout_in_secs)
+
+    def close(self):
+        """Waits for any sync with challonge to finish, then closes the files the bracket is kept in."""
+        self.wait_for_sync()
+        self._results.close()
+        self._local_state.close()
+
+    def _start_sync(self):
+        if self._sync is not None and not self._sync.done():
+            return
+        with self._engine_lock:
+            open_by_pair = {mirror.pair(*m.players): m.id for m in self._engine.open_matches()}
+        self._sync = _mirror_executor.submit(self._sync_with_challonge, open_by_pair)
+
+    def _sync_with_challonge(self, open_by_pair):
+        try:
+            for reported in self._mirror.sync(open_by_pair):
+                self._reported_on_challonge.put(reported)
+        except challonge.ChallongeError:
+            logging.warning(f'Unable to sync tournament {self.tourney_id} with challonge, will try again next poll.',
+                            exc_info=True)
+        except Exception:
+            logging.exception(f'Failed to sync tournament {self.tourney_id} with challonge.')
+
+    def start_locally(self, tournament_type: challonge.TourneyType = challonge.TourneyType.DOUBLE_ELIM):
+        """
+        Generates the bracket from the players, in the order they were added, and plays it out locally from now on.
 
-        return [known_matches_by_id[m.id] for m in open_match_data]
+        Challonge is started and kept up to date in the background (see mirror.py). Matches are
+        known by local IDs from now on, in place of challonge IDs.
+        Raises a ValueError if the bracket can't be played out locally.
+        """
+        if self._engine is not None:
+            raise ValueError('The bracket has already been started.')
+        if tournament_type == challonge.TourneyType.SWISS:
+            # Players report scores on challonge, which pairs swiss rounds its own way, so nobody could report ours.
+            raise ValueError('Swiss brackets can only be run on challonge for now.')
+        b = self._new_engine(tournament_type)
+        b.start([p.challonge_id for p in self._players])
+        self._results.start(tournament_type.value, [p.challonge_id for p in self._players])
+        self._engine = b
+        self._mirror = mirror.ChallongeMirror(self._challonge_client, self.tourney_id,
+                                              self._results.record_mirrored)
+        # Whatever was open on challonge is replaced by the local matches.
+        self._graph = None
+
+    def _resume_locally(self):
+        """Rebuilds the local bracket by replaying every result since it was started."""
+        self._engine = self._new_engine(challonge.TourneyType(self._results.tournament_type))
+        self._engine.start(self._results.player_ids)
+        self._mirror = mirror.ChallongeMirror(self._challonge_client, self.tourney_id,
+                                              self._results.record_mirrored, self._results.mirrored)
+        for r in self._results.results:
+            players = self._engine.matches[r.match_id].players
+            self._engine.report(r.match_id, r.winner_id)
+            if r.match_id not in self._results.mirrored:
+                self._mirror.push(r, *players)
+
+    @staticmethod
+    def _new_engine(tournament_type: challonge.TourneyType) -> engine.Engine:
+        # IDs are handed out in the same order every time, so replaying results gives the same bracket.
+        # Swiss pairings are deterministic too.
+        return engine.Engine(tournament_type, (f'{LOCAL_MATCH_ID_PREFIX}{i}' for i in itertools.count(1)),
+                             pair_round=swiss.pair_round_in_pool)
+
+    def _local_open_matches(self) -> List[challonge.Match]:
+        with self._engine_lock:
+            return [challonge.Match(m.id, *m.players) for m in self._engine.open_matches()]
+
+    def _record_locally(self, result: data.Result, challonge_id: str = None):
+        """
+        Records the result in the local bracket, and has it mirrored to challonge
+        (or links it to the given challonge match, if it came from there).
+        """
+        with self._engine_lock:
+            players = self._engine.matches[result.match_id].players
+            self._engine.report(result.match_id, result.winner_id)
+            self._results.record_result(result)
+        if challonge_id is not None:
+            self._mirror.link(result.match_id, challonge_id)
+        else:
+            self._mirror.push(result, *players)
 
     def save_metadata(self, match: data.Match):
-        # Wasteful, but fine.
-        matches = self._known_matches_by_challonge_id()
-        matches[match.challonge_id] = match
-        self._local_state.set_matches(matches.values())
+        self._put_matches([match])
 
-    def save_score(self, match: data.Match, p1_score: int, p2_score: int):
+    def save_all_metadata(self, matches: List[data.Match]):
+        """Like save_metadata, but saves every given match in a single write."""
+        self._put_matches(matches)
+
+    def save_score(self, match: data.Match, p1_score: int, p2_score: int) -> List[data.Match]:
+        """Reports the score of the given match, and returns the matches that opened up as a result."""
+        self.submit_score(match, p1_score, p2_score)
+        return self.advance([(match, p1_score, p2_score)])
+
+    def submit_score(self, match: data.Match, p1_score: int, p2_score: int):
+        """
+        Reports the score of the given match to challonge, without doing anything else.
+        In a local bracket, records it locally instead, and leaves challonge to be synced later.
+        """
         winner_id = match.p1.challonge_id if p1_score >= p2_score else match.p2.challonge_id
+        if self._engine is not None:
+            self._record_locally(data.Result(match.challonge_id, winner_id, p1_score, p2_score))
+            return
         self._challonge_client.set_score(self.tourney_id, match.challonge_id, p1_score, p2_score, winner_id)
 
+    def advance(self, scores: List[Tuple[data.Match, int, int]]) -> List[data.Match]:
+        """
+        Moves the players of each (match, p1 score, p2 score) that was just reported on to their next matches.
+
+        Returns the matches that opened up as a result, which count as open from now on.
+        Works them out locally when we can, and asks challonge for the whole bracket
+        when we can't (the first time, or after matches were reported without us).
+        """
+        if not scores:
+            return []
+        try:
+            if self._engine is not None:
+                # The local bracket already has these results in it.
+                opened = [m for m in self._local_open_matches()
+                          if self._open_matches is None or m.id not in self._open_matches]
+            elif self._graph is None:
+                # The fresh graph already has these results in it.
+                self._graph = match_graph.MatchGraph(self._challonge_client.list_all_matches(self.tourney_id))
+                opened = [m for m in self._graph.open_matches()
+                          if self._open_matches is None or m.id not in self._open_matches]
+            else:
+                opened = []
+                for match, p1_score, p2_score in scores:
+                    winner = match.p1 if p1_score >= p2_score else match.p2
+                    opened += self._graph.resolve(match.challonge_id, winner.challonge_id)
+        except challonge.ChallongeError:
+            # We'll find out about them on the next poll instead.
+            logging.exception(f'Unable to work out which matches opened up in tournament {self.tourney_id}.')
+            return []
+
+        # Players we don't know about (added on challonge directly) can't be called.
+        opened = [m for m in opened if m.p1_id in self._players_by_challonge_id and
+                  m.p2_id in self._players_by_challonge_id]
+        new_matches = [
+            data.new_match(self._players_by_challonge_id[m.p1_id], self._players_by_challonge_id[m.p2_id], m.id)
+            for m in opened if m.id not in self._matches_by_challonge_id
+        ]
+        if new_matches:
+            self._put_matches(new_matches)
+        if self._open_matches is not None:
+            for match, _, _ in scores:
+                self._open_matches.pop(match.challonge_id, None)
+            for m in opened:
+                self._open_matches[m.id] = self._matches_by_challonge_id[m.id]
+        return [self._matches_by_challonge_id[m.id] for m in opened]
+
     def is_admin(self, player_id: int) -> bool:
         return player_id == self._local_state.admin_id
 
-    def _known_matches_by_challonge_id(self) -> Dict[str, data.Match]:
+    def _add_players(self, players: List[data.Player]):
+        self._local_state.add_players(players)
+        self._players += players
+        for p in players:
+            self._players_by_challonge_id[p.challonge_id] = p
+            self._players_by_discord_id[p.discord_id] = p
+
+    def _put_matches(self, matches: List[data.Match]):
+        self._local_state.update_matches(matches)
+        for m in matches:
+            self._matches_by_challonge_id[m.challonge_id] = m
+            if self._open_matches is not None and m.challonge_id in self._open_matches:
+                self._open_matches[m.challonge_id] = m
+
+
+class AsyncBracket:
+    """
+    Awaitable facade over a Bracket, for use from the event loop.
+
+    Anything that may block (talking to challonge, saving state) runs on a
+    bounded thread pool shared by every tournament. Calls that change the
+    bracket are serialized, so two commands can't interleave their updates
+    to the same tournament.
+    """
+
+    def __init__(self, b: Bracket):
+        self._bracket = b
+        self._lock = asyncio.Lock()
+
+    @property
+    def bracket(self) -> Bracket:
+        return self._bracket
+
+    @property
+    def tourney_id(self) -> str:
+        return self._bracket.tourney_id
+
+    @property
+    def link(self) -> str:
+        return self._bracket.link
+
+    @property
+    def players(self) -> List[data.Player]:
+        return self._bracket.players
+
+    @property
+    def is_local(self) -> bool:
+        return self._bracket.is_local
+
+    @property
+    def last_poll_changed(self) -> bool:
+        return self._bracket.last_poll_changed
+
+    @property
+    def last_poll_not_modified(self) -> bool:
+        return self._bracket.last_poll_not_modified
+
+    def is_admin(self, player_id: int) -> bool:
+        return self._bracket.is_admin(player_id)
+
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        return self._bracket.player_by_discord_id(discord_id)
+
+    async def start_locally(self, tournament_type: challonge.TourneyType = challonge.TourneyType.DOUBLE_ELIM):
+        await self._write_serialized(self._bracket.start_locally, tournament_type)
+
+    async def create_players(self, names_by_discord_id) -> List[data.Player]:
+        return await self._write_serialized(self._bracket.create_players, names_by_discord_id)
+
+    async def recover_players(self, names_by_discord_id) -> List[data.Player]:
+        return await self._run_serialized(self._bracket.recover_players, names_by_discord_id)
+
+    async def update_username(self, player: data.Player, name: str) -> bool:
+        return await self._write_serialized(self._bracket.update_username, player, name)
+
+    async def fetch_open_matches(self) -> List[data.Match]:
+        return await self._run_serialized(self._bracket.fetch_open_matches)
+
+    async def poll_open_matches(self) -> data.OpenMatchDiff:
+        return await self._run_serialized(self._bracket.poll_open_matches)
+
+    async def save_metadata(self, match: data.Match):
+        await self._run_serialized(self._bracket.save_metadata, match)
+
+    async def save_all_metadata(self, matches: List[data.Match]):
+        await self._run_serialized(self._bracket.save_all_metadata, matches)
+
+    async def save_score(self, match: data.Match, p1_score: int, p2_score: int) -> List[data.Match]:
+        return await self._write_serialized(self._bracket.save_score, match, p1_score, p2_score)
+
+    async def advance(self, scores: List[Tuple[data.Match, int, int]]) -> List[data.Match]:
+        return await self._write_serialized(self._bracket.advance, scores)
+
+    async def save_scores(self, scores: List[Tuple[data.Match, int, int]]) -> List[Optional[Exception]]:
         """
-        Gets known matches from persistent state and indexes by challonge ID.
-        A bit wasteful not to save it once we have it, but this makes it less
-        likely that we get out of sync with our persistent state.
+        Submits the score of each (match, p1 score, p2 score), MAX_CONCURRENT_SCORE_SUBMISSIONS at a time.
+
+        Submitting a score only talks to challonge, so these don't wait on other calls to this bracket.
+        Returns what each submission raised (or None if it succeeded), in the same order as the scores.
+        Pass the ones that succeeded to advance to find out which matches opened up.
         """
-        return {m.challonge_id: m for m in self._local_state.known_matches}
+        limit = asyncio.Semaphore(MAX_CONCURRENT_SCORE_SUBMISSIONS)
+        loop = asyncio.get_running_loop()
+
+        async def submit(match: data.Match, p1_score: int, p2_score: int):
+            async with limit:
+                await loop.run_in_executor(
+                    _blocking_write_executor, functools.partial(self._bracket.submit_score, match, p1_score, p2_score))
+
+        return await asyncio.gather(*[submit(*s) for s in scores], return_exceptions=True)
+
+    async def _run_serialized(self, func, *args, executor: ThreadPoolExecutor = _blocking_io_executor):
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+    async def _write_serialized(self, func, *args):
+        """Same as _run_serialized, for calls that change the bracket."""
+        return await self._run_serialized(func, *args, executor=_blocking_write_executor)
 
 
 def _sanity_check():
@@ -0,0 +1,77 @@
+"""Remembers things we fetched, so that we don't have to fetch them again right away."""
+import collections
+import threading
+import time
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar('V')
+
+
+class TTLCache(Generic[V]):
+    """
+    Holds up to max_entries values for up to ttl_in_secs each.
+
+    Once full, the least recently used entry makes room for new ones.
+    Safe to share between threads.
+    """
+
+    def __init__(self, ttl_in_secs: float, max_entries: int, clock: Callable[[], float] = time.monotonic):
+        self._ttl = ttl_in_secs
+        self._max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (value, expiry time) by key, least recently used first.
+        self._entries: Dict[Hashable, Tuple[V, float]] = collections.OrderedDict()
+        # How many invalidations there had been when each key was last invalidated, least recent first.
+        # Only the latest max_entries are kept; keys that were forgotten (or never invalidated)
+        # count as invalidated as late as the last one forgotten.
+        self._invalidations: Dict[Hashable, int] = collections.OrderedDict()
+        self._invalidation_count = 0
+        self._last_forgotten_invalidation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def generation(self, key: Hashable) -> int:
+        """
+        Goes up every time key is invalidated.
+
+        Read it before fetching a value, and pass it to put, so that a fetch which
+        raced with an invalidation of the same key doesn't put back what was just invalidated.
+        """
+        with self._lock:
+            return self._invalidations.get(key, self._last_forgotten_invalidation)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Returns the value for key, or None if there isn't one or it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self._clock():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: V, generation: int = None):
+        """Stores value for key, unless key was invalidated since the given generation."""
+        with self._lock:
+            if generation is not None and generation != self._invalidations.get(key, self._last_forgotten_invalidation):
+                return
+            self._entries[key] = (value, self._clock() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidation_count += 1
+            self._invalidations.pop(key, None)
+            self._invalidations[key] = self._invalidation_count
+            while len(self._invalidations) > self._max_entries:
+                _, self._last_forgotten_invalidation = self._invalidations.popitem(last=False)
@@ -1,15 +1,168 @@
 #!/usr/bin/env python3
 """This is a thin wrapper for challonge's API."""
+import asyncio
 import enum
+import functools
+import json
+import logging
+import os
 import sys
+import threading
 import uuid
 from dataclasses import dataclass
-from typing import Tuple, List, Dict
+from typing import Awaitable, Callable, Tuple, List, Dict, Optional
+from urllib import error
 
+import aiohttp
+
+import cache
 import data
+import metrics
+import ratelimit
+import resilience
 import util
 
-CHALLONGE_API = 'https://api.challonge.com/v1'
+# Point this somewhere else (like fake_challonge.py) to run without the real challonge.
+CHALLONGE_API = os.environ.get('CHALLONGE_API', 'https://api.challonge.com/v1')
+
+# How many requests per second we allow ourselves to send with one API key,
+# across every tournament that uses it, and how many may go out in a burst.
+REQUESTS_PER_SEC = float(os.environ.get('CHALLONGE_REQUESTS_PER_SEC', 5))
+REQUEST_BURST = 10
+
+# How many times to try idempotent requests that failed because challonge was having trouble,
+# and how long to wait in between (see resilience.backoff_delay).
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY_IN_SECS = 0.5
+RETRY_MAX_DELAY_IN_SECS = 5
+
+# Participant lists rarely change once an event is underway, and we drop our copy whenever we change them ourselves.
+# This only bounds how stale they get when a TO edits the bracket on challonge's website.
+PARTICIPANT_CACHE_TTL_IN_SECS = 300
+PARTICIPANT_CACHE_MAX_ENTRIES = 1024
+
+
+class ChallongeError(Exception):
+    """Something went wrong talking to challonge."""
+
+
+class RequestRejected(ChallongeError):
+    """Challonge understood the request, but refused it. Trying again won't help."""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+class ChallongeUnavailable(ChallongeError):
+    """
+    Challonge is having trouble, or we couldn't reach it. Trying again later might work.
+
+    retry_in_secs is how long until we'll send requests for the same tournament again,
+    if we've stopped sending them for now.
+    """
+
+    def __init__(self, message: str, retry_in_secs: float = 0.0):
+        super().__init__(message)
+        self.retry_in_secs = retry_in_secs
+
+
+class Lane(enum.IntEnum):
+    """How urgent a request is. Lower goes first when we're at the rate limit."""
+    # Changes to the bracket, like reporting a score, which other things are waiting on.
+    WRITE = 0
+    # Reads someone is waiting on.
+    READ = 1
+    # Checking for open matches, which happens in the background all the time.
+    POLL = 2
+
+
+# Every client using the same API key shares a rate limit.
+_limiters_by_api_key: Dict[str, ratelimit.PriorityLimiter] = {}
+_limiters_lock = threading.Lock()
+
+# Circuit breakers by (API key, tournament ID), with a tournament ID of None for the API key as a whole.
+_breakers: Dict[Tuple[str, Optional[str]], resilience.CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+# Player names by ID, by (API key, tournament ID).
+_player_names: cache.TTLCache[Dict[str, str]] = cache.TTLCache(PARTICIPANT_CACHE_TTL_IN_SECS,
+                                                                PARTICIPANT_CACHE_MAX_ENTRIES)
+
+CALLS = metrics.Counter('challonge_calls', 'Calls to challonge.Client, by how they turned out.', ['method', 'outcome'])
+CALL_SECONDS = metrics.Histogram('challonge_call_seconds',
+                                 'How long calls to challonge.Client took, including waiting their turn and retries.',
+                                 ['method'])
+QUEUE_DEPTH = metrics.Gauge('challonge_queue_depth', 'Requests waiting for their turn to be sent to challonge.',
+                            ['lane'])
+
+
+def _limiter_for(api_key: str, requests_per_sec: float) -> ratelimit.PriorityLimiter:
+    with _limiters_lock:
+        if api_key not in _limiters_by_api_key:
+            bucket = ratelimit.TokenBucket(requests_per_sec, REQUEST_BURST)
+            _limiters_by_api_key[api_key] = ratelimit.PriorityLimiter(bucket)
+        return _limiters_by_api_key[api_key]
+
+
+def _instrumented(f):
+    """Counts and times calls to the given Client method."""
+    method = f.__name__[:-len('_async')]
+
+    @functools.wraps(f)
+    async def wrapper(*args, **kwargs):
+        outcome = 'error'
+        with CALL_SECONDS.time(method=method):
+            try:
+                result = await f(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            except RequestRejected:
+                outcome = 'rejected'
+                raise
+            except ChallongeUnavailable:
+                outcome = 'unavailable'
+                raise
+            finally:
+                CALLS.inc(method=method, outcome=outcome)
+
+    return wrapper
+
+
+def _queue_depth(lane: Lane) -> int:
+    with _limiters_lock:
+        limiters = list(_limiters_by_api_key.values())
+    return sum(l.queue_depth(lane) for l in limiters)
+
+
+for _lane in Lane:
+    QUEUE_DEPTH.set_function(functools.partial(_queue_depth, _lane), lane=_lane.name.lower())
+
+
+def _breaker_for(api_key: str, tourney_id: Optional[str]) -> resilience.CircuitBreaker:
+    with _breakers_lock:
+        if (api_key, tourney_id) not in _breakers:
+            _breakers[(api_key, tourney_id)] = resilience.CircuitBreaker()
+        return _breakers[(api_key, tourney_id)]
+
+
+def _classify(e: Exception) -> Optional[ChallongeError]:
+    """Returns the ChallongeError the given exception amounts to, if it came from talking to challonge."""
+    if isinstance(e, error.HTTPError):
+        if e.code == 429 or e.code >= 500:
+            return ChallongeUnavailable(f'Challonge responded with {e.code} {e.reason}.')
+        return RequestRejected(f'Challonge rejected the request with {e.code} {e.reason}.', e.code)
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return ChallongeUnavailable(f'Unable to reach challonge: {e!r}')
+    if isinstance(e, json.JSONDecodeError):
+        # Probably an error page from something in front of challonge.
+        return ChallongeUnavailable(f'Challonge responded with something other than JSON: {e}')
+    return None
+
+
+def _is_rate_limited(e: Exception) -> bool:
+    """Whether challonge turned the request down for going over the API key's rate limit."""
+    return isinstance(e, error.HTTPError) and e.code == 429
 
 
 class TourneyType(enum.Enum):
@@ -26,11 +179,160 @@ class Match:
     p2_id: str
 
 
+@dataclass
+class BracketMatch:
+    """A match anywhere in the bracket, along with the matches its players come from."""
+    id: str
+    # 'pending' (waiting on a player), 'open' or 'complete'.
+    state: str
+    p1_id: Optional[str]
+    p2_id: Optional[str]
+    # The match each player comes from, if any, and whether they come from it by losing.
+    p1_prereq_id: Optional[str]
+    p2_prereq_id: Optional[str]
+    p1_is_prereq_loser: bool
+    p2_is_prereq_loser: bool
+    winner_id: Optional[str] = None
+
+
 class Client:
-    def __init__(self, api_key):
+    """
+    Talks to challonge on behalf of the owner of an API key.
+
+    Every call comes in two flavors: an awaitable one (suffixed with _async),
+    which never blocks the caller's event loop, and a blocking one with the
+    same signature, which is a thin wrapper around the awaitable one.
+
+    Requests wait their turn in a lane (see Lane), and are sent as fast as the
+    rate limit for the API key allows. The first client created for an API
+    key decides its rate limit.
+
+    Failures raise a ChallongeError. Idempotent requests are retried a few
+    times if challonge is having trouble. If it keeps having trouble, with
+    one tournament or with the API key as a whole, a circuit breaker stops
+    sending those requests for a while, and they fail right away with
+    ChallongeUnavailable instead.
+    """
+
+    def __init__(self, api_key, requests_per_sec: float = None):
         self._api_key = api_key
+        self._pool = util.default_pool()
+        self._limiter = _limiter_for(api_key, requests_per_sec if requests_per_sec is not None else REQUESTS_PER_SEC)
+        # Validators for the last open match list we saw, by tournament ID.
+        self._open_matches_validators: Dict[str, util.Validator] = {}
+
+    def queue_depths(self) -> Dict[Lane, int]:
+        """How many requests are waiting to be sent in each lane, for every client sharing this API key."""
+        return {lane: self._limiter.queue_depth(lane) for lane in Lane}
+
+    @property
+    def requests_in_flight(self) -> int:
+        return self._limiter.in_flight
+
+    def circuit_state(self, tourney_id: str = None) -> resilience.CircuitState:
+        """
+        Whether we're sending requests for the given tournament, or for the API key as a whole if none is given.
+        """
+        states = [b.state for b in self._breakers(tourney_id)]
+        for state in (resilience.CircuitState.OPEN, resilience.CircuitState.HALF_OPEN):
+            if state in states:
+                return state
+        return resilience.CircuitState.CLOSED
+
+    def _breakers(self, tourney_id: Optional[str]) -> List[resilience.CircuitBreaker]:
+        breakers = [_breaker_for(self._api_key, None)]
+        if tourney_id is not None:
+            breakers.append(_breaker_for(self._api_key, tourney_id))
+        return breakers
+
+    async def _send(self, lane: Lane, request: Callable[[], Awaitable], tourney_id: str = None,
+                    idempotent: bool = False):
+        """
+        Sends the request made by calling request, when it's its turn.
+        Retries it if it's idempotent and challonge is having trouble.
+        """
+        # The limiter and breakers belong to the pool's event loop, so that they can be shared by every caller.
+        return await self._pool.run_async(self._send_with_retries(lane, request, tourney_id, idempotent))
+
+    async def _send_with_retries(self, lane: Lane, request: Callable[[], Awaitable], tourney_id: Optional[str],
+                                 idempotent: bool):
+        breakers = self._breakers(tourney_id)
+        attempts = MAX_ATTEMPTS if idempotent else 1
+        for attempt in range(attempts):
+            allowed = [b for b in breakers if b.allow_request()]
+            if len(allowed) < len(breakers):
+                for b in allowed:
+                    b.record_inconclusive()
+                raise ChallongeUnavailable('Not sending requests to challonge while it is having trouble.',
+                                           max(b.retry_in_secs() for b in breakers))
+            try:
+                result = await self._limiter.run(lane, request())
+            except Exception as e:
+                classified = _classify(e)
+                if classified is None:
+                    for b in breakers:
+                        b.record_inconclusive()
+                    raise
+                if not isinstance(classified, ChallongeUnavailable):
+                    # Challonge is up, it just didn't like the request.
+                    for b in breakers:
+                        b.record_success()
+                    raise classified from e
+
+                # Trouble with one tournament says nothing about the others, so only count it against the API key
+                # if the whole key is affected.
+                key_breaker, *tourney_breakers = breakers
+                for b in tourney_breakers:
+                    b.record_failure()
+                if tourney_id is None or _is_rate_limited(e):
+                    key_breaker.record_failure()
+                else:
+                    key_breaker.record_inconclusive()
+                classified.retry_in_secs = max(b.retry_in_secs() for b in breakers)
+                if attempt == attempts - 1 or classified.retry_in_secs > 0:
+                    raise classified from e
+                delay = resilience.backoff_delay(attempt, RETRY_BASE_DELAY_IN_SECS, RETRY_MAX_DELAY_IN_SECS)
+                logging.warning(f'{classified} Retrying in {delay:.2f} seconds.')
+                await asyncio.sleep(delay)
+                continue
+
+            except BaseException:
+                # Cancelled, so we never found out how it went.
+                for b in breakers:
+                    b.record_inconclusive()
+                raise
+
+            for b in breakers:
+                b.record_success()
+            return result
 
     def create_tournament(self, name, tournament_type=TourneyType.DOUBLE_ELIM, is_unlisted=True) -> Tuple[str, str]:
+        return self._pool.run(self.create_tournament_async(name, tournament_type, is_unlisted))
+
+    def start_tournament(self, tourney_id: str):
+        return self._pool.run(self.start_tournament_async(tourney_id))
+
+    def add_players(self, tourney_id, names: List[str]) -> Dict[str, str]:
+        return self._pool.run(self.add_players_async(tourney_id, names))
+
+    def update_username(self, tourney_id: str, player: data.Player, name: str):
+        return self._pool.run(self.update_username_async(tourney_id, player, name))
+
+    def list_matches(self, tourney_id: str, if_changed=False) -> Optional[List[Match]]:
+        return self._pool.run(self.list_matches_async(tourney_id, if_changed))
+
+    def list_all_matches(self, tourney_id: str) -> List[BracketMatch]:
+        return self._pool.run(self.list_all_matches_async(tourney_id))
+
+    def list_player_names_by_id(self, tourney_id: str) -> Dict[str, str]:
+        return self._pool.run(self.list_player_names_by_id_async(tourney_id))
+
+    def set_score(self, tourney_id: str, match_id: str, p1_score: int, p2_score: int, winner_id: str):
+        return self._pool.run(self.set_score_async(tourney_id, match_id, p1_score, p2_score, winner_id))
+
+    @_instrumented
+    async def create_tournament_async(self, name, tournament_type=TourneyType.DOUBLE_ELIM,
+                                      is_unlisted=True) -> Tuple[str, str]:
         """
         Creates a tournament with the given name.
         Returns the tournament ID and url.
@@ -45,11 +347,11 @@ class Client:
                 'private': is_unlisted,
             }
         }
-        resp = util.make_request(CHALLONGE_API,
-                                 '/tournaments.json',
-                                 params={'api_key': self._api_key},
-                                 data=payload,
-                                 raise_exception_on_http_error=False)
+        resp = await self._send(Lane.WRITE, lambda: util.make_request_async(CHALLONGE_API,
+                                                                            '/tournaments.json',
+                                                                            params={'api_key': self._api_key},
+                                                                            data=payload,
+                                                                            raise_exception_on_http_error=False))
 
         if 'tournament' not in resp:
             raise ValueError(
@@ -58,7 +360,18 @@ class Client:
 
         return resp['tournament']['id'], resp['tournament']['full_challonge_url']
 
-    def add_players(self, tourney_id, names: List[str]) -> Dict[str, str]:
+    @_instrumented
+    async def start_tournament_async(self, tourney_id: str):
+        """Starts the given tournament, so its matches can be played. Fails if it has already started."""
+        await self._send(Lane.WRITE, lambda: util.make_request_async(
+            CHALLONGE_API,
+            f'/tournaments/{tourney_id}/start.json',
+            params={'api_key': self._api_key},
+            data={},
+            raise_exception_on_http_error=True), tourney_id)
+
+    @_instrumented
+    async def add_players_async(self, tourney_id, names: List[str]) -> Dict[str, str]:
         """
         Adds the list of participant names to the tournament with the given tourney_id.
         Returns a map of the given names to their challonge participant IDs.
@@ -66,12 +379,16 @@ class Client:
         payload = {
             'participants': [{"name": n} for n in names],
         }
-        resp = util.make_request(
-            CHALLONGE_API,
-            f'/tournaments/{tourney_id}/participants/bulk_add.json',
-            params={'api_key': self._api_key},
-            data=payload,
-            raise_exception_on_http_error=True)
+        try:
+            resp = await self._send(Lane.WRITE, lambda: util.make_request_async(
+                CHALLONGE_API,
+                f'/tournaments/{tourney_id}/participants/bulk_add.json',
+                params={'api_key': self._api_key},
+                data=payload,
+                raise_exception_on_http_error=True), tourney_id)
+        finally:
+            # Even a failed request might have added some of them.
+            _player_names.invalidate((self._api_key, tourney_id))
 
         # Response format is a list of dicts, all with one property "participant".
         # Convert into dict of players by name.
@@ -80,7 +397,8 @@ class Client:
             for p in resp
         }
 
-    def update_username(self, tourney_id: str, player: data.Player, name: str):
+    @_instrumented
+    async def update_username_async(self, tourney_id: str, player: data.Player, name: str):
         """
         Updates a player's username in challonge.
         Returns true iff the user was present in the tournament.
@@ -94,39 +412,75 @@ class Client:
                 'challonge_username': name,
             }
         }
-        util.make_request(
-            CHALLONGE_API,
-            f'/tournaments/{tourney_id}/participants/{player.challonge_id}.json',
-            params={'api_key': self._api_key},
-            data=payload,
-            raise_exception_on_http_error=True,
-            method='PUT',
-        )
+        try:
+            await self._send(Lane.WRITE, lambda: util.make_request_async(
+                CHALLONGE_API,
+                f'/tournaments/{tourney_id}/participants/{player.challonge_id}.json',
+                params={'api_key': self._api_key},
+                data=payload,
+                raise_exception_on_http_error=True,
+                method='PUT',
+            ), tourney_id, idempotent=True)
+        finally:
+            _player_names.invalidate((self._api_key, tourney_id))
+
+    @_instrumented
+    async def list_matches_async(self, tourney_id: str, if_changed=False) -> Optional[List[Match]]:
+        """
+        Lists the open matches in the given tournament.
 
-    def list_matches(self, tourney_id: str) -> List[Match]:
-        matches = util.make_request(CHALLONGE_API,
-                                    f'/tournaments/{tourney_id}/matches.json',
-                                    params={
-                                        'api_key': self._api_key,
-                                        'state': "open"
-                                    },
-                                    raise_exception_on_http_error=True)
+        If if_changed is set, returns None instead if the list is the same as
+        the last time it was fetched.
+        """
+        validator = self._open_matches_validators.get(tourney_id) if if_changed else None
+        matches, validator = await self._send(Lane.POLL, lambda: util.make_conditional_request_async(
+            CHALLONGE_API,
+            f'/tournaments/{tourney_id}/matches.json',
+            params={
+                'api_key': self._api_key,
+                'state': "open"
+            },
+            validator=validator), tourney_id, idempotent=True)
+        if validator is not None:
+            self._open_matches_validators[tourney_id] = validator
+        if matches is None:
+            return None
 
         # Strip out the useless envelope-ish object
         # (an abject with 1 property, "match", and that's it.)
         return [_to_match(m) for m in matches]
 
-    def list_player_names_by_id(self, tourney_id: str) -> Dict[str, str]:
+    @_instrumented
+    async def list_all_matches_async(self, tourney_id: str) -> List[BracketMatch]:
+        """Lists every match in the given tournament, whatever its state."""
+        matches = await self._send(Lane.READ, lambda: util.make_request_async(
+            CHALLONGE_API,
+            f'/tournaments/{tourney_id}/matches.json',
+            {'api_key': self._api_key},
+            raise_exception_on_http_error=True), tourney_id, idempotent=True)
+        return [_to_bracket_match(m) for m in matches]
+
+    @_instrumented
+    async def list_player_names_by_id_async(self, tourney_id: str) -> Dict[str, str]:
         """
         Returns a map of player IDs to player names in challonge.
 
         Uses the official challonge username for a player if it is set.
         If the challonge username is not set, returns the nickname used by that player in the bracket.
+
+        Served from memory if we fetched it recently and haven't changed any players since.
         """
-        player_objs = util.make_request(CHALLONGE_API,
-                                    f'/tournaments/{tourney_id}/participants.json',
-                                    {'api_key': self._api_key},
-                                    raise_exception_on_http_error=True)
+        key = (self._api_key, tourney_id)
+        cached = _player_names.get(key)
+        if cached is not None:
+            return dict(cached)
+
+        generation = _player_names.generation(key)
+        player_objs = await self._send(Lane.READ, lambda: util.make_request_async(
+            CHALLONGE_API,
+            f'/tournaments/{tourney_id}/participants.json',
+            {'api_key': self._api_key},
+            raise_exception_on_http_error=True), tourney_id, idempotent=True)
 
         names_by_id = {}
         for p in player_objs:
@@ -136,20 +490,24 @@ class Client:
             name = p['challonge_username'] if p['challonge_username'] else p['name']
             names_by_id[p['id']] = name
 
-        return names_by_id
+        _player_names.put(key, names_by_id, generation)
+        return dict(names_by_id)
 
-    def set_score(self, tourney_id: str, match_id: str, p1_score: int, p2_score: int, winner_id: str):
-        util.make_request(CHALLONGE_API,
-                          f'/tournaments/{tourney_id}/matches/{match_id}.json',
-                          params={'api_key': self._api_key},
-                          data={
-                              'match': {
-                                  'scores_csv': f'{p1_score}-{p2_score}',
-                                  'winner_id': winner_id,
-                              }
-                          },
-                          method='PUT',
-                          raise_exception_on_http_error=True)
+    @_instrumented
+    async def set_score_async(self, tourney_id: str, match_id: str, p1_score: int, p2_score: int, winner_id: str):
+        # Setting the same score twice is harmless, so this is safe to retry.
+        await self._send(Lane.WRITE, lambda: util.make_request_async(
+            CHALLONGE_API,
+            f'/tournaments/{tourney_id}/matches/{match_id}.json',
+            params={'api_key': self._api_key},
+            data={
+                'match': {
+                    'scores_csv': f'{p1_score}-{p2_score}',
+                    'winner_id': winner_id,
+                }
+            },
+            method='PUT',
+            raise_exception_on_http_error=True), tourney_id, idempotent=True)
 
 
 def _to_match(envelope):
@@ -161,6 +519,21 @@ def _to_match(envelope):
     )
 
 
+def _to_bracket_match(envelope):
+    match_obj = envelope['match']
+    return BracketMatch(
+        match_obj['id'],
+        match_obj['state'],
+        match_obj['player1_id'],
+        match_obj['player2_id'],
+        match_obj['player1_prereq_match_id'],
+        match_obj['player2_prereq_match_id'],
+        bool(match_obj['player1_is_prereq_match_loser']),
+        bool(match_obj['player2_is_prereq_match_loser']),
+        match_obj.get('winner_id'),
+    )
+
+
 def _test_creation():
     # Create a new tournament, and add 2 dummy players to it.
     auth_token = sys.argv[1]
@@ -2,22 +2,53 @@
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import AbstractSet, FrozenSet, Iterable, List, Optional
+
+
+# Players and matches use __slots__ to keep large tournaments small in memory.
+# Each class lists its fields twice (once in __slots__, once as annotations),
+# so keep them in sync.
+
+
+def _restore_slots(obj, state):
+    """
+    Sets fields when unpickling.
+    Pickles from before these classes had __slots__ store their fields as a plain dict.
+    """
+    if isinstance(state, tuple):
+        _, state = state
+    for name, value in state.items():
+        object.__setattr__(obj, name, value)
 
 
 @dataclass
 class Player:
+    __slots__ = ('discord_id', 'challonge_id', 'key_id')
     discord_id: int
     challonge_id: str
     key_id: uuid.UUID
 
+    __setstate__ = _restore_slots
+
 
 def new_player(discord_id: int, challonge_id: str) -> Player:
     return Player(discord_id, challonge_id, uuid.uuid4())
 
 
+# Shared by every match nobody has checked in to, so that they don't each need an empty set of their own.
+NO_CHECK_INS: FrozenSet[int] = frozenset()
+
+
+def check_ins(discord_ids: Iterable[int]) -> FrozenSet[int]:
+    """The check-ins to store on a match for the given players. Replace them with a new one to change them."""
+    ids = frozenset(discord_ids)
+    return ids if ids else NO_CHECK_INS
+
+
 @dataclass
 class Match:
+    __slots__ = ('p1', 'p2', 'call_message_id', 'call_time', 'warn_time', 'dq_time', 'checked_in_ids',
+                 'challonge_id', 'key_id')
     p1: Player
     p2: Player
 
@@ -25,10 +56,17 @@ class Match:
     call_time: Optional[datetime]
     warn_time: Optional[datetime]
     dq_time: Optional[datetime]
+    # Discord IDs of the players that reacted to the call message. See check_ins.
+    checked_in_ids: AbstractSet[int]
 
     challonge_id: str
     key_id: uuid.UUID
 
+    def __setstate__(self, state):
+        _restore_slots(self, state)
+        # Matches pickled before check-ins were tracked don't have any, and older ones kept them in a set.
+        self.checked_in_ids = check_ins(getattr(self, 'checked_in_ids', ()))
+
 
 def new_match(p1: Player, p2: Player, external_id: str):
     return Match(
@@ -39,5 +77,31 @@ def new_match(p1: Player, p2: Player, external_id: str):
         call_time=None,
         warn_time=None,
         dq_time=None,
+        checked_in_ids=NO_CHECK_INS,
         key_id=uuid.uuid4(),
     )
+
+
+@dataclass
+class OpenMatchDiff:
+    """How the open matches in a bracket changed between two polls."""
+    # Matches that weren't open as of the previous poll, but are now.
+    opened: List[Match]
+    # Matches that were open as of the previous poll, but aren't anymore (usually because they were reported).
+    closed: List[Match]
+    # Matches that were open as of both polls.
+    unchanged: List[Match]
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.opened or self.closed)
+
+
+@dataclass
+class Result:
+    """Who won a match in a bracket played out locally (see engine.py)."""
+    match_id: str
+    winner_id: str
+    # Unknown for results reported on challonge.
+    p1_score: Optional[int] = None
+    p2_score: Optional[int] = None
@@ -0,0 +1,256 @@
+"""
+Plays out brackets locally: generates them, and moves players along as results come in.
+
+The bot runs brackets with this so it can call matches without waiting on
+challonge (see mirror.py).
+"""
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+import challonge
+import swiss
+
+# Stands in for the missing opponent of the top seeds when the number of players isn't a power of 2.
+BYE = 'bye'
+
+FORMATS = (challonge.TourneyType.SINGLE_ELIM, challonge.TourneyType.DOUBLE_ELIM, challonge.TourneyType.ROUND_ROBIN,
+           challonge.TourneyType.SWISS)
+
+
+class Match:
+    def __init__(self, match_id: Hashable, round_number: int):
+        self.id = match_id
+        # Negative in the losers bracket.
+        self.round = round_number
+        # Player IDs, BYE, or None until the match feeding into that slot is decided.
+        self.players: List = [None, None]
+        # The (match, whether it's the loser) that feeds into each slot.
+        self.prereqs: List[Optional[Tuple['Match', bool]]] = [None, None]
+        # Where the winner and loser go next, as (match, slot).
+        self.winner_to: Optional[Tuple['Match', int]] = None
+        self.loser_to: Optional[Tuple['Match', int]] = None
+        # In round robins, the matches either player has to finish before this one, and the other way around.
+        self.after: List['Match'] = []
+        self.before: List['Match'] = []
+        self.winner_id = None
+        self.loser_id = None
+        # Byes and grand final resets that weren't needed are decided without being played.
+        self.hidden = False
+
+    @property
+    def state(self) -> str:
+        if self.winner_id is not None:
+            return 'complete'
+        if None in self.players or any(m.winner_id is None for m in self.after):
+            return 'pending'
+        return 'open'
+
+
+class Engine:
+    """
+    A bracket in one of FORMATS.
+
+    Matches are made with new_match, so that callers can keep extra fields on them.
+    Swiss rounds are paired with pair_round (see swiss.py) as the round before them finishes.
+    """
+
+    def __init__(self, tournament_type: challonge.TourneyType, match_ids: Iterator[Hashable],
+                 new_match: Callable[[Hashable, int], Match] = Match,
+                 pair_round: Callable[[List[swiss.Standing]], swiss.Pairing] = swiss.pair_round):
+        if tournament_type not in FORMATS:
+            raise ValueError(f'Only {", ".join(f.value for f in FORMATS)} brackets can be played out locally.')
+        self.tournament_type = tournament_type
+        self.matches: Dict[Hashable, Match] = {}
+        self.grand_final: Optional[Match] = None
+        # Only played if the player coming from the losers bracket wins the first grand final.
+        self.grand_final_reset: Optional[Match] = None
+        self._match_ids = match_ids
+        self._new_match = new_match
+        self._pair_round = pair_round
+        # In swiss, the players in seed order, how many rounds there are, the round being played,
+        # and how many of its matches are left.
+        self._seeds: List = []
+        self.rounds = 0
+        self._round_number = 0
+        self._round_left = 0
+
+    @property
+    def finished(self) -> bool:
+        return bool(self.matches) and all(m.state == 'complete' for m in self.matches.values())
+
+    def start(self, player_ids: List) -> List[Match]:
+        """Generates the bracket for the given players, in seed order. Returns the matches that are open."""
+        if self.matches:
+            raise ValueError('The bracket has already been started.')
+        if len(player_ids) < 2:
+            raise ValueError('A bracket needs at least 2 players.')
+        if self.tournament_type == challonge.TourneyType.ROUND_ROBIN:
+            self._start_round_robin(player_ids)
+            return self.open_matches()
+        if self.tournament_type == challonge.TourneyType.SWISS:
+            self._seeds = list(player_ids)
+            self.rounds = swiss.rounds_for(len(player_ids))
+            self._pair_next_round([])
+            return self.open_matches()
+
+        first_round = self._start_elimination(player_ids)
+        for m in first_round:
+            self._settle_byes(m, [])
+        return self.open_matches()
+
+    def open_matches(self) -> List[Match]:
+        return [m for m in self.matches.values() if m.state == 'open' and not m.hidden]
+
+    def report(self, match_id: Hashable, winner_id) -> List[Match]:
+        """Records who won the given open match. Returns the matches that opened up as a result."""
+        m = self.matches.get(match_id)
+        if m is None or m.hidden:
+            raise KeyError(match_id)
+        if m.state != 'open':
+            raise ValueError(f'Match {match_id} is {m.state}, not open.')
+        if winner_id not in m.players:
+            raise ValueError(f'{winner_id} is not playing in match {match_id}.')
+        opened = []
+        self._decide(m, winner_id, opened)
+        return opened
+
+    def _add(self, round_number: int, *prereqs: Tuple[Match, bool]) -> Match:
+        m = self._new_match(next(self._match_ids), round_number)
+        for slot, (source, is_loser) in enumerate(prereqs):
+            m.prereqs[slot] = (source, is_loser)
+            if is_loser:
+                source.loser_to = (m, slot)
+            else:
+                source.winner_to = (m, slot)
+        self.matches[m.id] = m
+        return m
+
+    def _start_elimination(self, player_ids: List) -> List[Match]:
+        # Winners bracket, with the top seeds kept apart until the end and getting the byes.
+        seeds = list(player_ids) + [BYE] * (_next_power_of_2(len(player_ids)) - len(player_ids))
+        order = _seed_order(len(seeds))
+        first_round = []
+        for i in range(0, len(order), 2):
+            m = self._add(1)
+            m.players = [seeds[order[i]], seeds[order[i + 1]]]
+            first_round.append(m)
+        winners = [first_round]
+        while len(winners[-1]) > 1:
+            prev = winners[-1]
+            winners.append([self._add(len(winners) + 1, (prev[i], False), (prev[i + 1], False))
+                            for i in range(0, len(prev), 2)])
+        if self.tournament_type != challonge.TourneyType.DOUBLE_ELIM:
+            return first_round
+
+        # Losers bracket. It alternates between rounds where losers from the winners bracket drop in,
+        # and rounds where the players already in it play each other.
+        if len(winners) == 1:
+            losers_champion = (winners[0][0], True)
+        else:
+            losers = [self._add(-1, (winners[0][i], True), (winners[0][i + 1], True))
+                      for i in range(0, len(winners[0]), 2)]
+            for r, dropping in enumerate(winners[1:]):
+                # Drop losers in reversed every other round, so people don't replay who they just lost to.
+                dropping = dropping[::-1] if r % 2 == 0 else dropping
+                losers = [self._add(-(2 * r + 2), (losers[i], False), (dropping[i], True))
+                          for i in range(len(losers))]
+                if len(losers) > 1:
+                    losers = [self._add(-(2 * r + 3), (losers[i], False), (losers[i + 1], False))
+                              for i in range(0, len(losers), 2)]
+            losers_champion = (losers[0], False)
+
+        self.grand_final = self._add(len(winners) + 1, (winners[-1][0], False), losers_champion)
+        self.grand_final_reset = self._add(len(winners) + 1)
+        return first_round
+
+    def _start_round_robin(self, player_ids: List):
+        # The circle method: everyone but the first player rotates one place each round,
+        # and whoever is sat opposite each other plays.
+        seats = list(player_ids) + ([BYE] if len(player_ids) % 2 else [])
+        last_match = {}
+        for r in range(len(seats) - 1):
+            for i in range(len(seats) // 2):
+                p1, p2 = seats[i], seats[-1 - i]
+                if BYE in (p1, p2):
+                    continue
+                m = self._add(r + 1)
+                m.players = [p1, p2]
+                # Each player only plays one match at a time, in round order.
+                for p in (p1, p2):
+                    if p in last_match:
+                        m.after.append(last_match[p])
+                        last_match[p].before.append(m)
+                    last_match[p] = m
+            seats = seats[:1] + seats[-1:] + seats[1:-1]
+
+    def _pair_next_round(self, opened: List[Match]):
+        # Where everyone stands after every match so far. A bye counts as a win.
+        standings = {p: swiss.Standing(p, 0, seed) for seed, p in enumerate(self._seeds)}
+        for m in self.matches.values():
+            if BYE in m.players:
+                standings[m.winner_id].had_bye = True
+            else:
+                standings[m.players[0]].opponents.add(m.players[1])
+                standings[m.players[1]].opponents.add(m.players[0])
+            standings[m.winner_id].score += 1
+
+        pairing = self._pair_round(list(standings.values()))
+        self._round_number += 1
+        self._round_left = len(pairing.pairs) + (pairing.bye is not None)
+        for p1, p2 in pairing.pairs:
+            m = self._add(self._round_number)
+            m.players = [p1, p2]
+            opened.append(m)
+        if pairing.bye is not None:
+            m = self._add(self._round_number)
+            m.players = [pairing.bye, BYE]
+            self._settle_byes(m, opened)
+
+    def _decide(self, m: Match, winner, opened: List[Match]):
+        m.winner_id = winner
+        m.loser_id = m.players[1] if winner == m.players[0] else m.players[0]
+
+        if m is self.grand_final:
+            reset = self.grand_final_reset
+            if winner == m.players[0]:
+                # The winners bracket champion won, so there's nothing to reset.
+                reset.hidden = True
+                reset.winner_id, reset.loser_id = m.winner_id, m.loser_id
+            else:
+                reset.players = list(m.players)
+                opened.append(reset)
+        for to, player in ((m.winner_to, m.winner_id), (m.loser_to, m.loser_id)):
+            if to is not None:
+                to[0].players[to[1]] = player
+                self._settle_byes(to[0], opened)
+        for n in m.before:
+            if n.state == 'open':
+                opened.append(n)
+        if self.tournament_type == challonge.TourneyType.SWISS:
+            self._round_left -= 1
+            if self._round_left == 0 and self._round_number < self.rounds:
+                self._pair_next_round(opened)
+
+    def _settle_byes(self, m: Match, opened: List[Match]):
+        if m.state != 'open':
+            return
+        if BYE in m.players:
+            m.hidden = True
+            self._decide(m, m.players[1] if m.players[0] == BYE else m.players[0], opened)
+        else:
+            opened.append(m)
+
+
+def _next_power_of_2(n: int) -> int:
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+
+def _seed_order(size: int) -> List[int]:
+    """The (0-indexed) seed in each slot of the first round, so that seeds 1 and 2 can only meet in the final."""
+    order = [0]
+    while len(order) < size:
+        n = len(order) * 2
+        order = [s for seed in order for s in (seed, n - 1 - seed)]
+    return order
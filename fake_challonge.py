@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+A stand-in for challonge's API, for running the bot and its tests offline.
+
+Usage: ./fake_challonge.py [port]
+Then run the bot with CHALLONGE_API set to the URL it prints.
+
+Implements the endpoints challonge.Client uses, and plays out single
+elimination, double elimination, round robin and swiss brackets as scores
+are reported. Tournaments start the first time their matches are listed, or
+when POSTed to /start.json.
+
+Brackets are generated here independently of engine.py, so that tests can
+check the bot's local brackets against them. Swiss rounds are paired more
+simply than swiss.py does it, the way challonge is free to pair them its own way.
+
+It can also misbehave on purpose, set with these environment variables:
+ * FAKE_CHALLONGE_LATENCY_IN_SECS: How long to wait before responding.
+ * FAKE_CHALLONGE_ERROR_RATE: The fraction of requests to fail with a 500.
+ * FAKE_CHALLONGE_REQUESTS_PER_SEC: Respond with 429 to requests beyond this rate.
+ * FAKE_CHALLONGE_AUTO_REPORT_IN_SECS: Report a random winner for matches that have been open this long,
+   as if the players reported it themselves.
+
+It can also send a webhook notification (see webhooks.py) every time a match
+changes state, to FAKE_CHALLONGE_WEBHOOK_URL, signed with FAKE_CHALLONGE_WEBHOOK_SECRET.
+"""
+import contextlib
+import hashlib
+import http.server
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import ratelimit
+import webhooks
+
+# Stands in for the missing opponent of the top seeds when the number of players isn't a power of 2.
+BYE = 'bye'
+
+_SINGLE_ELIM = 'single elimination'
+_DOUBLE_ELIM = 'double elimination'
+_ROUND_ROBIN = 'round robin'
+_SWISS = 'swiss'
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, *errors: str):
+        super().__init__(status, errors)
+        self.status = status
+        self.errors = list(errors)
+
+
+class FakeMatch:
+    def __init__(self, match_id: int, tournament_id: int, round_number: int):
+        self.id = match_id
+        self.tournament_id = tournament_id
+        self.round = round_number
+        # Participant IDs, BYE, or None until the match feeding into that slot is decided.
+        self.players: List = [None, None]
+        # The (match, whether it's the loser) that feeds into each slot.
+        self.prereqs: List[Optional[Tuple['FakeMatch', bool]]] = [None, None]
+        # Where the winner and loser go next, as (match, slot).
+        self.winner_to: Optional[Tuple['FakeMatch', int]] = None
+        self.loser_to: Optional[Tuple['FakeMatch', int]] = None
+        self.winner_id = None
+        self.loser_id = None
+        self.scores_csv = ''
+        # Byes and grand final resets that weren't needed are decided without being played, and never listed.
+        self.hidden = False
+        self.opened_at: Optional[float] = None
+        self.updated_at = _now()
+
+    @property
+    def state(self) -> str:
+        if self.winner_id is not None:
+            return 'complete'
+        if None in self.players:
+            return 'pending'
+        return 'open'
+
+    def to_json(self) -> dict:
+        prereq_ids = [p[0].id if p else None for p in self.prereqs]
+        return {'match': {
+            'id': self.id,
+            'tournament_id': self.tournament_id,
+            'state': self.state,
+            'round': self.round,
+            # Challonge doesn't list byes as players.
+            'player1_id': None if self.players[0] == BYE else self.players[0],
+            'player2_id': None if self.players[1] == BYE else self.players[1],
+            'player1_prereq_match_id': prereq_ids[0],
+            'player2_prereq_match_id': prereq_ids[1],
+            'player1_is_prereq_match_loser': bool(self.prereqs[0] and self.prereqs[0][1]),
+            'player2_is_prereq_match_loser': bool(self.prereqs[1] and self.prereqs[1][1]),
+            'winner_id': self.winner_id,
+            'loser_id': self.loser_id,
+            'scores_csv': self.scores_csv,
+            'updated_at': self.updated_at,
+        }}
+
+
+class FakeTournament:
+    def __init__(self, tournament_id: int, name: str, url: str, tournament_type: str, private: bool):
+        self.id = tournament_id
+        self.name = name
+        self.url = url
+        self.tournament_type = tournament_type
+        self.private = private
+        self.state = 'pending'
+        # Participant JSON by ID, in seed order.
+        self.participants: Dict[int, dict] = {}
+        self.matches: Dict[int, FakeMatch] = {}
+        self._grand_final: Optional[FakeMatch] = None
+        self._grand_final_reset: Optional[FakeMatch] = None
+        self._match_ids: Optional[itertools.count] = None
+        # In swiss, how many rounds there are, and who has had a bye.
+        self._swiss_rounds = 0
+        self._byes: List[int] = []
+
+    def to_json(self) -> dict:
+        return {'tournament': {
+            'id': self.id,
+            'name': self.name,
+            'url': self.url,
+            'tournament_type': self.tournament_type,
+            'private': self.private,
+            'state': self.state,
+            'participants_count': len(self.participants),
+            'full_challonge_url': f'https://challonge.com/{self.url}',
+        }}
+
+    def start(self, match_ids: itertools.count):
+        if self.state != 'pending':
+            raise HttpError(422, 'Tournament has already started.')
+        if len(self.participants) < 2:
+            raise HttpError(422, 'Tournament needs at least 2 participants to start.')
+        if self.tournament_type not in (_SINGLE_ELIM, _DOUBLE_ELIM, _ROUND_ROBIN, _SWISS):
+            raise HttpError(422, f'The fake only plays {_SINGLE_ELIM}, {_DOUBLE_ELIM}, {_ROUND_ROBIN} '
+                                 f'and {_SWISS} tournaments.')
+        self.state = 'underway'
+        self._match_ids = match_ids
+
+        if self.tournament_type == _ROUND_ROBIN:
+            self._start_round_robin()
+            return
+        if self.tournament_type == _SWISS:
+            # Enough rounds for one player to be the only one who hasn't lost.
+            self._swiss_rounds = max(1, (len(self.participants) - 1).bit_length())
+            self._pair_swiss_round()
+            return
+
+        # Winners bracket, with the top seeds kept apart until the end and getting the byes.
+        seeds = list(self.participants) + [BYE] * (_next_power_of_2(len(self.participants)) - len(self.participants))
+        order = _seed_order(len(seeds))
+        first_round = []
+        for i in range(0, len(order), 2):
+            m = self._new_match(1)
+            m.players = [seeds[order[i]], seeds[order[i + 1]]]
+            first_round.append(m)
+        winners = [first_round]
+        while len(winners[-1]) > 1:
+            prev = winners[-1]
+            winners.append([self._new_match(len(winners) + 1, (prev[i], False), (prev[i + 1], False))
+                            for i in range(0, len(prev), 2)])
+
+        if self.tournament_type == _DOUBLE_ELIM:
+            # Losers bracket. It alternates between rounds where losers from the winners bracket drop in,
+            # and rounds where the players already in it play each other.
+            if len(winners) == 1:
+                losers_champion = (winners[0][0], True)
+            else:
+                losers = [self._new_match(-1, (winners[0][i], True), (winners[0][i + 1], True))
+                          for i in range(0, len(winners[0]), 2)]
+                for r, dropping in enumerate(winners[1:]):
+                    # Drop losers in reversed every other round, so people don't replay who they just lost to.
+                    dropping = dropping[::-1] if r % 2 == 0 else dropping
+                    losers = [self._new_match(-(2 * r + 2), (losers[i], False), (dropping[i], True))
+                              for i in range(len(losers))]
+                    if len(losers) > 1:
+                        losers = [self._new_match(-(2 * r + 3), (losers[i], False), (losers[i + 1], False))
+                                  for i in range(0, len(losers), 2)]
+                losers_champion = (losers[0], False)
+
+            self._grand_final = self._new_match(len(winners) + 1, (winners[-1][0], False), losers_champion)
+            # Only played if the player coming from the losers bracket wins the first grand final.
+            self._grand_final_reset = self._new_match(len(winners) + 1)
+
+        for m in first_round:
+            self._settle_byes(m)
+
+    def report(self, match_id: int, scores_csv: str, winner_id) -> FakeMatch:
+        m = self.matches.get(match_id)
+        if m is None or m.hidden:
+            raise HttpError(404, 'Match not found.')
+        if winner_id is not None and str(winner_id) not in (str(p) for p in m.players):
+            raise HttpError(422, 'Winner must be one of the players in the match.')
+        winner = next((p for p in m.players if str(p) == str(winner_id)), None)
+
+        if m.state == 'complete':
+            if winner is not None and winner != m.winner_id:
+                raise HttpError(422, 'The fake does not support changing the winner of a completed match.')
+        elif m.state != 'open':
+            raise HttpError(422, 'Match is not open yet.')
+        m.scores_csv = scores_csv if scores_csv is not None else m.scores_csv
+        m.updated_at = _now()
+        if m.state == 'open' and winner is not None:
+            self._decide(m, winner)
+        return m
+
+    def open_matches(self) -> List[FakeMatch]:
+        return [m for m in self.matches.values() if m.state == 'open' and not m.hidden]
+
+    def _new_match(self, round_number: int, *prereqs: Tuple[FakeMatch, bool]) -> FakeMatch:
+        m = FakeMatch(next(self._match_ids), self.id, round_number)
+        for slot, (source, is_loser) in enumerate(prereqs):
+            m.prereqs[slot] = (source, is_loser)
+            if is_loser:
+                source.loser_to = (m, slot)
+            else:
+                source.winner_to = (m, slot)
+        self.matches[m.id] = m
+        return m
+
+    def _start_round_robin(self):
+        # Everyone plays everyone, all at once, in the first round where neither player is busy.
+        rounds_played: Dict[int, set] = {p: set() for p in self.participants}
+        for p1, p2 in itertools.combinations(self.participants, 2):
+            round_number = next(r for r in itertools.count(1)
+                                if r not in rounds_played[p1] and r not in rounds_played[p2])
+            rounds_played[p1].add(round_number)
+            rounds_played[p2].add(round_number)
+            m = self._new_match(round_number)
+            m.players = [p1, p2]
+            self._opened(m)
+
+    def _pair_swiss_round(self):
+        """
+        Pairs everyone with the next highest ranked player they haven't played, if there is one.
+        With an odd number of players, the lowest ranked player who hasn't had a bye gets one.
+        """
+        wins = {p: self._byes.count(p) for p in self.participants}
+        played = {p: set() for p in self.participants}
+        rounds = 0
+        for m in self.matches.values():
+            wins[m.winner_id] += 1
+            played[m.players[0]].add(m.players[1])
+            played[m.players[1]].add(m.players[0])
+            rounds = max(rounds, m.round)
+        seeds = {p: i for i, p in enumerate(self.participants)}
+        ranked = sorted(seeds, key=lambda p: (-wins[p], seeds[p]))
+        if len(ranked) % 2:
+            bye = next((p for p in reversed(ranked) if p not in self._byes), ranked[-1])
+            ranked.remove(bye)
+            self._byes.append(bye)
+        while ranked:
+            p1 = ranked.pop(0)
+            p2 = next((p for p in ranked if p not in played[p1]), ranked[0])
+            ranked.remove(p2)
+            m = self._new_match(rounds + 1)
+            m.players = [p1, p2]
+            self._opened(m)
+
+    def _decide(self, m: FakeMatch, winner):
+        m.winner_id = winner
+        m.loser_id = m.players[1] if winner == m.players[0] else m.players[0]
+        m.updated_at = _now()
+
+        if m is self._grand_final:
+            reset = self._grand_final_reset
+            if winner == m.players[0]:
+                # The winners bracket champion won, so there's nothing to reset.
+                reset.hidden = True
+                reset.winner_id, reset.loser_id = m.winner_id, m.loser_id
+            else:
+                reset.players = list(m.players)
+                self._opened(reset)
+        for to, player in ((m.winner_to, m.winner_id), (m.loser_to, m.loser_id)):
+            if to is not None:
+                to[0].players[to[1]] = player
+                self._settle_byes(to[0])
+                self._opened(to[0])
+        if all(x.state == 'complete' for x in self.matches.values()):
+            if self.tournament_type == _SWISS and max(x.round for x in self.matches.values()) < self._swiss_rounds:
+                self._pair_swiss_round()
+            else:
+                self.state = 'complete'
+
+    def _settle_byes(self, m: FakeMatch):
+        if m.state == 'open' and BYE in m.players:
+            m.hidden = True
+            self._decide(m, m.players[1] if m.players[0] == BYE else m.players[0])
+        else:
+            self._opened(m)
+
+    @staticmethod
+    def _opened(m: FakeMatch):
+        if m.state == 'open' and m.opened_at is None:
+            m.opened_at = time.monotonic()
+
+
+def _next_power_of_2(n: int) -> int:
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+
+def _seed_order(size: int) -> List[int]:
+    """The (0-indexed) seed in each slot of the first round, so that seeds 1 and 2 can only meet in the final."""
+    order = [0]
+    while len(order) < size:
+        n = len(order) * 2
+        order = [s for seed in order for s in (seed, n - 1 - seed)]
+    return order
+
+
+class FakeChallonge:
+    """
+    Serves a fake challonge API on localhost, from a background thread.
+
+    Everything it knows is kept in memory, and forgotten when it's stopped.
+    """
+
+    def __init__(self,
+                 port: int = 0,
+                 latency_in_secs: float = 0.0,
+                 error_rate: float = 0.0,
+                 requests_per_sec: float = None,
+                 auto_report_in_secs: float = None,
+                 rng: random.Random = None,
+                 webhook_url: str = None,
+                 webhook_secret: str = None):
+        self.latency_in_secs = latency_in_secs
+        self.error_rate = error_rate
+        self.auto_report_in_secs = auto_report_in_secs
+        self._bucket = ratelimit.TokenBucket(requests_per_sec, max(1, requests_per_sec)) if requests_per_sec else None
+        self._rng = rng if rng is not None else random.Random()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # Status codes to fail the next requests with, in order.
+        self._failures: List[Optional[int]] = []
+        self.tournaments: Dict[int, FakeTournament] = {}
+        # (method, path) of every request received, in order.
+        self.requests: List[Tuple[str, str]] = []
+        self.webhook_url = webhook_url
+        self._webhook_secret = webhook_secret
+        # Notifications waiting to be sent, in order. None tells the sender to stop.
+        self._notifications: queue.Queue = queue.Queue()
+        self._sender: Optional[threading.Thread] = None
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send the headers and body together, instead of waiting on delayed ACKs in between.
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                status, headers, resp = fake._handle(self.command, self.path, body,
+                                                     self.headers.get('If-None-Match'))
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(resp)))
+                self.end_headers()
+                self.wfile.write(resp)
+
+            do_GET = do_POST = do_PUT = respond
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """What to set challonge.CHALLONGE_API to."""
+        return f'http://127.0.0.1:{self._server.server_port}/v1'
+
+    def start(self) -> 'FakeChallonge':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-challonge', daemon=True)
+        self._thread.start()
+        if self.webhook_url is not None:
+            self._sender = threading.Thread(target=self._send_notifications, name='fake-challonge-webhooks',
+                                            daemon=True)
+            self._sender.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._sender is not None:
+            self._notifications.put(None)
+            self._sender.join()
+
+    def __enter__(self) -> 'FakeChallonge':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self, tourney_id: int, match_id: int, winner_id, scores_csv: str = '2-0'):
+        """Reports the given match as its players would, on challonge's website."""
+        with self._lock:
+            t = self.tournaments[tourney_id]
+            with self._watching(t):
+                t.report(match_id, scores_csv, winner_id)
+
+    def fail_next(self, *statuses: Optional[int]):
+        """Responds to the next requests with the given status codes, one each. None lets a request through."""
+        with self._lock:
+            self._failures.extend(statuses)
+
+    def _handle(self, method: str, raw_path: str, body: bytes, etag: Optional[str]) -> Tuple[int, dict, bytes]:
+        url = urllib.parse.urlsplit(raw_path)
+        path = url.path[len('/v1'):] if url.path.startswith('/v1/') else url.path
+        params = dict(urllib.parse.parse_qsl(url.query))
+        with self._lock:
+            self.requests.append((method, path))
+            failure = self._failures.pop(0) if self._failures else None
+            limited = self._bucket is not None and not self._bucket.try_acquire()
+        if self.latency_in_secs:
+            time.sleep(self.latency_in_secs)
+
+        try:
+            if failure is not None:
+                raise HttpError(failure, f'Injected {failure}.')
+            if limited:
+                raise HttpError(429, 'Rate limit exceeded.')
+            if self._rng.random() < self.error_rate:
+                raise HttpError(500, 'Injected error.')
+            if 'api_key' not in params:
+                raise HttpError(401, 'Missing API key.')
+            try:
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                raise HttpError(400, 'Request body must be JSON.')
+            with self._lock:
+                resp = self._route(method, path, params, payload)
+        except HttpError as e:
+            return e.status, {'Content-Type': 'application/json'}, json.dumps({'errors': e.errors}).encode()
+
+        resp_body = json.dumps(resp).encode()
+        headers = {'Content-Type': 'application/json'}
+        if method == 'GET':
+            headers['ETag'] = f'"{hashlib.md5(resp_body).hexdigest()}"'
+            if etag == headers['ETag']:
+                return 304, headers, b''
+        return 200, headers, resp_body
+
+    def _route(self, method: str, path: str, params: Dict[str, str], payload: dict):
+        if (method, path) == ('POST', '/tournaments.json'):
+            return self._create(payload.get('tournament', {}))
+
+        m = re.fullmatch(r'/tournaments/(\d+)(/.*)\.json', path)
+        if m is None:
+            raise HttpError(404, 'Not found.')
+        t = self.tournaments.get(int(m.group(1)))
+        if t is None:
+            raise HttpError(404, 'Tournament not found.')
+        with self._watching(t):
+            return self._route_tournament(t, method, m.group(2), params, payload)
+
+    def _route_tournament(self, t: FakeTournament, method: str, rest: str, params: Dict[str, str], payload: dict):
+        if (method, rest) == ('POST', '/start'):
+            t.start(self._ids)
+            return t.to_json()
+        if (method, rest) == ('GET', '/participants'):
+            return [{'participant': p} for p in t.participants.values()]
+        if (method, rest) == ('POST', '/participants/bulk_add'):
+            return self._add_participants(t, payload.get('participants', []))
+        m = re.fullmatch(r'/participants/(\d+)', rest)
+        if method == 'PUT' and m:
+            p = t.participants.get(int(m.group(1)))
+            if p is None:
+                raise HttpError(404, 'Participant not found.')
+            p.update(payload.get('participant', {}))
+            return {'participant': p}
+        if (method, rest) == ('GET', '/matches'):
+            if t.state == 'pending' and len(t.participants) >= 2:
+                t.start(self._ids)
+            self._auto_report(t)
+            state = params.get('state', 'all')
+            return [m.to_json() for m in t.matches.values() if not m.hidden and state in ('all', m.state)]
+        m = re.fullmatch(r'/matches/(\d+)', rest)
+        if method == 'PUT' and m:
+            match = payload.get('match', {})
+            return t.report(int(m.group(1)), match.get('scores_csv'), match.get('winner_id')).to_json()
+        raise HttpError(404, 'Not found.')
+
+    @contextlib.contextmanager
+    def _watching(self, t: FakeTournament):
+        """Sends a notification for every match that changes state in the body of the with block."""
+        if self.webhook_url is None:
+            yield
+            return
+        before = {m.id: m.state for m in t.matches.values() if not m.hidden}
+        try:
+            yield
+        finally:
+            for m in t.matches.values():
+                if not m.hidden and before.get(m.id, 'pending') != m.state:
+                    self._notifications.put(json.dumps({
+                        'id': str(uuid.uuid4()),
+                        'tournament_id': t.id,
+                        'match_id': m.id,
+                        'state': m.state,
+                    }).encode())
+
+    def _send_notifications(self):
+        while (body := self._notifications.get()) is not None:
+            request = urllib.request.Request(self.webhook_url, body, method='POST', headers={
+                'Content-Type': 'application/json',
+                webhooks.SIGNATURE_HEADER: webhooks.sign(self._webhook_secret or '', body),
+            })
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except (urllib.error.URLError, OSError) as e:
+                logging.warning(f'Unable to send webhook notification to {self.webhook_url}: {e}')
+
+    def _create(self, fields: dict) -> dict:
+        if not fields.get('name'):
+            raise HttpError(422, "Name can't be blank.")
+        t = FakeTournament(next(self._ids), fields['name'], fields.get('url') or fields['name'],
+                           fields.get('tournament_type', _SINGLE_ELIM), bool(fields.get('private')))
+        self.tournaments[t.id] = t
+        return t.to_json()
+
+    def _add_participants(self, t: FakeTournament, participants: List[dict]) -> List[dict]:
+        if t.state != 'pending':
+            raise HttpError(422, 'Participants cannot be added once the tournament has started.')
+        taken = {p['name'] for p in t.participants.values()}
+        names = [p.get('name') for p in participants]
+        if None in names or len(set(names)) != len(names) or taken.intersection(names):
+            raise HttpError(422, 'Every participant needs a name, and names must be unique.')
+        added = []
+        for name in names:
+            p = {
+                'id': next(self._ids),
+                'tournament_id': t.id,
+                'name': name,
+                'seed': len(t.participants) + 1,
+                'challonge_username': None,
+                'created_at': _now(),
+            }
+            t.participants[p['id']] = p
+            added.append({'participant': p})
+        return added
+
+    def _auto_report(self, t: FakeTournament):
+        if self.auto_report_in_secs is None:
+            return
+        now = time.monotonic()
+        for m in t.open_matches():
+            if now - m.opened_at >= self.auto_report_in_secs:
+                winner = self._rng.choice(m.players)
+                t.report(m.id, '2-1' if winner == m.players[0] else '1-2', winner)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    auto_report = os.environ.get('FAKE_CHALLONGE_AUTO_REPORT_IN_SECS')
+    requests_per_sec = os.environ.get('FAKE_CHALLONGE_REQUESTS_PER_SEC')
+    fake = FakeChallonge(port,
+                         latency_in_secs=float(os.environ.get('FAKE_CHALLONGE_LATENCY_IN_SECS', 0)),
+                         error_rate=float(os.environ.get('FAKE_CHALLONGE_ERROR_RATE', 0)),
+                         requests_per_sec=float(requests_per_sec) if requests_per_sec else None,
+                         auto_report_in_secs=float(auto_report) if auto_report else None,
+                         webhook_url=os.environ.get('FAKE_CHALLONGE_WEBHOOK_URL'),
+                         webhook_secret=os.environ.get('FAKE_CHALLONGE_WEBHOOK_SECRET'))
+    print(f'Serving a fake challonge API. Run the bot with CHALLONGE_API={fake.url}')
+    fake.start()
+    try:
+        fake._thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,69 @@
 #!/usr/bin/env python3
 import asyncio
+import functools
+import io
 import logging
 import os
 import sys
+import time
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Tuple, List, Set
+from typing import Tuple, List, Set, Optional, Dict
 
 import discord
 from discord.ext import commands
 
+import announcements
 import bracket as challonge_bracket
+import challonge
+import data
+import metrics
+import polling
+import profiling
+import registration
+import registry
+import timers
 import util
+import webhooks
 
 DISCORD_TOKEN_VAR = 'DISCORD_BOT_TOKEN'
 CHALLONGE_TOKEN_VAR = 'CHALLONGE_TOKEN'
 
 PREFIX = '!'
-CHALLONGE_POLLING_INTERVAL_IN_SECS = 10
 BACKUP_FILE = 'in_progress_tournaments.txt'
 DEFAULT_WARN_TIMER_IN_MINS = 5
 DEFAULT_DQ_TIMER_IN_MINS = 10
 DEFAULT_CHECK_IN_EMOJI = discord.PartialEmoji(name="👍")
+# The least amount of time to leave challonge alone for when it is having trouble.
+CHALLONGE_DOWN_PAUSE_IN_SECS = 30
+# How long the profile command profiles for, unless told otherwise, and at most.
+DEFAULT_PROFILE_SECS = 30
+MAX_PROFILE_SECS = 300
+PROFILE_CPU = 'cpu'
+PROFILE_MEMORY = 'memory'
+PROFILE_BOTH = 'both'
+# How often to update the progress message while adding players.
+REGISTRATION_PROGRESS_INTERVAL_IN_SECS = 2
+
+# Metrics are served at http://localhost:METRICS_PORT/metrics. Set it to 0 to turn them off.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+# Webhook notifications are received at http://localhost:WEBHOOK_PORT/webhook, signed with the secret in
+# WEBHOOK_SECRET_VAR. Set it to 0 (the default) to rely on polling alone.
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 0))
+WEBHOOK_SECRET_VAR = 'WEBHOOK_SECRET'
+
+TOURNAMENTS = metrics.Gauge('tournaments', 'Tournaments being run, as of the last poll.')
+OPEN_MATCHES = metrics.Gauge('open_matches', 'Matches that were open as of the last poll, across every tournament.')
+PENDING_DEADLINES = metrics.Gauge('pending_deadlines',
+                                  'Warnings and DQs waiting for their deadline, as of the last poll.', ['kind'])
 
 CREATE_COMMAND = 'create'
 PAIR_USERNAME_COMMAND = 'pair-challonge-account'
 ADD_PLAYER_COMMAND = 'add-player'
 GET_BRACKET_COMMAND = 'bracket'
+PROFILE_COMMAND = 'profile'
+REGISTER_COMMAND = 'register'
+START_COMMAND = 'start'
 
 
 def _save_state(tourney_id, channel_id):
@@ -92,6 +129,48 @@ class Options:
     warn_timer_in_minutes: float = DEFAULT_WARN_TIMER_IN_MINS
     dq_timer_in_minutes: float = DEFAULT_DQ_TIMER_IN_MINS
     check_in_emoji: discord.PartialEmoji = DEFAULT_CHECK_IN_EMOJI
+    # Whether we can be told when matches change (see webhooks.py). Tournaments we're actually being told about
+    # only need to be polled once in a while, in case we miss something.
+    push_notifications: bool = False
+
+
+class ActiveTournament:
+    """
+    A tournament being run in a particular channel, along with the discord
+    bits needed to run it.
+    """
+
+    def __init__(self, b: challonge_bracket.AsyncBracket, announce_channel: discord.abc.Messageable,
+                 poller: polling.AdaptivePoller = None):
+        self.bracket = b
+        self.announce_channel = announce_channel
+        self.announcements = announcements.AnnouncementQueue(announce_channel)
+        self.poller = poller if poller is not None else polling.AdaptivePoller()
+        # Matches that were open as of the last poll, by challonge ID.
+        self.open_matches: Dict[str, data.Match] = {}
+        # Open matches that have been called, by the ID of their call message and the discord ID of each player.
+        # Several matches can be called in the same message, but each player is only ever in one open match.
+        self.called_matches: Dict[Tuple[int, int], data.Match] = {}
+        # Open matches that haven't been called yet, by challonge ID.
+        self.uncalled_matches: Dict[str, data.Match] = {}
+        self.polled = False
+        # When to try challonge again if it's having trouble with this tournament, in time.monotonic() time.
+        self.challonge_retry_at = 0.0
+
+    def seconds_until_challonge_retry(self) -> float:
+        return max(0.0, self.challonge_retry_at - time.monotonic())
+
+    @property
+    def guild_id(self) -> Optional[int]:
+        guild = getattr(self.announce_channel, 'guild', None)
+        return guild.id if guild is not None else None
+
+    @property
+    def channel_id(self) -> int:
+        return self.announce_channel.id
+
+    def __str__(self):
+        return f'{self.bracket.tourney_id} ({self.bracket.link})'
 
 
 class Tournament(commands.Cog):
@@ -99,38 +178,154 @@ class Tournament(commands.Cog):
                  announce_channel_override: discord.abc.Messageable = None,
                  options: Options = Options()):  # override is for testing.
         self._bot = bot
-        self._bracket = b
-        self._announce_channel_id = announce_channel_id
-        self._announce_channel = announce_channel_override
         self._check_in_emoji = options.check_in_emoji
         self._warn_time_in_mins = options.warn_timer_in_minutes
         self._dq_time_in_mins = options.dq_timer_in_minutes
+        self._push_notifications = options.push_notifications
+
+        self._tournaments = registry.Registry()
+        # Don't poll tournaments while challonge is having trouble with them.
+        self._scheduler = registry.PollScheduler(self._tournaments, self._check_tournament,
+                                                 lambda t: max(t.poller.interval, t.seconds_until_challonge_retry()),
+                                                 after_polls=self._publish_metrics)
+        self._polling_task = None
+        self._deadlines = timers.DeadlineHeap()
+        self._deadlines_changed = asyncio.Event()
+        self._deadline_task = None
+        # Brackets to resume once we are connected, with the ID of the channel they announce to.
+        self._to_resume = []
+        # The event loop we run on, once we're connected. Webhook notifications are handed to it.
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._profiling = False
 
-        self._players_by_discord_id = None
         if b is not None:
-            self._players_by_discord_id = {p.discord_id: p for p in b.players}
+            self.resume(b, announce_channel_id, announce_channel_override)
 
         self._bot.add_listener(self.on_ready, 'on_ready')
+        self._bot.add_listener(self.on_raw_reaction_add, 'on_raw_reaction_add')
+        self._bot.add_listener(self.on_raw_reaction_remove, 'on_raw_reaction_remove')
+
+    def resume(self, b: challonge_bracket.Bracket, announce_channel_id: int,
+               announce_channel_override: discord.abc.Messageable = None):
+        """
+        Resumes running the given bracket.
+
+        If no announce channel is injected (probably for testing), the channel
+        is fetched and the bracket is resumed once the bot has connected.
+        """
+        if announce_channel_override is None:
+            self._to_resume.append((b, announce_channel_id))
+            return
+        self._register(self._new_tournament(challonge_bracket.AsyncBracket(b), announce_channel_override))
+
+    def cog_unload(self):
+        """Stops checking on tournaments, and closes their brackets."""
+        for task in (self._polling_task, self._deadline_task):
+            if task is not None:
+                task.cancel()
+        self._polling_task = None
+        self._deadline_task = None
+        for t in self._tournaments:
+            t.bracket.bracket.close()
 
     async def on_ready(self):
-        # Fetch announce channel, unless one was injected (probably for testing.)
-        # If announce channel id isn't set, we clearly don't have a channel to
-        # announce to yet, and that's ok.
-        if self._announce_channel is None and self._announce_channel_id:
-            await self._configure_announce_channel(self._announce_channel_id)
+        self._loop = asyncio.get_running_loop()
+        for b, channel_id in self._to_resume:
+            logging.info(f'Resuming bracket with ID {b.tourney_id}: {b.link}')
+            channel = await self._fetch_announce_channel(channel_id)
+            self._register(self._new_tournament(challonge_bracket.AsyncBracket(b), channel))
+        self._to_resume = []
+
+        # Monitor brackets for changes.
+        self._ensure_polling()
+
+        logging.info(f'Logged in and ready. Running {len(self._tournaments)} tournament(s).')
+
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        await self._update_checkin(payload, checked_in=True)
 
-        # Monitor bracket for changes.
-        if self._bracket is not None:
-            logging.info(f'Resuming bracket with ID {self._bracket.tourney_id}: {self._bracket.link}')
-            asyncio.create_task(self._monitor_matches())
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        await self._update_checkin(payload, checked_in=False)
 
-        logging.info('Logged in and ready')
+    async def _update_checkin(self, payload: discord.RawReactionActionEvent, checked_in: bool):
+        """
+        Keeps track of who has checked in to each called match as reactions come in,
+        so deciding who to warn or DQ doesn't have to ask discord.
+        """
+        if _get_emoji_id(payload.emoji) != _get_emoji_id(self._check_in_emoji):
+            return
+        if (t := self._tournaments.get(payload.guild_id, payload.channel_id)) is None:
+            return
+        if (match := t.called_matches.get((payload.message_id, payload.user_id))) is None:
+            return
+        if checked_in == (payload.user_id in match.checked_in_ids):
+            return
 
-    async def _configure_announce_channel(self, channel_id: int):
-        self._announce_channel_id = channel_id
-        self._announce_channel = await self._bot.fetch_channel(self._announce_channel_id)
-        logging.info(f'Using channel {self._announce_channel_id} "{self._announce_channel.name}" in'
-                     f'"{self._announce_channel.guild.name}" to call matches and warn players of DQs.')
+        if checked_in:
+            match.checked_in_ids = data.check_ins(match.checked_in_ids | {payload.user_id})
+        else:
+            match.checked_in_ids = data.check_ins(match.checked_in_ids - {payload.user_id})
+        await t.bracket.save_metadata(match)
+        logging.info(f'Player {payload.user_id} {"checked in to" if checked_in else "checked out of"} '
+                     f'match {match.challonge_id}.')
+
+    def notify(self, n: webhooks.Notification):
+        """Checks the tournament a webhook notification is about right away, rather than waiting to poll it."""
+        if (t := self._tournaments.get_by_tourney_id(n.tourney_id)) is None:
+            return
+        logging.info(f'Told that match {n.match_id} in tournament {t} is now {n.state}.')
+        if self._push_notifications:
+            t.poller.record_push()
+        self._scheduler.poke(t)
+
+    def notify_threadsafe(self, n: webhooks.Notification):
+        """Same as notify, but can be called from any thread."""
+        if self._loop is None:
+            # We'll poll every tournament once we're connected anyway.
+            return
+        self._loop.call_soon_threadsafe(self.notify, n)
+
+    def _new_tournament(self, b: challonge_bracket.AsyncBracket,
+                        announce_channel: discord.abc.Messageable) -> ActiveTournament:
+        return ActiveTournament(b, announce_channel, polling.PushAwarePoller() if self._push_notifications else None)
+
+    def _register(self, t: ActiveTournament):
+        self._tournaments.add(t.guild_id, t.channel_id, t.bracket.tourney_id, t)
+        self._scheduler.poke(t)
+
+    def _publish_metrics(self):
+        """
+        Updates the gauges about what we're running. The metrics server reads them from its own thread,
+        so they're set here, on the event loop, rather than counting structures the loop is changing.
+        """
+        TOURNAMENTS.set(len(self._tournaments))
+        OPEN_MATCHES.set(sum(len(t.open_matches) for t in self._tournaments))
+        for kind in timers.Deadline:
+            PENDING_DEADLINES.set(self._deadlines.pending(kind), kind=kind.name.lower())
+
+    def _ensure_polling(self):
+        if self._polling_task is None:
+            self._polling_task = asyncio.create_task(self._scheduler.run())
+        if self._deadline_task is None:
+            self._deadline_task = asyncio.create_task(self._watch_deadlines())
+
+    async def _fetch_announce_channel(self, channel_id: int) -> discord.abc.Messageable:
+        with util.discord_call('fetch_channel'):
+            channel = await self._bot.fetch_channel(channel_id)
+        logging.info(f'Using channel {channel_id} "{channel.name}" in'
+                     f'"{channel.guild.name}" to call matches and warn players of DQs.')
+        return channel
+
+    async def _tournament_for(self, ctx: commands.Context) -> Optional[ActiveTournament]:
+        """
+        Returns the tournament being run in the channel the command was sent in.
+        Lets the sender know if there isn't one.
+        """
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        t = self._tournaments.get(guild_id, ctx.channel.id)
+        if t is None:
+            await ctx.send(f"Sorry, no bracket exists in this channel yet. Ask your TO to run the {CREATE_COMMAND} command!")
+        return t
 
     @commands.command(name=CREATE_COMMAND)
     async def create(self, ctx: commands.Context, reg_msg: WrappedMessage, tourney_name="Tournament"):
@@ -138,7 +333,8 @@ class Tournament(commands.Cog):
         Creates a bracket with every member that reacted to the specified message.
         Responds with a link to the new bracket.
 
-        Anyone can run this command if there isn't a tournament already in progress, so choose permissions wisely.
+        Anyone can run this command if there isn't a tournament already in progress in this channel,
+        so choose permissions wisely.
         The admin of the challonge bracket is the one specified when the bot is turned up.
         If you don't know what that means, it isn't you.
 
@@ -149,58 +345,140 @@ class Tournament(commands.Cog):
             tourney_name: The title of the tournament.
         """
 
-        if self._bracket is not None:
-            await ctx.send("A bracket has already been created, sorry!")
-            logging.info(f'Refusing to create new bracket, as bracket with id {self._bracket.tourney_id} '
-                         f'already exists: {self._bracket.link}')
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        if (existing := self._tournaments.get(guild_id, ctx.channel.id)) is not None:
+            await ctx.send("A bracket has already been created in this channel, sorry!")
+            logging.info(f'Refusing to create new bracket, as bracket with id {existing.bracket.tourney_id} '
+                         f'already exists in channel {ctx.channel.id}: {existing.bracket.link}')
             return
 
         # Collect all the users who reacted to the registration message.
-        names_by_discord_id = {}
-        for r in reg_msg.reactions:
-            async for u in r.users():
-                names_by_discord_id[u.id] = _format_name(u)
+        names_by_discord_id = await registration.collect_reactors(reg_msg.reactions, _format_name)
         logging.info(f'Creating a new bracket with {len(names_by_discord_id)} people.')
 
-        # Create a challonge bracket, and match challonge IDs to discord IDs.
-        await self._configure_announce_channel(ctx.channel.id)
-        self._bracket = challonge_bracket.create(challonge_auth, tourney_name, ctx.author.id)
-        self._bracket.create_players(names_by_discord_id)
-        self._players_by_discord_id = {p.discord_id: p for p in self._bracket.players}
+        # Create a challonge bracket, and start running it right away,
+        # so that if adding the players fails part way, the rest can be added later.
+        b = await challonge_bracket.create_async(challonge_auth, tourney_name, ctx.author.id)
+        t = self._new_tournament(b, ctx.channel)
+        self._register(t)
+        _save_state(b.tourney_id, t.channel_id)
+        self._ensure_polling()
+        logging.info(f'Successfully created bracket with ID {b.tourney_id}: {b.link}')
 
-        _save_state(self._bracket.tourney_id, self._announce_channel_id)
-        asyncio.create_task(self._monitor_matches())
+        if not await self._add_registrants(ctx, t, names_by_discord_id):
+            return
 
         # Ping the players letting them know the bracket was created.
-        message = ""
-        for player_id in self._players_by_discord_id.keys():
-            message += f"<@!{player_id}> "
-        message += f"\nBracket has been created! View it here: {self._bracket.link}" \
-                   "\n\n If you have a challonge account, you can pair it using the command" \
-                   f"\n`{self._bot.command_prefix}{PAIR_USERNAME_COMMAND} your-challonge-username`"
+        # There may be too many of them for one message, so let the announcement queue split them up.
+        for player_id in names_by_discord_id.keys():
+            t.announcements.post(f"<@!{player_id}>", announcements.Priority.CALL)
+        t.announcements.post(f"Bracket has been created! View it here: {b.link}"
+                             "\n\n If you have a challonge account, you can pair it using the command"
+                             f"\n`{self._bot.command_prefix}{PAIR_USERNAME_COMMAND} your-challonge-username`",
+                             announcements.Priority.CALL)
+        await t.announcements.flush()
+
+    @commands.command(name=REGISTER_COMMAND)
+    async def register(self, ctx: commands.Context, reg_msg: WrappedMessage):
+        """
+        Adds everyone who reacted to the specified message and isn't in the bracket yet.
 
-        logging.info(f'Successfully created bracket with ID {self._bracket.tourney_id}: {self._bracket.link}')
-        await ctx.send(message)
+        Use this to finish adding players if creating the bracket failed part way,
+        or to add late signups. Only the person who created the bracket can run this command.
+
+        Args:
+            reg_msg: The message to check for reactions, in the same format as for the create command.
+        """
+        if (t := await self._tournament_for(ctx)) is None:
+            return
+        if not t.bracket.is_admin(ctx.author.id):
+            await ctx.send("Sorry, you are not the person that created this tournament. "
+                           "Ask them _nicely_ if they can still add people.")
+            logging.info(f'Unauthorized member {ctx.author.id} "{ctx.author.name}" attempted to register players.')
+            return
+        names_by_discord_id = await registration.collect_reactors(reg_msg.reactions, _format_name)
+        if await self._add_registrants(ctx, t, names_by_discord_id):
+            await ctx.send("Everyone who signed up is in the bracket!")
+
+    async def _add_registrants(self, ctx: commands.Context, t: ActiveTournament, names_by_discord_id) -> bool:
+        """
+        Adds the given players to the bracket, keeping the channel posted on how it's going.
+        Returns false if challonge failed to add some of them.
+        """
+        progress = await ctx.send(f"Adding {len(names_by_discord_id)} players to the bracket...")
+        last_update = time.monotonic()
+
+        async def update_progress(done: int, total: int):
+            nonlocal last_update
+            if done < total and time.monotonic() - last_update < REGISTRATION_PROGRESS_INTERVAL_IN_SECS:
+                return
+            last_update = time.monotonic()
+            try:
+                with util.discord_call('edit_message'):
+                    await progress.edit(content=f"Added {done}/{total} players to the bracket.")
+            except discord.HTTPException:
+                logging.exception('Unable to update registration progress.')
+
+        try:
+            added = await registration.add_players(t.bracket, names_by_discord_id, update_progress)
+        except challonge.ChallongeError as e:
+            logging.exception(f'Failed to add every player to bracket {t.bracket.tourney_id}.')
+            await ctx.send(f"Challonge had trouble adding everyone to the bracket ({e}). "
+                           f"Run `{self._bot.command_prefix}{REGISTER_COMMAND}` with the same message "
+                           f"to add the rest.")
+            return False
+        logging.info(f'Added {len(added)} players to bracket {t.bracket.tourney_id}.')
+        return True
+
+    @commands.command(name=START_COMMAND)
+    async def start(self, ctx: commands.Context, *, tournament_type: str = challonge.TourneyType.DOUBLE_ELIM.value):
+        """
+        Starts the bracket, and plays it out here instead of waiting on challonge.
+
+        Matches are called as soon as the matches before them are decided, and challonge is
+        kept up to date in the background, so the event keeps going while challonge is slow or down.
+        Run this once everyone is in the bracket. Only the person who created the bracket can run this command.
+
+        Args:
+            tournament_type: single elimination, double elimination or round robin.
+        """
+        if (t := await self._tournament_for(ctx)) is None:
+            return
+        if not t.bracket.is_admin(ctx.author.id):
+            await ctx.send("Sorry, you are not the person that created this tournament. Ask them to start it.")
+            logging.info(f'Unauthorized member {ctx.author.id} "{ctx.author.name}" attempted to start the bracket.')
+            return
+        try:
+            await t.bracket.start_locally(challonge.TourneyType(tournament_type.lower()))
+        except ValueError as e:
+            await ctx.send(f"Unable to start the bracket: {e}")
+            return
+        logging.info(f'Playing out bracket {t.bracket.tourney_id} locally.')
+        t.poller.tighten()
+        self._scheduler.poke(t)
+        await ctx.send("The bracket has started! Matches will be called here.")
 
     @commands.command(name=ADD_PLAYER_COMMAND)
     async def add_player(self, ctx: commands.Context, player: discord.Member):
         """
-        Adds the given player to the ongoing tournament.
+        Adds the given player to the tournament running in this channel.
 
         Only the person who created the bracket can run this command.
 
         args:
             player: The player to add.
         """
-        if not self._bracket.is_admin(ctx.author.id):
+        if (t := await self._tournament_for(ctx)) is None:
+            return
+        if not t.bracket.is_admin(ctx.author.id):
             await ctx.send("Sorry, you are not the person that created this tournament. "
                            "Ask them _nicely_ if they can still add people.")
             logging.info(f'Unauthorized member {ctx.author.id} "{ctx.author.name}" '
                          f'attempted to add member {player.id} "{player.name}"')
             return
-        logging.info(f'Adding member {player.id} "{player.name}" to bracket.')
-        self._bracket.create_players({player.id: _format_name(player)})
-        logging.info(f'Successfully added member {player.id} "{player.name}" to bracket.')
+        logging.info(f'Adding member {player.id} "{player.name}" to bracket {t.bracket.tourney_id}.')
+        await t.bracket.create_players({player.id: _format_name(player)})
+        logging.info(f'Successfully added member {player.id} "{player.name}" to bracket {t.bracket.tourney_id}.')
         await ctx.send("Player added successfully!")
 
     @commands.command(name=PAIR_USERNAME_COMMAND)
@@ -212,119 +490,392 @@ class Tournament(commands.Cog):
         After running this command, that user should get a notification in challonge to accept being added.
         Any player can run this command, as it only affects the caller.
         """
-        if ctx.author.id not in self._players_by_discord_id.keys():
+        if (t := await self._tournament_for(ctx)) is None:
+            return
+        if (player := t.bracket.player_by_discord_id(ctx.author.id)) is None:
             await ctx.send("Unfortunately you are not in the tournament."
                            " Contact your TO and ask nicely, maybe they can fix it.")
             logging.info(f'Refusing to update challonge username for player {ctx.author.id} "{ctx.author.name}". '
                          f'They are not in the tournament.')
             return
         logging.info(f'Associating player {ctx.author.id} "{ctx.author.name}" with challonge username "{username}".')
-        self._bracket.update_username(self._players_by_discord_id[ctx.author.id], username)
+        await t.bracket.update_username(player, username)
         logging.info(f'Successfully associated player {ctx.author.id} "{ctx.author.name}" with challonge username "{username}".')
         await ctx.send("Update Successful! Log into challonge, you should have received an invitation.")
 
     @commands.command(name=GET_BRACKET_COMMAND)
     async def get_bracket_link(self, ctx):
-        """Returns a link to the current tournament."""
+        """Returns a link to the tournament running in this channel."""
         logging.info(f'Got request for bracket from member {ctx.author.id} "{ctx.author.name}".')
-        if self._bracket is None:
-            await ctx.send(f"Sorry, no bracket exists yet. Ask your TO to run the {CREATE_COMMAND} command!")
-        else:
-            await ctx.send(self._bracket.link)
+        if (t := await self._tournament_for(ctx)) is not None:
+            await ctx.send(t.bracket.link)
 
     @commands.command(name='link')
     async def get_bracket_link_alt_def(self, ctx):
         """
-        Returns a link to the current tournament.
+        Returns a link to the tournament running in this channel.
 
         This exists because the devs couldn't figure out whether !link or !bracket was better.
         """
         await self.get_bracket_link(ctx)
 
+    @commands.command(name=PROFILE_COMMAND)
+    async def profile(self, ctx: commands.Context, seconds: float = DEFAULT_PROFILE_SECS, what: str = PROFILE_CPU):
+        """
+        Profiles the bot while it keeps running, and responds with the results as attachments.
+
+        Only the person who created the bracket can run this command.
+
+        Args:
+            seconds: How long to profile for, up to MAX_PROFILE_SECS.
+            what: "cpu" for sampled stacks of every thread (collapsed, for flame graphs),
+                "memory" for the lines that allocated the most, or "both".
+        """
+        if (t := await self._tournament_for(ctx)) is None:
+            return
+        if not t.bracket.is_admin(ctx.author.id):
+            await ctx.send("Sorry, only the person that created this tournament can profile the bot.")
+            logging.info(f'Unauthorized member {ctx.author.id} "{ctx.author.name}" attempted to profile the bot.')
+            return
+        if what not in (PROFILE_CPU, PROFILE_MEMORY, PROFILE_BOTH):
+            await ctx.send(f'Not sure how to profile "{what}". '
+                           f'Try "{PROFILE_CPU}", "{PROFILE_MEMORY}" or "{PROFILE_BOTH}".')
+            return
+        if self._profiling:
+            await ctx.send("Already profiling, try again once that's done.")
+            return
+
+        # Claimed before anything else is awaited, so that a second command can't start profiling too.
+        self._profiling = True
+        try:
+            seconds = min(max(seconds, 1), MAX_PROFILE_SECS)
+            logging.info(f'Member {ctx.author.id} "{ctx.author.name}" started profiling {what} for {seconds} seconds.')
+            await ctx.send(f"Profiling {what} for {seconds:g} seconds.")
+            # Both run on other threads, so tournaments keep being monitored in the meantime.
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            jobs = {}
+            if what in (PROFILE_CPU, PROFILE_BOTH):
+                jobs[f'stacks-{stamp}.txt'] = asyncio.to_thread(
+                    lambda: profiling.collapse(profiling.sample_stacks(seconds)))
+            if what in (PROFILE_MEMORY, PROFILE_BOTH):
+                jobs[f'allocations-{stamp}.txt'] = asyncio.to_thread(profiling.allocation_diff, seconds)
+            results = await asyncio.gather(*jobs.values())
+        finally:
+            self._profiling = False
+
+        files = [discord.File(io.BytesIO(r.encode()), filename=name) for name, r in zip(jobs, results)]
+        await ctx.send("Done profiling!", files=files)
+
     async def check_matches(self):
-        for match in self._bracket.fetch_open_matches():
-            # Call any matches that haven't been called yet.
-            if match.call_time is None:
-                logging.info(f'Noticed new match with challonge ID {match.challonge_id} '
-                             f'between players {match.p1.discord_id} (P1) and {match.p2.discord_id} (P2).')
+        """
+        Checks every running tournament for matches to call,
+        then warns or DQs players in any match whose deadline has passed.
+        """
+        await self._scheduler.poll_all()
+        await self._fire_due_deadlines()
 
-                # Tell players before updating state - in the event of a crash,
-                # better they get pinged twice than someone gets DQ'd without being told about it.
-                call_message = await self._announce_channel.send(
-                    f"<@!{match.p1.discord_id}> <@!{match.p2.discord_id}> your match has been called!"
-                    f" React with {self._check_in_emoji} in the next {self._dq_time_in_mins} minutes to check in!")
+    async def _check_tournament(self, t: ActiveTournament):
+        if t.seconds_until_challonge_retry() > 0:
+            return
+        try:
+            diff = await t.bracket.poll_open_matches()
+        except challonge.ChallongeUnavailable as e:
+            self._pause_for_challonge(t, e)
+            return
+        t.poller.record_poll(t.bracket.last_poll_changed, t.bracket.last_poll_not_modified)
+        await self._apply_diff(t, diff)
+        await self._call_matches(t)
+
+    async def _apply_diff(self, t: ActiveTournament, diff: data.OpenMatchDiff):
+        """Brings what we know about the given tournament's open matches up to date."""
+        # Matches that were finished (or reset) can't be warned or DQ'd anymore.
+        for match in diff.closed:
+            t.open_matches.pop(match.challonge_id, None)
+            t.uncalled_matches.pop(match.challonge_id, None)
+            self._unindex_call(t, match)
+            self._deadlines.cancel(t.bracket.tourney_id, match.challonge_id)
+
+        # On our first poll, every open match is new to us, even if the bracket had been polled before.
+        opened = diff.opened
+        if not t.polled:
+            opened = diff.opened + diff.unchanged
+            t.polled = True
+
+        # Matches that were called before we resumed pick their deadlines back up.
+        called = []
+        for match in opened:
+            t.open_matches[match.challonge_id] = match
+            if match.call_time is None:
+                t.uncalled_matches[match.challonge_id] = match
+                continue
+            self._index_call(t, match)
+            called.append(match)
+        if called:
+            await self._reconcile_checkins(t, [m for m in called if m.dq_time is None])
+            for match in called:
+                self._schedule_deadlines(t, match)
+
+    async def _call_matches(self, t: ActiveTournament):
+        """Calls any open matches in the given tournament that haven't been called yet."""
+        calls = []
+        for match in t.uncalled_matches.values():
+            logging.info(f'Noticed new match with challonge ID {match.challonge_id} '
+                         f'between players {match.p1.discord_id} (P1) and {match.p2.discord_id} (P2).')
+            calls.append((match, t.announcements.post(
+                f"<@!{match.p1.discord_id}> <@!{match.p2.discord_id}> your match has been called!"
+                f" React with {self._check_in_emoji} in the next {self._dq_time_in_mins} minutes to check in!",
+                announcements.Priority.CALL, functools.partial(self._mark_called, t, match))))
+        if not calls:
+            return
 
-                match.call_message_id = call_message.id
-                match.call_time = datetime.now()
-                self._bracket.save_metadata(match)
+        # Tell players before updating state - in the event of a crash,
+        # better they get pinged twice than someone gets DQ'd without being told about it.
+        await t.announcements.flush()
 
-                # Pre-react to the message with the check-in emoji to make it easier for the players.
-                # We do this after updating the metadata in case it fails for some reason.
-                await call_message.add_reaction(self._check_in_emoji)
-                logging.info(f'Match {match.challonge_id} has been called. Call message ID: {match.call_message_id}')
+        call_messages = {}
+        newly_called = []
+        for match, call in calls:
+            if call.message is None:
+                # We'll try calling it again next poll.
                 continue
+            newly_called.append(match)
+            call_messages[call.message.id] = call.message
+            logging.info(f'Match {match.challonge_id} has been called. Call message ID: {match.call_message_id}')
+        if newly_called:
+            await t.bracket.save_all_metadata(newly_called)
+        for match in newly_called:
+            self._schedule_deadlines(t, match)
+
+        # Players often report quickly after a call (especially when someone doesn't show),
+        # so check back soon.
+        t.poller.tighten()
+
+        # Pre-react to the messages with the check-in emoji to make it easier for the players.
+        # We do this after updating the metadata in case it fails for some reason.
+        for call_message in call_messages.values():
+            with util.discord_call('add_reaction'):
+                await call_message.add_reaction(self._check_in_emoji)
+
+    def _mark_called(self, t: ActiveTournament, match: data.Match, message: discord.Message):
+        """
+        Records that the given match was called in the given message, as soon as it's sent.
+        Check-ins to it count from then on, even while the rest of the calls are still going out.
+        """
+        match.call_message_id = message.id
+        match.call_time = datetime.now()
+        t.uncalled_matches.pop(match.challonge_id, None)
+        self._index_call(t, match)
+
+    @staticmethod
+    def _index_call(t: ActiveTournament, match: data.Match):
+        t.called_matches[(match.call_message_id, match.p1.discord_id)] = match
+        t.called_matches[(match.call_message_id, match.p2.discord_id)] = match
+
+    @staticmethod
+    def _unindex_call(t: ActiveTournament, match: data.Match):
+        t.called_matches.pop((match.call_message_id, match.p1.discord_id), None)
+        t.called_matches.pop((match.call_message_id, match.p2.discord_id), None)
+
+    def _schedule_deadlines(self, t: ActiveTournament, match: data.Match):
+        tourney_id = t.bracket.tourney_id
+        if match.warn_time is None:
+            self._deadlines.schedule(tourney_id, match.challonge_id, timers.Deadline.WARN,
+                                     match.call_time + timedelta(minutes=self._warn_time_in_mins))
+        if match.dq_time is None:
+            self._deadlines.schedule(tourney_id, match.challonge_id, timers.Deadline.DQ,
+                                     match.call_time + timedelta(minutes=self._dq_time_in_mins))
+        self._deadlines_changed.set()
+
+    async def _watch_deadlines(self):
+        """
+        Warns and DQs players as their deadlines pass, indefinitely.
 
-            # Warn players that haven't checked in.
-            if (overdue_mins := _minutes_in(datetime.now() - match.call_time)) >= self._warn_time_in_mins and match.warn_time is None:
-                logging.info(f'It has been {overdue_mins} minutes since match {match.challonge_id} was called.')
-                checked_in_ids = await self._get_checkins(match.call_message_id)
-
-                # Ping players that didn't check-in to this match.
-                if match.p1.discord_id not in checked_in_ids:
-                    warn_msg = await self._announce_channel.send(self._warn_msg(match.p1.discord_id))
-                    logging.info(f'Player 1 ({match.p1.discord_id}) has not checked in for match {match.challonge_id}. '
-                                 f'Warned them via discord in message with ID: {warn_msg.id}')
-                if match.p2.discord_id not in checked_in_ids:
-                    warn_msg = await self._announce_channel.send(self._warn_msg(match.p2.discord_id))
-                    logging.info(f'Player 2 ({match.p2.discord_id}) has not checked in for match {match.challonge_id}. '
-                                 f'Warned them via discord in message with ID: {warn_msg.id}')
-
-                # Mark this match as warned, so we don't ping them again.
-                match.warn_time = datetime.now()
-                self._bracket.save_metadata(match)
+        Sleeps until the earliest deadline, or until a new one is scheduled.
+        """
+        while True:
+            self._deadlines_changed.clear()
+            timeout = None
+            if (next_deadline := self._deadlines.next_deadline()) is not None:
+                timeout = max(0.0, (next_deadline - datetime.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._deadlines_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._fire_due_deadlines()
+            except Exception:
+                # Keep watching, so one bad deadline doesn't stop everyone else's warnings and DQs.
+                logging.exception('Failed to process due deadlines.')
+
+    async def _fire_due_deadlines(self):
+        # Warnings and DQs that fall due together are announced together, once they've all been processed.
+        to_flush = set()
+        # DQs are submitted to challonge together, per tournament.
+        due_dqs: Dict[ActiveTournament, List[data.Match]] = {}
+        for tourney_id, match_id, kind in self._deadlines.pop_due(datetime.now()):
+            t = self._tournaments.get_by_tourney_id(tourney_id)
+            match = t.open_matches.get(match_id) if t is not None else None
+            if match is None:
                 continue
+            to_flush.add(t)
+            try:
+                if kind == timers.Deadline.WARN and match.warn_time is None:
+                    await self._warn(t, match)
+                elif kind == timers.Deadline.DQ and match.dq_time is None:
+                    if t.seconds_until_challonge_retry() > 0:
+                        # Nobody gets DQ'd while we can't tell challonge about it.
+                        self._postpone_dq(t, match)
+                    else:
+                        due_dqs.setdefault(t, []).append(match)
+            except Exception:
+                logging.exception(f'Failed to process {kind.name} deadline for match {match_id} '
+                                  f'in tournament {tourney_id}.')
+        await asyncio.gather(*[self._dq_all(t, matches) for t, matches in due_dqs.items()])
+        await asyncio.gather(*[t.announcements.flush() for t in to_flush])
+
+    async def _warn(self, t: ActiveTournament, match: data.Match):
+        """Warns players that haven't checked in."""
+        logging.info(f'It has been {_minutes_in(datetime.now() - match.call_time)} minutes '
+                     f'since match {match.challonge_id} was called.')
+        checked_in_ids = match.checked_in_ids
+
+        # Ping players that didn't check-in to this match.
+        if match.p1.discord_id not in checked_in_ids:
+            t.announcements.post(self._warn_msg(match.p1.discord_id), announcements.Priority.WARN)
+            logging.info(f'Player 1 ({match.p1.discord_id}) has not checked in for match {match.challonge_id}. '
+                         f'Queued a warning for them.')
+        if match.p2.discord_id not in checked_in_ids:
+            t.announcements.post(self._warn_msg(match.p2.discord_id), announcements.Priority.WARN)
+            logging.info(f'Player 2 ({match.p2.discord_id}) has not checked in for match {match.challonge_id}. '
+                         f'Queued a warning for them.')
+
+        # Mark this match as warned, so we don't ping them again.
+        match.warn_time = datetime.now()
+        await t.bracket.save_metadata(match)
+
+    async def _dq_all(self, t: ActiveTournament, matches: List[data.Match]):
+        """
+        DQs players that took too long to check in to any of the given matches.
 
-            # DQ players if they took too long to check in.
-            if (overdue_mins := _minutes_in((datetime.now() - match.call_time))) > self._dq_time_in_mins and match.dq_time is None:
-                logging.info(f'It has been {overdue_mins} minutes since match {match.challonge_id} was called.')
+        Scores are submitted to challonge concurrently, and each match is
+        reconciled with how its own submission went.
+        """
+        try:
+            for match in matches:
+                logging.info(f'It has been {_minutes_in(datetime.now() - match.call_time)} minutes '
+                             f'since match {match.challonge_id} was called.')
                 # Make sure that if something fails (for example, interacting
                 # with challonge), we don't ping players multiple times.
                 match.dq_time = datetime.now()
-                self._bracket.save_metadata(match)
-
-                checked_in_ids = await self._get_checkins(match.call_message_id)
-                p1_checked_in = match.p1.discord_id in checked_in_ids
-                p2_checked_in = match.p2.discord_id in checked_in_ids
-
-                if p1_checked_in:
-                    if not p2_checked_in:
-                        # Only P2 gets DQ'd
-                        self._bracket.save_score(match, 0, -1)
-                        await self._announce_channel.send(self._dq_msg(match.p2.discord_id))
-                        logging.info(
-                            f'Player 2 ({match.p2.discord_id}) did not check in for match {match.challonge_id}. '
-                            f'They have been disqualified.')
+            await t.bracket.save_all_metadata(matches)
+
+            dqs = [(match, *dq) for match in matches if (dq := self._dq_outcome(match)) is not None]
+            if not dqs:
+                return
+
+            # Someone is about to get DQ'd, which will probably open up new matches.
+            t.poller.tighten()
+            self._scheduler.poke(t, t.poller.interval)
+
+            scores = [(match, *scores) for match, scores, _, _ in dqs]
+            results = await t.bracket.save_scores(scores)
+            postponed = []
+            for (match, _, announcement, outcome), error in zip(dqs, results):
+                if error is None:
+                    t.announcements.post(announcement, announcements.Priority.DQ)
+                    logging.info(outcome)
+                elif isinstance(error, challonge.ChallongeUnavailable):
+                    # Try again once challonge is back, rather than telling players they're DQ'd when they aren't.
+                    match.dq_time = None
+                    postponed.append(match)
+                    self._pause_for_challonge(t, error)
                 else:
-                    if p2_checked_in:
-                        # Only P1 gets DQ'd
-                        self._bracket.save_score(match, -1, 0)
-                        await self._announce_channel.send(self._dq_msg(match.p1.discord_id))
-                        logging.info(
-                            f'Player 1 ({match.p1.discord_id}) did not check in for match {match.challonge_id}. '
-                            f'They have been disqualified.')
-                    else:
-                        # If neither player checks in, only P2 gets DQ'd
-                        # TODO tomorrow: save score isn't working.
-                        # Also let's not ping them every 10 seconds if challonge has an issue.
-                        self._bracket.save_score(match, -1, -2)
-                        await self._announce_channel.send(f"Wow, neither player checked in. Unfortunately I can only DQ"
-                                                          f" one of you, so I'm DQing <@!{match.p2.discord_id}>."
-                                                          f" <@!{match.p1.discord_id}>, I'm watching you...")
-                        logging.info(f'Neither player checked in for match {match.challonge_id}. '
-                                     f'Player 1 ({match.p1.discord_id}) was disqualified.')
-
-    async def _get_checkins(self, mid: int) -> Set[int]:
-        message = await self._announce_channel.fetch_message(mid)
+                    logging.error(f'Failed to DQ players in match {match.challonge_id} in tournament {t}.',
+                                  exc_info=error)
+            if postponed:
+                await t.bracket.save_all_metadata(postponed)
+                for match in postponed:
+                    self._postpone_dq(t, match)
+
+            # Call whatever the DQs opened up right away, rather than waiting for the next poll to notice.
+            reported = [s for s, error in zip(scores, results) if error is None]
+            opened = await t.bracket.advance(reported)
+            await self._apply_diff(t, data.OpenMatchDiff(opened=opened, closed=[m for m, _, _ in reported],
+                                                         unchanged=[]))
+            if opened:
+                await self._call_matches(t)
+        except Exception:
+            logging.exception(f'Failed to process DQ deadlines for {len(matches)} matches in tournament {t}.')
+
+    def _dq_outcome(self, match: data.Match) -> Optional[Tuple[Tuple[int, int], str, str]]:
+        """
+        Works out who gets DQ'd from the given match, if anyone.
+        Returns the scores to report, what to tell the players and what to log, or None if both players checked in.
+        """
+        checked_in_ids = match.checked_in_ids
+        p1_checked_in = match.p1.discord_id in checked_in_ids
+        p2_checked_in = match.p2.discord_id in checked_in_ids
+        if p1_checked_in and p2_checked_in:
+            return None
+
+        if p1_checked_in:
+            # Only P2 gets DQ'd
+            return (0, -1), self._dq_msg(match.p2.discord_id), \
+                f'Player 2 ({match.p2.discord_id}) did not check in for match {match.challonge_id}. ' \
+                f'They have been disqualified.'
+        if p2_checked_in:
+            # Only P1 gets DQ'd
+            return (-1, 0), self._dq_msg(match.p1.discord_id), \
+                f'Player 1 ({match.p1.discord_id}) did not check in for match {match.challonge_id}. ' \
+                f'They have been disqualified.'
+        # If neither player checks in, only P2 gets DQ'd
+        # TODO tomorrow: save score isn't working.
+        return (-1, -2), \
+            f"Wow, neither player checked in. Unfortunately I can only DQ" \
+            f" one of you, so I'm DQing <@!{match.p2.discord_id}>." \
+            f" <@!{match.p1.discord_id}>, I'm watching you...", \
+            f'Neither player checked in for match {match.challonge_id}. ' \
+            f'Player 1 ({match.p1.discord_id}) was disqualified.'
+
+    def _pause_for_challonge(self, t: ActiveTournament, e: challonge.ChallongeUnavailable):
+        """Stops polling the given tournament, and DQing players in it, until challonge has had time to recover."""
+        pause_in_secs = max(e.retry_in_secs, CHALLONGE_DOWN_PAUSE_IN_SECS)
+        t.challonge_retry_at = time.monotonic() + pause_in_secs
+        logging.warning(f'Challonge is having trouble with tournament {t}. '
+                        f'Leaving it alone for {pause_in_secs:.0f} seconds. {e}')
+
+    def _postpone_dq(self, t: ActiveTournament, match: data.Match):
+        when = datetime.now() + timedelta(seconds=t.seconds_until_challonge_retry())
+        self._deadlines.schedule(t.bracket.tourney_id, match.challonge_id, timers.Deadline.DQ, when)
+        self._deadlines_changed.set()
+        logging.info(f'Postponed DQ for match {match.challonge_id} until {when}, since challonge is having trouble.')
+
+    async def _reconcile_checkins(self, t: ActiveTournament, matches: List[data.Match]):
+        """
+        Catches up on check-ins we missed while we weren't running, by asking discord directly.
+        Only needed once per match after resuming, since reactions are tracked as they come in after that.
+        """
+        # Matches called together share a call message, so only fetch each message once.
+        reacted_ids_by_message_id = {}
+        for match in matches:
+            mid = match.call_message_id
+            if mid not in reacted_ids_by_message_id:
+                try:
+                    reacted_ids_by_message_id[mid] = await self._fetch_checkins(t, mid)
+                except discord.HTTPException:
+                    logging.exception(f'Unable to fetch check-ins for call message {mid}. '
+                                      f'Keeping the ones we already knew about.')
+                    reacted_ids_by_message_id[mid] = None
+            if (reacted_ids := reacted_ids_by_message_id[mid]) is None:
+                continue
+            checked_in_ids = data.check_ins(i for i in reacted_ids if i in (match.p1.discord_id, match.p2.discord_id))
+            if checked_in_ids != match.checked_in_ids:
+                match.checked_in_ids = checked_in_ids
+                await t.bracket.save_metadata(match)
+
+    async def _fetch_checkins(self, t: ActiveTournament, mid: int) -> Set[int]:
+        with util.discord_call('fetch_message'):
+            message = await t.announce_channel.fetch_message(mid)
         for r in message.reactions:
             # Assuming r.emoji is a built-in emoji.
             # TODO support custom emojis as well as built-in emojis.
@@ -332,16 +883,6 @@ class Tournament(commands.Cog):
                 return await util.get_user_ids(r)
         return set()
 
-    async def _monitor_matches(self):
-        """
-        Poll for match updates indefinitely.
-
-        If a match is "called" notify the players in discord.
-        """
-        while True:
-            await self.check_matches()
-            await asyncio.sleep(CHALLONGE_POLLING_INTERVAL_IN_SECS)
-
     def _warn_msg(self, player_challonge_id: str) -> str:
         return f"<@!{player_challonge_id}> it has been at least {self._warn_time_in_mins} minutes since your match " \
                f"was called. Please check in in the next {self._dq_time_in_mins - self._warn_time_in_mins} minutes or " \
@@ -374,20 +915,25 @@ if __name__ == '__main__':
                 CHALLONGE_TOKEN_VAR))
     challonge_auth = os.environ[CHALLONGE_TOKEN_VAR]
 
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    if WEBHOOK_PORT and WEBHOOK_SECRET_VAR not in os.environ:
+        sys.exit(f"{WEBHOOK_SECRET_VAR} not found in system environment. "
+                 f"It's needed to check that webhook notifications are genuine.")
+
     # Create bot instance.
     bot = commands.Bot(command_prefix=PREFIX)
 
-    # Resume the last interrupted tournament.
-    # For now, assume we only have one tournament running at any given time.
-    # Resume the last tournament.
-    # TODO support multiple tournaments.
-    in_progress_tournaments = _reload_state()
-    if len(in_progress_tournaments) > 0:
-        tourney_id, announce_channel_id = in_progress_tournaments[-1]
-        in_progress_bracket = challonge_bracket.resume(challonge_auth, tourney_id)
-        bot.add_cog(Tournament(bot, in_progress_bracket, announce_channel_id))
-    else:
-        bot.add_cog(Tournament(bot))
+    # Resume every interrupted tournament.
+    # A channel only runs one tournament at a time, so if a channel shows up
+    # more than once, the most recent tournament in it is the one in progress.
+    tourney_ids_by_channel_id = {channel_id: tourney_id for tourney_id, channel_id in _reload_state()}
+    cog = Tournament(bot, options=Options(push_notifications=bool(WEBHOOK_PORT)))
+    for announce_channel_id, tourney_id in tourney_ids_by_channel_id.items():
+        cog.resume(challonge_bracket.resume(challonge_auth, tourney_id), announce_channel_id)
+    bot.add_cog(cog)
+    if WEBHOOK_PORT:
+        webhooks.serve(webhooks.Receiver(os.environ[WEBHOOK_SECRET_VAR], cog.notify_threadsafe), WEBHOOK_PORT)
 
     # Connect to discord and start doing stuff.
     bot.run(discord_auth)
@@ -0,0 +1,63 @@
+"""
+Works out which matches a result opens up, without asking challonge.
+
+Challonge only tells us about a match once it's open, which we'd otherwise
+only find out about on the next poll. Since we know where the winner and
+loser of every match go next, we can call the next match as soon as a score
+is saved.
+"""
+import collections
+import dataclasses
+from typing import Dict, Iterable, List, Tuple
+
+import challonge
+
+
+class MatchGraph:
+    """Every match in a bracket, and which matches each one feeds players into."""
+
+    def __init__(self, matches: Iterable[challonge.BracketMatch]):
+        # Copies, since we fill in players as results come in.
+        self._matches: Dict[str, challonge.BracketMatch] = {m.id: dataclasses.replace(m) for m in matches}
+        # Where the players of each match go next, as (match ID, slot, whether it's the loser that goes there).
+        self._next: Dict[str, List[Tuple[str, int, bool]]] = collections.defaultdict(list)
+        for m in self._matches.values():
+            for slot, prereq_id, is_loser in ((0, m.p1_prereq_id, m.p1_is_prereq_loser),
+                                              (1, m.p2_prereq_id, m.p2_is_prereq_loser)):
+                if prereq_id is not None:
+                    self._next[prereq_id].append((m.id, slot, is_loser))
+
+    def open_matches(self) -> List[challonge.Match]:
+        return [challonge.Match(m.id, m.p1_id, m.p2_id) for m in self._matches.values() if m.state == 'open']
+
+    def is_decided(self, match_id: str) -> bool:
+        """Whether we know who won the given match (or know nothing about it, so can't do any better)."""
+        m = self._matches.get(match_id)
+        return m is None or m.state == 'complete'
+
+    def resolve(self, match_id: str, winner_id: str) -> List[challonge.Match]:
+        """
+        Records who won the given match, and moves both players on to their next matches.
+        Returns the matches that have both of their players as a result.
+        """
+        m = self._matches.get(match_id)
+        if m is None or m.state == 'complete':
+            return []
+        m.state = 'complete'
+        loser_id = m.p2_id if winner_id == m.p1_id else m.p1_id
+
+        opened = []
+        for next_id, slot, is_loser in self._next.get(match_id, ()):
+            n = self._matches.get(next_id)
+            # A grand final reset is fed by both players of the grand final, and is only played if
+            # the right one wins. That's up to challonge, so it's left to polling.
+            if n is None or n.state != 'pending' or n.p1_prereq_id == n.p2_prereq_id:
+                continue
+            if slot == 0:
+                n.p1_id = loser_id if is_loser else winner_id
+            else:
+                n.p2_id = loser_id if is_loser else winner_id
+            if n.p1_id is not None and n.p2_id is not None:
+                n.state = 'open'
+                opened.append(challonge.Match(n.id, n.p1_id, n.p2_id))
+        return opened
@@ -0,0 +1,211 @@
+"""
+Counters, gauges and latency histograms, served over HTTP in Prometheus' text format.
+
+Metrics are defined at module level by whatever they measure, and all end up
+in one registry, which serve() exposes at /metrics.
+"""
+import abc
+import contextlib
+import http.server
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Upper bounds of the latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[str, ...]
+
+_registry: List['Metric'] = []
+_registry_lock = threading.Lock()
+
+
+class Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if labels.keys() != set(self.label_names):
+            raise ValueError(f'{self.name} takes labels {self.label_names}, got {tuple(labels)}.')
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    @abc.abstractmethod
+    def _samples(self) -> Iterator[Tuple[str, LabelValues, Tuple[Tuple[str, str], ...], float]]:
+        """Yields (name suffix, label values, extra labels, value) for everything this metric has recorded."""
+        pass
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for suffix, values, extra, value in self._samples():
+            pairs = list(zip(self.label_names, values)) + list(extra)
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in pairs)
+            lines.append(f'{self.name}{suffix}{{{label_text}}} {_format(value)}' if pairs
+                         else f'{self.name}{suffix} {_format(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """Something that only goes up, like the number of requests sent."""
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(f'{name}_total', description, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            yield '', values, (), value
+
+
+class Gauge(Metric):
+    """
+    Something that goes up and down, like the number of open matches.
+
+    Either set it as things change, or give it a function to call whenever it is read.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, f: Callable[[], float], **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = f
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            f = self._functions.get(key)
+            value = self._values.get(key, 0)
+        return f() if f is not None else value
+
+    def _samples(self):
+        with self._lock:
+            items = dict(self._values)
+            functions = dict(self._functions)
+        for key, f in functions.items():
+            try:
+                items[key] = f()
+            except Exception:
+                logging.exception(f'Failed to read gauge {self.name}.')
+        for values, value in sorted(items.items()):
+            yield '', values, (), value
+
+
+class Histogram(Metric):
+    """How long things take (or how big they are), counted into buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self._bounds = tuple(sorted(buckets)) + (math.inf,)
+        # Per set of label values: (count in each bucket, sum of everything observed).
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self._bounds), 0.0)
+            for i, bound in enumerate(self._bounds):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the body of the with block takes, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, (list(counts), total)) for k, (counts, total) in self._values.items())
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self._bounds, counts):
+                cumulative += count
+                yield '_bucket', values, (('le', _format(bound)),), cumulative
+            yield '_sum', values, (), total
+            yield '_count', values, (), cumulative
+
+
+def render() -> str:
+    """Every metric, in Prometheus' text exposition format."""
+    with _registry_lock:
+        registered = list(_registry)
+    return '\n'.join(line for m in registered for line in m.render()) + '\n'
+
+
+def serve(port: int, host: str = '127.0.0.1') -> http.server.HTTPServer:
+    """Serves every metric at http://host:port/metrics, from a background thread."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Serving metrics at http://{host}:{server.server_port}/metrics')
+    return server
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
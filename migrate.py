@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Copies tournaments saved with the pickle storage backend into the sqlite one.
+
+Usage: ./migrate.py [tournament IDs...]
+Migrates every tournament in STATE_BACKUP_DIR if no IDs are given.
+Tournaments that are already in the sqlite database are skipped.
+"""
+import os
+import sys
+from typing import List
+
+import persistent
+
+
+def pickled_tournament_ids() -> List[str]:
+    ids = []
+    for name in sorted(os.listdir(persistent.STATE_BACKUP_DIR)):
+        path = os.path.join(persistent.STATE_BACKUP_DIR, name)
+        # Skip journals, half-written snapshots, the sqlite database and anything else that isn't a snapshot.
+        if not os.path.isfile(path) or '.' in name or name.startswith('.'):
+            continue
+        ids.append(name)
+    return ids
+
+
+def migrate(tournament_id: str) -> bool:
+    """
+    Copies the given tournament from the pickle backend into the sqlite backend.
+    Returns false if it was already there.
+    """
+    old = persistent.State(tournament_id, backend=persistent.PICKLE_BACKEND)
+    new = persistent.State(tournament_id, old.bracket_link, backend=persistent.SQLITE_BACKEND)
+    if new.admin_id is not None or new.players or new.known_matches:
+        return False
+
+    new.add_players(old.players)
+    new.set_matches(old.known_matches)
+    new.set_admin(old.admin_id)
+    return True
+
+
+def main():
+    tournament_ids = sys.argv[1:] or pickled_tournament_ids()
+    for tournament_id in tournament_ids:
+        if migrate(tournament_id):
+            print(f'Migrated {tournament_id}.')
+        else:
+            print(f'Skipped {tournament_id}, it is already in the sqlite database.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Keeps challonge up to date with a bracket being played out locally (see engine.py).
+
+Results are queued as they come in, and pushed to challonge whenever we sync,
+so that nobody waits on challonge to find out what their next match is. While
+challonge is slow or down, results just wait in the queue.
+
+The local bracket is the source of truth. Challonge generates the same bracket
+from the same seeding, but its matches have their own IDs, so each local
+match is linked to the challonge match between the same two players. Results
+players report on challonge themselves are passed back, to be recorded locally.
+Results challonge never gets a match for (e.g. where it generated the bracket
+differently) are only kept locally, once it's clear challonge isn't catching up.
+"""
+import collections
+import logging
+import threading
+from typing import Callable, Dict, FrozenSet, List, Tuple
+
+import challonge
+import data
+import metrics
+
+# How many syncs in a row a queued result can go without a challonge match to link it to, before we stop trying.
+# Results challonge is just behind on are linked within a sync or two, as the results before them are pushed.
+MAX_UNLINKED_SYNCS = 5
+
+MIRRORED = metrics.Counter('mirrored_results', 'Results of local brackets synced with challonge, by how it went.',
+                           ['outcome'])
+
+
+def pair(p1_id, p2_id) -> FrozenSet:
+    """How local and challonge matches are matched up: by who is playing, in either order."""
+    return frozenset((p1_id, p2_id))
+
+
+class ChallongeMirror:
+    """
+    Write-behind queue of results for one tournament.
+
+    on_mirrored is called with the local and challonge IDs of each match once they're linked,
+    so the links can be saved. Links saved before are passed back in as linked.
+    """
+
+    def __init__(self, client: challonge.Client, tourney_id: str, on_mirrored: Callable[[str, str], None],
+                 linked: Dict[str, str] = None):
+        self._client = client
+        self._tourney_id = tourney_id
+        self._on_mirrored = on_mirrored
+        # Challonge match IDs, by the ID of the local match they mirror.
+        self._links: Dict[str, str] = dict(linked or {})
+        self._linked_challonge_ids = set(self._links.values())
+        # Results waiting to be pushed, with the IDs of the players in the match, by local match ID.
+        self._pending: Dict[str, Tuple[data.Result, str, str]] = collections.OrderedDict()
+        # How many syncs in a row each queued result couldn't be linked, by local match ID.
+        self._unlinked_syncs: Dict[str, int] = collections.Counter()
+        self._started = False
+        # Results are queued from whichever thread recorded them.
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """How many results haven't made it to challonge yet."""
+        return len(self._pending)
+
+    def push(self, result: data.Result, p1_id: str, p2_id: str):
+        """Queues the given result, between the given players, to be sent to challonge on the next sync."""
+        with self._lock:
+            self._pending[result.match_id] = (result, p1_id, p2_id)
+
+    def link(self, match_id: str, challonge_id: str):
+        """Records that the given local match is mirrored by the given challonge match."""
+        with self._lock:
+            self._links[match_id] = challonge_id
+            self._linked_challonge_ids.add(challonge_id)
+            self._pending.pop(match_id, None)
+            self._unlinked_syncs.pop(match_id, None)
+        self._on_mirrored(match_id, challonge_id)
+
+    def sync(self, open_matches: Dict[FrozenSet, str]) -> List[Tuple[str, str, str]]:
+        """
+        Pushes queued results to challonge, and finds results reported on challonge for the given open
+        local matches, which are keyed by their pair of players.
+
+        Returns the results reported on challonge, as (local match ID, challonge match ID, winner ID).
+        Record them, then link them. Raises a ChallongeError if challonge is having trouble;
+        anything not pushed yet stays queued.
+        """
+        if not self._started:
+            self._start()
+        # Challonge only changes when we push something, or when someone reports a match there.
+        if not self._pending and self._client.list_matches(self._tourney_id, if_changed=True) is None:
+            return []
+
+        matches = self._client.list_all_matches(self._tourney_id)
+        reported = self._reported(matches, open_matches)
+        # Each result we push may open up the challonge matches the next ones go to.
+        while self._pending and self._push(matches):
+            matches = self._client.list_all_matches(self._tourney_id)
+        if self._pending:
+            self._drop_unlinkable(matches)
+        return reported
+
+    def _start(self):
+        try:
+            self._client.start_tournament(self._tourney_id)
+        except challonge.RequestRejected as e:
+            # Most likely someone started it on challonge already.
+            logging.info(f'Challonge did not start tournament {self._tourney_id} for us ({e}). Carrying on.')
+        self._started = True
+
+    def _reported(self, matches: List[challonge.BracketMatch],
+                  open_matches: Dict[FrozenSet, str]) -> List[Tuple[str, str, str]]:
+        reported = []
+        for m in matches:
+            if m.state != 'complete' or m.winner_id is None or m.id in self._linked_challonge_ids:
+                continue
+            if (match_id := open_matches.get(pair(m.p1_id, m.p2_id))) is not None:
+                reported.append((match_id, m.id, m.winner_id))
+                MIRRORED.inc(outcome='reported_on_challonge')
+        return reported
+
+    def _push(self, matches: List[challonge.BracketMatch]) -> bool:
+        """Pushes every queued result challonge has caught up to. Returns whether any were pushed."""
+        # Challonge matches that could still be linked to a local match, by their pair of players.
+        unlinked = collections.defaultdict(list)
+        for m in matches:
+            if m.state in ('open', 'complete') and m.id not in self._linked_challonge_ids:
+                unlinked[pair(m.p1_id, m.p2_id)].append(m)
+
+        with self._lock:
+            pending = list(self._pending.values())
+        pushed = False
+        for result, p1_id, p2_id in pending:
+            candidates = unlinked.get(pair(p1_id, p2_id))
+            if not candidates:
+                # Challonge hasn't caught up to this match yet.
+                continue
+            m = candidates.pop(0)
+            if m.state == 'complete' and m.winner_id == result.winner_id:
+                MIRRORED.inc(outcome='already_there')
+            else:
+                scores = (result.p1_score, result.p2_score) if m.p1_id == p1_id else (result.p2_score, result.p1_score)
+                try:
+                    self._client.set_score(self._tourney_id, m.id, *scores, result.winner_id)
+                except challonge.RequestRejected as e:
+                    # Challonge has a different result that it won't let us change. Ours still stands.
+                    logging.warning(f'Unable to mirror the result of match {result.match_id} to match {m.id} in '
+                                    f'tournament {self._tourney_id}, which challonge has a different result for: {e}')
+                    MIRRORED.inc(outcome='conflict')
+                    with self._lock:
+                        self._pending.pop(result.match_id, None)
+                        self._unlinked_syncs.pop(result.match_id, None)
+                    continue
+                MIRRORED.inc(outcome='pushed')
+                pushed = True
+            self.link(result.match_id, m.id)
+        return pushed
+
+    def _drop_unlinkable(self, matches: List[challonge.BracketMatch]):
+        """
+        Stops trying to push queued results for pairs of players challonge doesn't have, once nothing on challonge
+        is waiting for players (e.g. challonge paired a swiss round differently), or after MAX_UNLINKED_SYNCS syncs
+        (e.g. challonge seeded the bracket differently). Otherwise they'd stay queued forever, and every sync would
+        download the whole bracket.
+        """
+        pairs = {pair(m.p1_id, m.p2_id) for m in matches if m.id not in self._linked_challonge_ids}
+        waiting_for_players = any(m.state == 'pending' for m in matches)
+        with self._lock:
+            dropped = []
+            for match_id, (_, p1_id, p2_id) in self._pending.items():
+                if pair(p1_id, p2_id) in pairs:
+                    continue
+                self._unlinked_syncs[match_id] += 1
+                if not waiting_for_players or self._unlinked_syncs[match_id] >= MAX_UNLINKED_SYNCS:
+                    dropped.append(match_id)
+            for match_id in dropped:
+                del self._pending[match_id]
+                del self._unlinked_syncs[match_id]
+        for match_id in dropped:
+            logging.warning(f'Unable to mirror the result of match {match_id} to tournament {self._tourney_id}, '
+                            f'which has no match between the same players.')
+            MIRRORED.inc(outcome='unlinkable')
@@ -1,35 +1,78 @@
+import abc
+import logging
 import os
 import pickle
+import sqlite3
+import struct
+import threading
+import uuid
+import zlib
+from datetime import datetime
 
-from typing import List, Collection
+from typing import List, Collection, Dict, BinaryIO, FrozenSet, Optional, Tuple
 
 import data
+import metrics
 
 STATE_BACKUP_DIR = 'tournament_backups/'
 
+# Which backend State uses to store data, unless told otherwise.
+PICKLE_BACKEND = 'pickle'
+SQLITE_BACKEND = 'sqlite'
+STORAGE_BACKEND = os.environ.get('TOURNAMENT_STORAGE_BACKEND', PICKLE_BACKEND)
+
+# All tournaments stored with the sqlite backend share this database, in STATE_BACKUP_DIR.
+SQLITE_FILE_NAME = 'tournaments.sqlite3'
+
+# Once the journal holds this many records, it is folded into a fresh snapshot.
+COMPACT_AFTER_RECORDS = 1000
+
 # State uses these when writing data to a file.
 # Don't touch unless you have a good reason to.
 _ADMIN = 'admin_id'
 _MATCHES = 'called_match_ids'
 _PLAYERS = 'players'
 _LINK = 'tournament_link'
+_GENERATION = 'journal_generation'
+_FORMAT = 'format'
+
+# Snapshots and journal records store players and matches as plain tuples
+# (see _player_record and PickleBackend._match_record), with matches referring
+# to players by key_id. Older files hold whole Player and Match objects, and can still be read.
+_NORMALIZED_FORMAT = 2
+
+# Journal records are (op, argument) tuples.
+_OP_GENERATION = 'generation'
+_OP_ADD_PLAYERS = 'add_players'
+_OP_SET_ADMIN = 'set_admin'
+_OP_SET_MATCHES = 'set_matches'
+_OP_UPDATE_MATCHES = 'update_matches'
+
+# ResultLog records are (op, argument) tuples too.
+_OP_START = 'start'
+_OP_RESULT = 'result'
+_OP_MIRRORED = 'mirrored'
+
+# Each journal record is prefixed with its length and a checksum, so a record
+# that was only partially written when we crashed can be recognized and dropped.
+_RECORD_HEADER = struct.Struct('>II')
+
+WRITE_SECONDS = metrics.Histogram('state_write_seconds', 'How long saving tournament state took, by kind of write.',
+                                  ['kind'])
+BYTES_WRITTEN = metrics.Counter('state_bytes_written', 'Bytes of tournament state written, by kind of write.',
+                                ['kind'])
 
 
 class State:
     """
     Manages state of a tournament being run.
     This class backs info up in a nonvolatile way.
+
+    Where the info is kept depends on the storage backend, which defaults to STORAGE_BACKEND.
     """
 
-    def __init__(self, tournament_id, link: str = 'unspecified, sorry. :/'):
+    def __init__(self, tournament_id, link: str = 'unspecified, sorry. :/', backend: str = None):
         self._tournament_id = tournament_id
-        self._known_matches = []
-        self._players = []
-        self._admin_id = None
-        self._tournament_link = link
-        # NOTE: Anytime you add a relevant piece of tournament state, you must
-        # add it to _load_from and _save as well.
-        # WARNING: Do not add state in the constructor. Make separate set_<thingy> methods.
 
         # Make sure our backup folder exists.
         if not os.path.exists(STATE_BACKUP_DIR):
@@ -38,40 +81,353 @@ class State:
             )
             os.makedirs(STATE_BACKUP_DIR)
 
+        backend = backend if backend is not None else STORAGE_BACKEND
+        if backend not in _BACKENDS:
+            raise ValueError(f'Unknown storage backend "{backend}". Options are: {", ".join(_BACKENDS)}')
+        self._backend = _BACKENDS[backend](tournament_id, link)
+
+    @property
+    def tournament_id(self) -> str:
+        return self._tournament_id
+
+    @property
+    def players(self) -> List[data.Player]:
+        return self._backend.players
+
+    @property
+    def admin_id(self) -> int:
+        return self._backend.admin_id
+
+    @property
+    def known_matches(self) -> List[data.Match]:
+        return self._backend.known_matches
+
+    @property
+    def bracket_link(self) -> str:
+        return self._backend.bracket_link
+
+    @property
+    def bytes_written(self) -> int:
+        return self._backend.bytes_written
+
+    def add_players(self, players: List[data.Player]):
+        # We can only ever add players, because we just store the player data here.
+        # Which players are actually playing (like if one gets removed or something)
+        # is determined in bracket.py.
+        self._backend.add_players(players)
+
+    def set_admin(self, admin_id: int):
+        self._backend.set_admin(admin_id)
+
+    def set_matches(self, matches: Collection[data.Match]):
+        """Replaces every known match. Prefer update_matches, which only writes what changed."""
+        self._backend.set_matches(matches)
+
+    def update_matches(self, matches: Collection[data.Match]):
+        """Adds the given matches, or replaces the known matches with the same challonge IDs."""
+        self._backend.update_matches(matches)
+
+    def player_by_challonge_id(self, challonge_id: str) -> Optional[data.Player]:
+        return self._backend.player_by_challonge_id(challonge_id)
+
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        return self._backend.player_by_discord_id(discord_id)
+
+    def match_by_challonge_id(self, challonge_id: str) -> Optional[data.Match]:
+        return self._backend.match_by_challonge_id(challonge_id)
+
+    def close(self):
+        """Closes any files the state is kept in. They are reopened if the state changes again."""
+        self._backend.close()
+
+
+class Backend(abc.ABC):
+    """Stores the state of a single tournament. See State for what each method does."""
+
+    # Roughly how many bytes have been written to storage by this backend.
+    bytes_written = 0
+
+    @property
+    @abc.abstractmethod
+    def players(self) -> List[data.Player]:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def admin_id(self) -> int:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def known_matches(self) -> List[data.Match]:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def bracket_link(self) -> str:
+        pass
+
+    @abc.abstractmethod
+    def add_players(self, players: List[data.Player]):
+        pass
+
+    @abc.abstractmethod
+    def set_admin(self, admin_id: int):
+        pass
+
+    @abc.abstractmethod
+    def set_matches(self, matches: Collection[data.Match]):
+        pass
+
+    @abc.abstractmethod
+    def update_matches(self, matches: Collection[data.Match]):
+        pass
+
+    @abc.abstractmethod
+    def player_by_challonge_id(self, challonge_id: str) -> Optional[data.Player]:
+        pass
+
+    @abc.abstractmethod
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        pass
+
+    @abc.abstractmethod
+    def match_by_challonge_id(self, challonge_id: str) -> Optional[data.Match]:
+        pass
+
+    def close(self):
+        pass
+
+
+class PickleBackend(Backend):
+    """
+    Keeps one tournament's state in memory, backed by pickle files under STATE_BACKUP_DIR.
+
+    State is kept as a snapshot plus a journal of every change made since
+    the snapshot was taken. Each change only appends one small record to the
+    journal; every so often the journal is folded into a new snapshot.
+    """
+
+    def __init__(self, tournament_id, link: str):
+        self._known_matches = []
+        self._players = []
+        self._admin_id = None
+        self._tournament_link = link
+        # NOTE: Anytime you add a relevant piece of tournament state, you must
+        # add it to _load_from, _apply and _save as well.
+        # WARNING: Do not add state in the constructor. Make separate set_<thingy> methods.
+
+        # Position of each known match in _known_matches, by challonge ID.
+        self._match_positions: Dict[str, int] = {}
+        self._players_by_challonge_id: Dict[str, data.Player] = {}
+        self._players_by_discord_id: Dict[int, data.Player] = {}
+        self._players_by_key: Dict[uuid.UUID, data.Player] = {}
+        self._generation = 0
+        self._journal = None
+        self._journal_records = 0
+        # How much of the journal on disk is intact and from the current generation, if any of it is.
+        self._journal_valid_bytes = None
+        self.bytes_written = 0
+
         # Will blow up if 2 bots are managing the same tournament.
         # Things would blow up if you had that happening anyway.
-        self._save_file_name = f'{STATE_BACKUP_DIR}/{self.tournament_id}'
+        self._save_file_name = f'{STATE_BACKUP_DIR}/{tournament_id}'
+        self._journal_file_name = f'{self._save_file_name}.journal'
 
         # Read state if possible.
         if os.path.exists(self._save_file_name):
             with open(self._save_file_name, 'rb') as save_file:
                 self._load_from(save_file)
+            if os.path.exists(self._journal_file_name):
+                with open(self._journal_file_name, 'rb') as journal_file:
+                    self._replay(journal_file)
 
     def _load_from(self, file):
         state = pickle.load(file)
-        self._known_matches = state[_MATCHES]
-        self._players = state[_PLAYERS]
+        self._players = self._decode_players(state[_PLAYERS])
+        self._index_players(self._players)
+        self._known_matches = self._decode_matches(state[_MATCHES])
+        self._index_matches()
         self._admin_id = state[_ADMIN]
         self._tournament_link = state[_LINK]
+        # Snapshots from before the journal existed don't have a generation.
+        self._generation = state.get(_GENERATION, 0)
+
+    def _replay(self, file: BinaryIO):
+        """
+        Applies every complete record in the journal.
+
+        Stops at the first record that is cut off or corrupted, since that
+        (and anything after it) was being written when we crashed.
+        A journal from a different generation than the snapshot has already
+        been folded into the snapshot, and is ignored.
+        """
+        first = True
+        while len(header := file.read(_RECORD_HEADER.size)) == _RECORD_HEADER.size:
+            length, checksum = _RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            op, arg = pickle.loads(payload)
+            if first:
+                if op != _OP_GENERATION or arg != self._generation:
+                    return
+                first = False
+            else:
+                self._apply(op, self._decode(op, arg))
+            self._journal_records += 1
+            self._journal_valid_bytes = file.tell()
+
+    def _apply(self, op: str, arg):
+        if op == _OP_ADD_PLAYERS:
+            self._players += arg
+            self._index_players(arg)
+        elif op == _OP_SET_ADMIN:
+            self._admin_id = arg
+        elif op == _OP_SET_MATCHES:
+            self._known_matches = list(arg)
+            self._index_matches()
+        elif op == _OP_UPDATE_MATCHES:
+            for m in arg:
+                if (i := self._match_positions.get(m.challonge_id)) is not None:
+                    self._known_matches[i] = m
+                else:
+                    self._match_positions[m.challonge_id] = len(self._known_matches)
+                    self._known_matches.append(m)
+        else:
+            raise ValueError(f'Unknown journal operation "{op}"')
+
+    def _encode(self, op: str, arg):
+        """Converts the argument of a change into what gets written to the journal."""
+        if op == _OP_ADD_PLAYERS:
+            return [_player_record(p) for p in arg]
+        if op in (_OP_SET_MATCHES, _OP_UPDATE_MATCHES):
+            return [self._match_record(m) for m in arg]
+        return arg
+
+    def _match_record(self, m: data.Match) -> tuple:
+        return (m.challonge_id, m.key_id, self._player_ref(m.p1), self._player_ref(m.p2),
+                m.call_message_id, m.call_time, m.warn_time, m.dq_time, tuple(m.checked_in_ids))
+
+    def _player_ref(self, p: data.Player):
+        # Matches normally only have players we know about, but store the whole player if not.
+        return p.key_id if p.key_id in self._players_by_key else _player_record(p)
+
+    def _resolve_player(self, ref) -> data.Player:
+        if isinstance(ref, tuple):
+            return data.Player(*ref)
+        return self._players_by_key[ref]
+
+    def _decode(self, op: str, arg):
+        if op == _OP_ADD_PLAYERS:
+            return self._decode_players(arg)
+        if op in (_OP_SET_MATCHES, _OP_UPDATE_MATCHES):
+            return self._decode_matches(arg)
+        return arg
+
+    @staticmethod
+    def _decode_players(records) -> List[data.Player]:
+        return [r if isinstance(r, data.Player) else data.Player(*r) for r in records]
+
+    def _decode_matches(self, records) -> List[data.Match]:
+        """
+        Builds matches that share our one copy of each player.
+        Must be called after the players they refer to are indexed.
+        """
+        matches = []
+        for r in records:
+            if isinstance(r, data.Match):
+                # Old files pickled each match with its own copies of the players.
+                r.p1 = self._players_by_key.get(r.p1.key_id, r.p1)
+                r.p2 = self._players_by_key.get(r.p2.key_id, r.p2)
+                matches.append(r)
+                continue
+            challonge_id, key_id, p1_ref, p2_ref, call_message_id, call_time, warn_time, dq_time = r[:8]
+            # Records from before check-ins were tracked stop at dq_time.
+            checked_in_ids = data.check_ins(r[8]) if len(r) > 8 else data.NO_CHECK_INS
+            matches.append(data.Match(p1=self._resolve_player(p1_ref), p2=self._resolve_player(p2_ref),
+                                      call_message_id=call_message_id, call_time=call_time,
+                                      warn_time=warn_time, dq_time=dq_time, checked_in_ids=checked_in_ids,
+                                      challonge_id=challonge_id, key_id=key_id))
+        return matches
+
+    def _index_matches(self):
+        self._match_positions = {m.challonge_id: i for i, m in enumerate(self._known_matches)}
+
+    def _index_players(self, players: Collection[data.Player]):
+        for p in players:
+            self._players_by_challonge_id[p.challonge_id] = p
+            self._players_by_discord_id[p.discord_id] = p
+            self._players_by_key[p.key_id] = p
+
+    def _record(self, op: str, arg):
+        """Applies the given change, and appends it to the journal."""
+        self._apply(op, arg)
+        if self._journal is None:
+            if not os.path.exists(self._save_file_name):
+                # Nothing has been saved yet, so start from a snapshot of what we have.
+                self._save()
+                return
+            self._open_journal()
+        self._append(op, self._encode(op, arg))
+        if self._journal_records >= COMPACT_AFTER_RECORDS:
+            self._save()
+
+    def _open_journal(self):
+        if self._journal_valid_bytes is None:
+            # There was no usable journal, start a new one.
+            self._journal = open(self._journal_file_name, 'wb')
+            self._journal_records = 0
+            self._append(_OP_GENERATION, self._generation)
+            return
+        # Drop anything after the last good record, so new records aren't stuck behind a corrupted one.
+        self._journal = open(self._journal_file_name, 'r+b')
+        self._journal.truncate(self._journal_valid_bytes)
+        self._journal.seek(self._journal_valid_bytes)
+
+    def _append(self, op: str, arg):
+        with WRITE_SECONDS.time(kind='journal'):
+            payload = pickle.dumps((op, arg))
+            self._journal.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        self._journal_records += 1
+        self.bytes_written += _RECORD_HEADER.size + len(payload)
+        BYTES_WRITTEN.inc(_RECORD_HEADER.size + len(payload), kind='journal')
 
     def _save(self):
-        # If we crash before writing to the file we might lose state, but
-        # the likelihood of that is fairly small (I hope), and the penalty
-        # for that happening now is that (only the open matches) might get
-        # pinged twice. So...whatever.
-        with open(self._save_file_name, 'wb') as save_file:
-            pickle.dump(
-                {
-                    _MATCHES: self._known_matches,
-                    _PLAYERS: self._players,
-                    _ADMIN: self._admin_id,
-                    _LINK: self._tournament_link
-                }, save_file)
-            save_file.flush()
+        """
+        Writes a full snapshot, and starts a new, empty journal.
 
-    @property
-    def tournament_id(self) -> str:
-        return self._tournament_id
+        The snapshot is written to a temporary file and then moved into place,
+        so a crash part way through leaves the previous snapshot and journal intact.
+        If we crash after the new snapshot is in place but before the journal
+        is replaced, the old journal is from an older generation and is ignored.
+        """
+        with WRITE_SECONDS.time(kind='snapshot'):
+            self._generation += 1
+            temp_file_name = f'{self._save_file_name}.tmp'
+            with open(temp_file_name, 'wb') as save_file:
+                pickle.dump(
+                    {
+                        _MATCHES: [self._match_record(m) for m in self._known_matches],
+                        _PLAYERS: [_player_record(p) for p in self._players],
+                        _ADMIN: self._admin_id,
+                        _LINK: self._tournament_link,
+                        _GENERATION: self._generation,
+                        _FORMAT: _NORMALIZED_FORMAT,
+                    }, save_file)
+                save_file.flush()
+                os.fsync(save_file.fileno())
+                self.bytes_written += save_file.tell()
+                BYTES_WRITTEN.inc(save_file.tell(), kind='snapshot')
+            os.replace(temp_file_name, self._save_file_name)
+
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_file_name, 'wb')
+        self._journal_records = 0
+        self._append(_OP_GENERATION, self._generation)
 
     @property
     def players(self) -> List[data.Player]:
@@ -90,16 +446,376 @@ class State:
         return self._tournament_link
 
     def add_players(self, players: List[data.Player]):
-        # We can only ever add players, because we just store the player data here.
-        # Which players are actually playing (like if one gets removed or something)
-        # is determined in bracket.py.
-        self._players += players
-        self._save()
+        self._record(_OP_ADD_PLAYERS, list(players))
+
+    def set_admin(self, admin_id: int):
+        self._record(_OP_SET_ADMIN, admin_id)
+
+    def set_matches(self, matches: Collection[data.Match]):
+        self._record(_OP_SET_MATCHES, list(matches))
+
+    def update_matches(self, matches: Collection[data.Match]):
+        self._record(_OP_UPDATE_MATCHES, list(matches))
+
+    def player_by_challonge_id(self, challonge_id: str) -> Optional[data.Player]:
+        return self._players_by_challonge_id.get(challonge_id)
+
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        return self._players_by_discord_id.get(discord_id)
+
+    def match_by_challonge_id(self, challonge_id: str) -> Optional[data.Match]:
+        i = self._match_positions.get(challonge_id)
+        return self._known_matches[i] if i is not None else None
+
+    def close(self):
+        if self._journal is None:
+            return
+        # Everything written so far is good, so _open_journal picks up after it.
+        self._journal_valid_bytes = self._journal.tell()
+        self._journal.close()
+        self._journal = None
+
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tournaments (
+    tournament_id TEXT PRIMARY KEY,
+    admin_id INTEGER,
+    link TEXT
+);
+CREATE TABLE IF NOT EXISTS players (
+    tournament_id TEXT NOT NULL,
+    key_id NOT NULL,
+    discord_id INTEGER,
+    challonge_id,
+    PRIMARY KEY (tournament_id, key_id)
+);
+CREATE INDEX IF NOT EXISTS players_by_challonge_id ON players (tournament_id, challonge_id);
+CREATE INDEX IF NOT EXISTS players_by_discord_id ON players (tournament_id, discord_id);
+CREATE TABLE IF NOT EXISTS matches (
+    tournament_id TEXT NOT NULL,
+    challonge_id NOT NULL,
+    key_id NOT NULL,
+    p1_key_id NOT NULL,
+    p2_key_id NOT NULL,
+    call_message_id INTEGER,
+    call_time TEXT,
+    warn_time TEXT,
+    dq_time TEXT,
+    checked_in_ids TEXT,
+    PRIMARY KEY (tournament_id, challonge_id)
+);
+'''
+
+_MATCH_COLUMNS = ('challonge_id, key_id, p1_key_id, p2_key_id, call_message_id, call_time, warn_time, dq_time, '
+                  'checked_in_ids')
+
+# A match along with both of its players, as the columns _to_match and _to_player take.
+# Players that are missing come back as NULLs.
+_MATCH_WITH_PLAYERS = (
+    'SELECT ' + ', '.join(f'm.{c.strip()}' for c in _MATCH_COLUMNS.split(',')) + ', '
+    'p1.discord_id, p1.challonge_id, p1.key_id, p2.discord_id, p2.challonge_id, p2.key_id FROM matches m '
+    'LEFT JOIN players p1 ON p1.tournament_id = m.tournament_id AND p1.key_id = m.p1_key_id '
+    'LEFT JOIN players p2 ON p2.tournament_id = m.tournament_id AND p2.key_id = m.p2_key_id')
+_MATCH_COLUMN_COUNT = len(_MATCH_COLUMNS.split(','))
+
+# Columns added to existing tables since they were first created, with their types.
+_ADDED_MATCH_COLUMNS = {'checked_in_ids': 'TEXT'}
+
+# challonge_id columns have no type, so that IDs come back as whatever type they went in as (challonge's are ints).
+# Older databases declared them as TEXT, which turned every ID into a string. Those tables are rebuilt with
+# the IDs made back into numbers, since that's what challonge's IDs always were.
+_UNTYPED_ID_TABLES = ('players', 'matches')
+_NUMBER_FROM_TEXT = ("CASE WHEN challonge_id <> '' AND challonge_id NOT GLOB '*[^0-9]*' "
+                     "THEN CAST(challonge_id AS INTEGER) ELSE challonge_id END")
+
+# Open sqlite databases, by path, along with a lock guarding each one.
+# Every tournament in the same database shares one connection.
+_sqlite_databases: Dict[str, Tuple[sqlite3.Connection, threading.Lock]] = {}
+_sqlite_databases_lock = threading.Lock()
+
+
+def _sqlite_database(path: str) -> Tuple[sqlite3.Connection, threading.Lock]:
+    with _sqlite_databases_lock:
+        if path not in _sqlite_databases:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SQLITE_SCHEMA)
+            existing_columns = {row[1] for row in conn.execute('PRAGMA table_info(matches)')}
+            for column, column_type in _ADDED_MATCH_COLUMNS.items():
+                if column not in existing_columns:
+                    conn.execute(f'ALTER TABLE matches ADD COLUMN {column} {column_type}')
+            _untype_challonge_ids(conn)
+            _sqlite_databases[path] = (conn, threading.Lock())
+        return _sqlite_databases[path]
+
+
+def _untype_challonge_ids(conn: sqlite3.Connection):
+    for table in _UNTYPED_ID_TABLES:
+        columns = [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info({table})')]
+        if ('challonge_id', 'TEXT') not in columns:
+            continue
+        names = [name for name, _ in columns]
+        values = [_NUMBER_FROM_TEXT if name == 'challonge_id' else name for name in names]
+        conn.executescript(f'''
+            BEGIN;
+            ALTER TABLE {table} RENAME TO old_{table};
+            {_SQLITE_SCHEMA}
+            INSERT INTO {table} ({", ".join(names)}) SELECT {", ".join(values)} FROM old_{table};
+            DROP TABLE old_{table};
+            COMMIT;
+        ''')
+        # The indexes went with the old table.
+        conn.executescript(_SQLITE_SCHEMA)
+
+
+def close_sqlite_databases():
+    """Closes every open sqlite database. They will be reopened the next time they are needed."""
+    with _sqlite_databases_lock:
+        for conn, _ in _sqlite_databases.values():
+            conn.close()
+        _sqlite_databases.clear()
+
+
+class SqliteBackend(Backend):
+    """
+    Keeps tournament state in a sqlite database shared by every tournament.
+
+    Nothing is cached in memory: lookups by challonge ID or discord ID are
+    answered from an index, and each change only writes the affected rows.
+    """
+
+    def __init__(self, tournament_id, link: str):
+        self._tournament_id = tournament_id
+        self._default_link = link
+        self._conn, self._lock = _sqlite_database(os.path.join(STATE_BACKUP_DIR, SQLITE_FILE_NAME))
+        self.bytes_written = 0
+
+    @property
+    def players(self) -> List[data.Player]:
+        rows = self._query('SELECT discord_id, challonge_id, key_id FROM players '
+                           'WHERE tournament_id = ? ORDER BY rowid', (self._tournament_id,))
+        return [_to_player(r) for r in rows]
+
+    @property
+    def admin_id(self) -> int:
+        rows = self._query('SELECT admin_id FROM tournaments WHERE tournament_id = ?', (self._tournament_id,))
+        return rows[0][0] if rows else None
+
+    @property
+    def known_matches(self) -> List[data.Match]:
+        players_by_key = {p.key_id: p for p in self.players}
+        rows = self._query(f'SELECT {_MATCH_COLUMNS} FROM matches WHERE tournament_id = ? ORDER BY rowid',
+                           (self._tournament_id,))
+        matches = []
+        for r in rows:
+            p1, p2 = players_by_key.get(_decode_key(r[2])), players_by_key.get(_decode_key(r[3]))
+            if p1 is None or p2 is None:
+                self._warn_missing_player(r[0])
+                continue
+            matches.append(_to_match(r, p1, p2))
+        return matches
+
+    @property
+    def bracket_link(self) -> str:
+        rows = self._query('SELECT link FROM tournaments WHERE tournament_id = ?', (self._tournament_id,))
+        return rows[0][0] if rows else self._default_link
+
+    def add_players(self, players: List[data.Player]):
+        self._write('INSERT INTO players (tournament_id, key_id, discord_id, challonge_id) VALUES (?, ?, ?, ?)',
+                    [(self._tournament_id, _encode_key(p.key_id), p.discord_id, p.challonge_id) for p in players])
 
     def set_admin(self, admin_id: int):
-        self._admin_id = admin_id
-        self._save()
+        self._write('UPDATE tournaments SET admin_id = ? WHERE tournament_id = ?', [(admin_id, self._tournament_id)])
 
     def set_matches(self, matches: Collection[data.Match]):
-        self._known_matches = list(matches)
-        self._save()
+        self._write('DELETE FROM matches WHERE tournament_id = ?', [(self._tournament_id,)])
+        self.update_matches(matches)
+
+    def update_matches(self, matches: Collection[data.Match]):
+        self._write(f'INSERT INTO matches (tournament_id, {_MATCH_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (tournament_id, challonge_id) DO UPDATE SET '
+                    'key_id = excluded.key_id, p1_key_id = excluded.p1_key_id, p2_key_id = excluded.p2_key_id, '
+                    'call_message_id = excluded.call_message_id, call_time = excluded.call_time, '
+                    'warn_time = excluded.warn_time, dq_time = excluded.dq_time, '
+                    'checked_in_ids = excluded.checked_in_ids',
+                    [(self._tournament_id,) + _match_row(m) for m in matches])
+
+    def player_by_challonge_id(self, challonge_id: str) -> Optional[data.Player]:
+        rows = self._query('SELECT discord_id, challonge_id, key_id FROM players '
+                           'WHERE tournament_id = ? AND challonge_id = ?', (self._tournament_id, challonge_id))
+        return _to_player(rows[0]) if rows else None
+
+    def player_by_discord_id(self, discord_id: int) -> Optional[data.Player]:
+        rows = self._query('SELECT discord_id, challonge_id, key_id FROM players '
+                           'WHERE tournament_id = ? AND discord_id = ?', (self._tournament_id, discord_id))
+        return _to_player(rows[0]) if rows else None
+
+    def match_by_challonge_id(self, challonge_id: str) -> Optional[data.Match]:
+        rows = self._query(f'{_MATCH_WITH_PLAYERS} WHERE m.tournament_id = ? AND m.challonge_id = ?',
+                           (self._tournament_id, challonge_id))
+        if not rows:
+            return None
+        match_row = rows[0][:_MATCH_COLUMN_COUNT]
+        p1_row, p2_row = rows[0][_MATCH_COLUMN_COUNT:_MATCH_COLUMN_COUNT + 3], rows[0][_MATCH_COLUMN_COUNT + 3:]
+        if p1_row[2] is None or p2_row[2] is None:
+            self._warn_missing_player(challonge_id)
+            return None
+        return _to_match(match_row, _to_player(p1_row), _to_player(p2_row))
+
+    def _warn_missing_player(self, challonge_id):
+        logging.warning(f'Leaving out match {challonge_id} in tournament {self._tournament_id}, '
+                        f'which has a player that was never added.')
+
+    def _query(self, sql: str, params: tuple) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _write(self, sql: str, rows: List[tuple]):
+        """Runs the given statement once per row, in a single transaction."""
+        with WRITE_SECONDS.time(kind='sqlite'), self._lock, self._conn:
+            # Every change needs the tournament to exist, so that its link is remembered.
+            self._conn.execute('INSERT OR IGNORE INTO tournaments (tournament_id, link) VALUES (?, ?)',
+                               (self._tournament_id, self._default_link))
+            self._conn.executemany(sql, rows)
+        written = sum(len(str(v)) for row in rows for v in row)
+        self.bytes_written += written
+        BYTES_WRITTEN.inc(written, kind='sqlite')
+
+
+_BACKENDS = {
+    PICKLE_BACKEND: PickleBackend,
+    SQLITE_BACKEND: SqliteBackend,
+}
+
+
+class ResultLog:
+    """
+    Everything needed to rebuild a bracket being played out locally (see engine.py):
+    how it was started, and every result in the order it came in. Also keeps
+    track of which challonge match each local match was mirrored to (see mirror.py).
+
+    Records are appended to their own file in STATE_BACKUP_DIR as they happen,
+    framed the same way as the PickleBackend journal. Nothing is written until
+    the bracket is started.
+    """
+
+    def __init__(self, tournament_id):
+        self._file_name = f'{STATE_BACKUP_DIR}/{tournament_id}.results'
+        self.tournament_type: Optional[str] = None
+        # Challonge IDs of the players, in seed order.
+        self.player_ids: Optional[list] = None
+        self.results: List[data.Result] = []
+        # Challonge match IDs, by the ID of the local match they mirror.
+        self.mirrored: Dict[str, str] = {}
+        self._file = None
+        self._valid_bytes = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self._file_name):
+            with open(self._file_name, 'rb') as f:
+                self._replay(f)
+
+    @property
+    def started(self) -> bool:
+        return self.player_ids is not None
+
+    def start(self, tournament_type: str, player_ids: list):
+        if self.started:
+            raise ValueError('The bracket has already been started.')
+        self._record(_OP_START, (tournament_type, list(player_ids)))
+
+    def record_result(self, result: data.Result):
+        self._record(_OP_RESULT, (result.match_id, result.winner_id, result.p1_score, result.p2_score))
+
+    def record_mirrored(self, match_id: str, challonge_id: str):
+        self._record(_OP_MIRRORED, (match_id, challonge_id))
+
+    def close(self):
+        """Closes the file results are written to. It's reopened if another record comes in."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._valid_bytes = self._file.tell()
+            self._file.close()
+            self._file = None
+
+    def _replay(self, file: BinaryIO):
+        # Like PickleBackend._replay, anything after a cut off or corrupted record was being written when we crashed.
+        while len(header := file.read(_RECORD_HEADER.size)) == _RECORD_HEADER.size:
+            length, checksum = _RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            self._apply(*pickle.loads(payload))
+            self._valid_bytes = file.tell()
+
+    def _apply(self, op: str, arg):
+        if op == _OP_START:
+            self.tournament_type, self.player_ids = arg
+        elif op == _OP_RESULT:
+            self.results.append(data.Result(*arg))
+        elif op == _OP_MIRRORED:
+            self.mirrored[arg[0]] = arg[1]
+        else:
+            raise ValueError(f'Unknown result log operation "{op}"')
+
+    def _record(self, op: str, arg):
+        payload = pickle.dumps((op, arg))
+        with self._lock:
+            with WRITE_SECONDS.time(kind='results'):
+                if self._file is None:
+                    self._file = open(self._file_name, 'ab')
+                    self._file.truncate(self._valid_bytes)
+                self._file.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._apply(op, arg)
+        BYTES_WRITTEN.inc(_RECORD_HEADER.size + len(payload), kind='results')
+
+
+def _player_record(p: data.Player) -> tuple:
+    return p.discord_id, p.challonge_id, p.key_id
+
+
+def _encode_key(key_id):
+    # Keys are normally UUIDs, which sqlite doesn't know about.
+    return str(key_id) if isinstance(key_id, uuid.UUID) else key_id
+
+
+def _decode_key(value):
+    return uuid.UUID(value) if isinstance(value, str) else value
+
+
+def _encode_time(t: Optional[datetime]) -> Optional[str]:
+    return t.isoformat() if t is not None else None
+
+
+def _decode_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def _encode_ids(ids: Collection[int]) -> str:
+    return ','.join(str(i) for i in sorted(ids))
+
+
+def _decode_ids(value: Optional[str]) -> FrozenSet[int]:
+    return data.check_ins(int(i) for i in value.split(',')) if value else data.NO_CHECK_INS
+
+
+def _to_player(row: tuple) -> data.Player:
+    discord_id, challonge_id, key_id = row
+    return data.Player(discord_id, challonge_id, _decode_key(key_id))
+
+
+def _match_row(m: data.Match) -> tuple:
+    return (m.challonge_id, _encode_key(m.key_id), _encode_key(m.p1.key_id), _encode_key(m.p2.key_id),
+            m.call_message_id, _encode_time(m.call_time), _encode_time(m.warn_time), _encode_time(m.dq_time),
+            _encode_ids(m.checked_in_ids))
+
+
+def _to_match(row: tuple, p1: data.Player, p2: data.Player) -> data.Match:
+    challonge_id, key_id, _, _, call_message_id, call_time, warn_time, dq_time, checked_in_ids = row
+    return data.Match(p1=p1, p2=p2, call_message_id=call_message_id, call_time=_decode_time(call_time),
+                      warn_time=_decode_time(warn_time), dq_time=_decode_time(dq_time),
+                      checked_in_ids=_decode_ids(checked_in_ids),
+                      challonge_id=challonge_id, key_id=_decode_key(key_id))
@@ -0,0 +1,119 @@
+"""Decides how often to poll challonge for each tournament."""
+import time
+
+# Polling interval while the bracket is moving at a normal pace.
+BASE_POLLING_INTERVAL_IN_SECS = 10
+# Polling interval right after we did something likely to open new matches.
+MIN_POLLING_INTERVAL_IN_SECS = 2
+# Longest we'll go without polling, e.g. while waiting on a 3 hour grand finals.
+MAX_POLLING_INTERVAL_IN_SECS = 60
+# How much longer to wait after each poll where nothing changed.
+BACKOFF_FACTOR = 1.5
+# Polling interval for tournaments we're being told about changes to (see webhooks.py), in case we miss any.
+SAFETY_NET_POLLING_INTERVAL_IN_SECS = 120
+
+
+class AdaptivePoller:
+    """
+    Tracks how long to wait before polling a tournament again.
+
+    Backs off while the set of open matches stays the same, returns to the base
+    interval when it changes, and polls again quickly right after a match is
+    called or a score is reported.
+    """
+
+    def __init__(self,
+                 base_interval_in_secs: float = BASE_POLLING_INTERVAL_IN_SECS,
+                 min_interval_in_secs: float = MIN_POLLING_INTERVAL_IN_SECS,
+                 max_interval_in_secs: float = MAX_POLLING_INTERVAL_IN_SECS,
+                 backoff_factor: float = BACKOFF_FACTOR):
+        self._base = base_interval_in_secs
+        self._min = min_interval_in_secs
+        self._max = max_interval_in_secs
+        self._backoff_factor = backoff_factor
+        self._interval = base_interval_in_secs
+
+        self._last_poll_time = None
+        self._polls = 0
+        self._requests_skipped = 0.0
+        self._responses_not_modified = 0
+
+    @property
+    def interval(self) -> float:
+        """How many seconds to wait before the next poll."""
+        return self._interval
+
+    @property
+    def polls(self) -> int:
+        return self._polls
+
+    @property
+    def requests_skipped(self) -> int:
+        """How many fewer requests we sent than if we had polled every base interval."""
+        return int(self._requests_skipped)
+
+    @property
+    def responses_not_modified(self) -> int:
+        """How many polls challonge answered with 'unchanged', so there was nothing to download or process."""
+        return self._responses_not_modified
+
+    @property
+    def requests_saved(self) -> int:
+        return self.requests_skipped + self.responses_not_modified
+
+    def record_poll(self, changed: bool, not_modified: bool = False, now: float = None):
+        """Updates the interval after a poll, based on whether the open matches changed."""
+        now = time.monotonic() if now is None else now
+        if self._last_poll_time is not None:
+            self._requests_skipped += max(0.0, (now - self._last_poll_time) / self._base - 1)
+        self._last_poll_time = now
+        self._polls += 1
+        if not_modified:
+            self._responses_not_modified += 1
+
+        if changed:
+            self._interval = min(self._interval, self._base)
+        else:
+            self._interval = min(self._max, self._interval * self._backoff_factor)
+
+    def tighten(self):
+        """Poll again soon, since something probably just changed."""
+        self._interval = self._min
+
+
+class PushAwarePoller(AdaptivePoller):
+    """
+    An AdaptivePoller that only slows down to the safety net interval while we're actually being
+    told when the tournament's matches change (see webhooks.py).
+
+    Being able to receive notifications doesn't mean anyone sends them (challonge's v1 API never
+    does), so this polls adaptively until a notification arrives for the tournament, and goes back
+    to it as soon as a poll finds a change nobody told us about.
+    """
+
+    def __init__(self, safety_net_interval_in_secs: float = SAFETY_NET_POLLING_INTERVAL_IN_SECS, **kwargs):
+        super().__init__(**kwargs)
+        self._safety_net = safety_net_interval_in_secs
+        self._pushed = False
+        self._pushed_since_last_poll = False
+
+    @property
+    def interval(self) -> float:
+        return self._safety_net if self._pushed else super().interval
+
+    @property
+    def pushed(self) -> bool:
+        """Whether we're relying on being told when matches change."""
+        return self._pushed
+
+    def record_push(self):
+        """Records that we were just told the tournament's matches changed."""
+        self._pushed = True
+        self._pushed_since_last_poll = True
+
+    def record_poll(self, changed: bool, not_modified: bool = False, now: float = None):
+        super().record_poll(changed, not_modified, now)
+        if changed and not self._pushed_since_last_poll:
+            # We weren't told about this change, so notifications stopped coming (if they ever did).
+            self._pushed = False
+        self._pushed_since_last_poll = False
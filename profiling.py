@@ -0,0 +1,77 @@
+"""
+Profiles the running bot, without stopping it or getting in the way of running tournaments.
+
+Stacks are sampled from a separate thread, so the event loop keeps running
+(and shows up in the samples) while we watch it.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict
+
+# How often to sample every thread's stack, and how many stack frames to keep in each sample.
+SAMPLE_INTERVAL_IN_SECS = 0.01
+MAX_STACK_DEPTH = 64
+# How many of the lines that allocated the most memory to report.
+TOP_ALLOCATION_SITES = 50
+
+
+def sample_stacks(duration_in_secs: float, interval_in_secs: float = SAMPLE_INTERVAL_IN_SECS) -> Dict[str, int]:
+    """
+    Samples the stack of every other thread until duration_in_secs is up. Blocks until then.
+
+    Returns how many times each stack was seen, keyed by the thread name followed by
+    each frame from the outermost in, separated by semicolons.
+    """
+    me = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.monotonic() + duration_in_secs
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval_in_secs)
+    return counts
+
+
+def collapse(counts: Dict[str, int]) -> str:
+    """Formats stack counts as collapsed stacks, one per line, which flame graph tools can read."""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items(), key=lambda i: -i[1]))
+
+
+def allocation_diff(duration_in_secs: float, top: int = TOP_ALLOCATION_SITES) -> str:
+    """
+    Reports the lines that allocated the most memory (net of frees) over the next duration_in_secs.
+    Blocks until then.
+
+    Tracing allocations slows everything down, so it's only on while this runs,
+    unless it was already on.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration_in_secs)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    stats = after.compare_to(before, 'lineno')
+    lines = [f'Top {top} allocation sites over {duration_in_secs} seconds, by change in size:']
+    lines += [str(s) for s in stats[:top]]
+    total = sum(s.size_diff for s in stats)
+    lines.append(f'Net change across all {len(stats)} sites: {total:+,} B')
+    return '\n'.join(lines) + '\n'
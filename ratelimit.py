@@ -0,0 +1,121 @@
+"""Keeps us under the rate limits of the services we talk to."""
+import asyncio
+import collections
+import heapq
+import inspect
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to capacity actions, refilling at rate_per_sec.
+
+    Doesn't hold on to any asyncio primitives, so it isn't tied to a particular event loop.
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self._rate = rate_per_sec
+        self._capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available. Returns whether it did."""
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def seconds_until_available(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    async def acquire(self):
+        """Waits until a token is available, then takes it."""
+        while not self.try_acquire():
+            await asyncio.sleep(self.seconds_until_available())
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+class PriorityLimiter:
+    """
+    Runs coroutines as a token bucket allows, most urgent first.
+
+    Callers wait in one lane per priority (lower goes first), and whenever a
+    token frees up, the longest waiting caller in the most urgent lane goes.
+    Must only be used from a single event loop, except for queue_depth.
+    """
+
+    def __init__(self, bucket: TokenBucket):
+        self._bucket = bucket
+        self._waiting: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._depths: Dict[int, int] = collections.Counter()
+        # A copy of _depths, replaced whenever it changes, for other threads to read.
+        self._published_depths: Dict[int, int] = {}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.in_flight = 0
+
+    def queue_depth(self, priority: int = None) -> int:
+        """
+        How many callers are waiting in the given lane, or in every lane if none is given.
+        Safe to call from any thread.
+        """
+        depths = self._published_depths
+        if priority is None:
+            return sum(depths.values())
+        return depths.get(priority, 0)
+
+    async def run(self, priority: int, coro: Awaitable[T]) -> T:
+        """Waits for our turn, then awaits coro."""
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), turn))
+        self._depths[priority] += 1
+        self._publish_depths()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.cancelled():
+                # We gave up while waiting, so we're still counted in our lane.
+                self._depths[priority] -= 1
+                self._publish_depths()
+            if inspect.iscoroutine(coro):
+                coro.close()
+            raise
+
+        self.in_flight += 1
+        try:
+            return await coro
+        finally:
+            self.in_flight -= 1
+
+    def _publish_depths(self):
+        self._published_depths = dict(self._depths)
+
+    async def _dispatch(self):
+        while self._waiting:
+            await self._bucket.acquire()
+            while self._waiting:
+                priority, _, turn = heapq.heappop(self._waiting)
+                if not turn.cancelled():
+                    self._depths[priority] -= 1
+                    self._publish_depths()
+                    turn.set_result(None)
+                    break
@@ -0,0 +1,68 @@
+"""Turns reactions to a registration message into players in a bracket, even for very large tournaments."""
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+import discord
+
+import bracket as challonge_bracket
+import data
+import util
+
+# How many participants to add to challonge per request. Players are added in order,
+# one chunk at a time, so that challonge seeds them in the order they signed up.
+CHUNK_SIZE = 100
+# How many reactions to page through the users of at the same time.
+MAX_CONCURRENT_REACTION_FETCHES = 4
+
+
+async def collect_reactors(reactions: Iterable[discord.Reaction],
+                           format_name: Callable[[discord.abc.User], str]) -> Dict[int, str]:
+    """
+    Returns the formatted names of everyone who reacted with any of the given reactions, by discord ID.
+
+    Reactions are paged through concurrently. Someone who reacted more than once is only included once.
+    """
+    names_by_discord_id = {}
+    limit = asyncio.Semaphore(MAX_CONCURRENT_REACTION_FETCHES)
+
+    async def collect(r: discord.Reaction):
+        async with limit:
+            with util.discord_call('reaction_users'):
+                async for u in r.users():
+                    if u.id not in names_by_discord_id:
+                        names_by_discord_id[u.id] = format_name(u)
+
+    await asyncio.gather(*[collect(r) for r in reactions])
+    return names_by_discord_id
+
+
+async def add_players(b: challonge_bracket.AsyncBracket, names_by_discord_id: Dict[int, str],
+                      on_progress: Callable[[int, int], Awaitable[None]] = None) -> List[data.Player]:
+    """
+    Adds the given players to the bracket, CHUNK_SIZE at a time, skipping any that are already in it.
+
+    After each chunk, awaits on_progress with how many of the given players are in
+    the bracket, and how many there are in total. If a chunk fails, the players in
+    earlier chunks stay added, so calling this again with the same players picks up
+    where it left off. Returns the players that were added.
+    """
+    missing = {i: name for i, name in names_by_discord_id.items() if b.player_by_discord_id(i) is None}
+    recovered = []
+    if missing:
+        # If an earlier attempt failed part way, challonge may have added the chunk that failed anyway.
+        recovered = await b.recover_players(missing)
+        for p in recovered:
+            del missing[p.discord_id]
+
+    added = list(recovered)
+    total = len(names_by_discord_id)
+    done = total - len(missing)
+    pending = list(missing.items())
+    for start in range(0, len(pending), CHUNK_SIZE):
+        chunk = dict(pending[start:start + CHUNK_SIZE])
+        await b.create_players(chunk)
+        added += [b.player_by_discord_id(i) for i in chunk]
+        done += len(chunk)
+        if on_progress is not None:
+            await on_progress(done, total)
+    return added
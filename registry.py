@@ -0,0 +1,148 @@
+"""Keeps track of every tournament a single bot process is running."""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+import metrics
+
+# How many tournaments may be polled at the same time.
+# Polls mostly wait on challonge, so this can be fairly high.
+MAX_CONCURRENT_POLLS = 32
+
+POLL_SECONDS = metrics.Histogram('poll_seconds', 'How long polling a single tournament took.')
+POLL_FAILURES = metrics.Counter('poll_failures', 'Polls that failed with an exception.')
+POLL_CYCLE_SECONDS = metrics.Histogram('poll_cycle_seconds', 'How long polling every tournament that was due took.')
+LAST_POLL_CYCLE_SECONDS = metrics.Gauge('last_poll_cycle_seconds',
+                                        'How long the most recent round of polling every due tournament took.')
+
+T = TypeVar('T')
+Location = Tuple[Optional[int], int]  # (guild ID, channel ID)
+
+
+class Registry(Generic[T]):
+    """
+    Holds every running tournament, keyed by the guild and channel it is run in.
+
+    Each channel runs at most one tournament at a time, so a command can be
+    routed to its tournament with a single dict lookup.
+    """
+
+    def __init__(self):
+        self._by_location: Dict[Location, T] = {}
+        self._by_tourney_id: Dict[str, T] = {}
+        self._locations_by_tourney_id: Dict[str, Location] = {}
+
+    def add(self, guild_id: Optional[int], channel_id: int, tourney_id: str, tournament: T):
+        # Tournament IDs come back from challonge as numbers, but are read back from disk as strings.
+        tourney_id = str(tourney_id)
+        location = (guild_id, channel_id)
+        if location in self._by_location:
+            raise ValueError(f'Channel {channel_id} in guild {guild_id} is already running a tournament.')
+        if tourney_id in self._by_tourney_id:
+            raise ValueError(f'Tournament {tourney_id} is already being run in another channel.')
+        self._by_location[location] = tournament
+        self._by_tourney_id[tourney_id] = tournament
+        self._locations_by_tourney_id[tourney_id] = location
+
+    def remove(self, tourney_id: str):
+        tourney_id = str(tourney_id)
+        location = self._locations_by_tourney_id.pop(tourney_id)
+        del self._by_location[location]
+        del self._by_tourney_id[tourney_id]
+
+    def get(self, guild_id: Optional[int], channel_id: int) -> Optional[T]:
+        return self._by_location.get((guild_id, channel_id))
+
+    def get_by_tourney_id(self, tourney_id: str) -> Optional[T]:
+        return self._by_tourney_id.get(str(tourney_id))
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._by_tourney_id.values())
+
+    def __len__(self) -> int:
+        return len(self._by_tourney_id)
+
+
+class PollScheduler(Generic[T]):
+    """
+    Polls every tournament in a registry from one shared task.
+
+    Each tournament is polled on its own interval, which may change from one
+    poll to the next. A failure while polling one tournament is logged and
+    does not affect the others.
+    """
+
+    def __init__(self, registry: Registry[T], poll: Callable[[T], Awaitable[None]],
+                 interval_for: Callable[[T], float], max_concurrent_polls: int = MAX_CONCURRENT_POLLS,
+                 after_polls: Optional[Callable[[], None]] = None):
+        self._registry = registry
+        self._poll = poll
+        self._interval_for = interval_for
+        self._max_concurrent_polls = max_concurrent_polls
+        # Called after each batch of polls, e.g. to publish metrics about what the polls changed.
+        self._after_polls = after_polls
+        # Tournaments that aren't in here are due to be polled right away.
+        self._next_poll_at: Dict[T, float] = {}
+        # Tournaments that need to be polled sooner than their interval says.
+        self._poked_at: Dict[T, float] = {}
+        self._wakeup = asyncio.Event()
+
+    async def run(self):
+        """Poll indefinitely."""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = [t for t in self._registry if self._due_at(t, now) <= now]
+            for t in due:
+                self._poked_at.pop(t, None)
+            await self._poll_many(due)
+            for t in due:
+                self._next_poll_at[t] = time.monotonic() + self._interval_for(t)
+
+            # Forget about tournaments that are no longer running.
+            now = time.monotonic()
+            self._next_poll_at = {t: self._next_poll_at.get(t, now) for t in self._registry}
+            self._poked_at = {t: when for t, when in self._poked_at.items() if t in self._next_poll_at}
+
+            timeout = None
+            if self._next_poll_at:
+                timeout = max(0.0, min(self._due_at(t, now) for t in self._next_poll_at) - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def poke(self, tournament: T, delay_in_secs: float = 0):
+        """Makes sure the given tournament is polled within delay_in_secs."""
+        when = time.monotonic() + delay_in_secs
+        self._poked_at[tournament] = min(when, self._poked_at.get(tournament, when))
+        self._wakeup.set()
+
+    def _due_at(self, tournament: T, now: float) -> float:
+        return min(self._next_poll_at.get(tournament, now), self._poked_at.get(tournament, float('inf')))
+
+    async def poll_all(self):
+        """Polls every tournament right now, regardless of when they are due."""
+        await self._poll_many(list(self._registry))
+
+    async def _poll_many(self, tournaments: List[T]):
+        if not tournaments:
+            return
+        start = time.perf_counter()
+        limit = asyncio.Semaphore(self._max_concurrent_polls)
+        await asyncio.gather(*[self._poll_one(t, limit) for t in tournaments])
+        elapsed = time.perf_counter() - start
+        POLL_CYCLE_SECONDS.observe(elapsed)
+        LAST_POLL_CYCLE_SECONDS.set(elapsed)
+        if self._after_polls is not None:
+            self._after_polls()
+
+    async def _poll_one(self, tournament: T, limit: asyncio.Semaphore):
+        async with limit:
+            try:
+                with POLL_SECONDS.time():
+                    await self._poll(tournament)
+            except Exception:
+                POLL_FAILURES.inc()
+                logging.exception(f'Failed to poll tournament {tournament}.')
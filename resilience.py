@@ -0,0 +1,106 @@
+"""Helps us back off from services that are having trouble, instead of making it worse."""
+import enum
+import random
+import time
+from typing import Callable, Optional
+
+# How many failures in a row it takes to open a circuit.
+FAILURE_THRESHOLD = 5
+# How long an open circuit waits before letting requests through on trial.
+# Doubles every time the trial fails, up to the max.
+RESET_TIMEOUT_IN_SECS = 30
+MAX_RESET_TIMEOUT_IN_SECS = 300
+
+
+class CircuitState(enum.Enum):
+    # Requests go through as normal.
+    CLOSED = 'closed'
+    # Requests are refused without being sent.
+    OPEN = 'open'
+    # One request at a time goes through on trial, to see whether things have recovered.
+    # A failed trial opens the circuit again.
+    HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to something after it fails too many times in a row.
+
+    Once open, the circuit waits out a timeout, then lets a single request
+    through on trial. A success closes it again, a failure opens it for longer.
+    """
+
+    def __init__(self,
+                 failure_threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout_in_secs: float = RESET_TIMEOUT_IN_SECS,
+                 max_reset_timeout_in_secs: float = MAX_RESET_TIMEOUT_IN_SECS,
+                 clock: Callable[[], float] = time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._base_reset_timeout = reset_timeout_in_secs
+        self._max_reset_timeout = max_reset_timeout_in_secs
+        self._clock = clock
+
+        self._failures = 0
+        self._reset_timeout = reset_timeout_in_secs
+        # When an open circuit starts letting requests through on trial. None while closed.
+        self._retry_at: Optional[float] = None
+        # Whether a request was let through on trial, and we haven't heard how it went.
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> CircuitState:
+        if self._retry_at is None:
+            return CircuitState.CLOSED
+        if self._clock() < self._retry_at:
+            return CircuitState.OPEN
+        return CircuitState.HALF_OPEN
+
+    def retry_in_secs(self) -> float:
+        """How long until a request will be let through again. 0 if one would be now."""
+        if self.state != CircuitState.OPEN:
+            return 0.0
+        return self._retry_at - self._clock()
+
+    def allow_request(self) -> bool:
+        """
+        Whether a request may be sent now. Report how it went with record_success, record_failure
+        or record_inconclusive. While half open, only the first request is let through.
+        """
+        state = self.state
+        if state == CircuitState.HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return state != CircuitState.OPEN
+
+    def record_success(self):
+        self._failures = 0
+        self._reset_timeout = self._base_reset_timeout
+        self._retry_at = None
+        self._trial_in_flight = False
+
+    def record_inconclusive(self):
+        """For a request that was let through, but didn't tell us whether things recovered (e.g. it was cancelled)."""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_flight = False
+        state = self.state
+        if state == CircuitState.HALF_OPEN:
+            # Still broken, so give it longer this time.
+            self._reset_timeout = min(self._max_reset_timeout, self._reset_timeout * 2)
+        if state == CircuitState.HALF_OPEN or (state == CircuitState.CLOSED
+                                               and self._failures >= self._failure_threshold):
+            self._retry_at = self._clock() + self._reset_timeout
+
+
+def backoff_delay(attempt: int, base_delay_in_secs: float, max_delay_in_secs: float,
+                  rng: random.Random = random) -> float:
+    """
+    How long to wait before retrying after the given (0-indexed) failed attempt.
+
+    Exponential, with "full jitter" so that callers who failed at the same time
+    don't all retry at the same time too.
+    """
+    return rng.uniform(0, min(max_delay_in_secs, base_delay_in_secs * 2 ** attempt))
@@ -0,0 +1,205 @@
+"""
+Pairs the rounds of swiss tournaments.
+
+Players are paired with someone on the same score wherever possible, and never
+with someone they've already played unless there's no other way. Within each
+score group, the top half plays the bottom half. Where that would mean a
+rematch, a maximum matching (Edmonds' blossom algorithm) over the players in
+the group who haven't played each other pairs as many of them as possible, and
+whoever is left floats down to the next group. With an odd number of players,
+the lowest ranked player who hasn't had a bye yet gets one.
+
+Pairing thousands of players takes a fraction of a second, but that's still
+time the bot can't spend on anything else, so big rounds can be paired in a
+separate process with pair_round_in_pool.
+"""
+import collections
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Hashable, Iterator, List, Optional, Set, Tuple
+
+# Rounds with at least this many players are paired in a separate process by pair_round_in_pool.
+PROCESS_POOL_MIN_PLAYERS = int(os.environ.get('SWISS_PROCESS_POOL_MIN_PLAYERS', 1000))
+PROCESS_POOL_WORKERS = 2
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+@dataclass
+class Standing:
+    """Where a player stands going into a round."""
+    player_id: Hashable
+    score: float
+    # Breaks ties in score. Lower is better.
+    seed: int
+    opponents: Set[Hashable] = field(default_factory=set)
+    had_bye: bool = False
+
+
+@dataclass
+class Pairing:
+    # (higher ranked player ID, lower ranked player ID) of each match.
+    pairs: List[Tuple[Hashable, Hashable]]
+    bye: Optional[Hashable] = None
+
+
+def rounds_for(players: int) -> int:
+    """How many rounds it takes for one player to be the only one left who hasn't lost."""
+    return max(1, math.ceil(math.log2(players)))
+
+
+def pair_round(standings: List[Standing]) -> Pairing:
+    """Pairs the next round, given where everyone stands."""
+    ranked = sorted(standings, key=lambda s: (-s.score, s.seed))
+    bye = None
+    if len(ranked) % 2:
+        bye = next((s for s in reversed(ranked) if not s.had_bye), ranked[-1])
+        ranked.remove(bye)
+
+    pairs: List[Tuple[Standing, Standing]] = []
+    floaters: List[Standing] = []
+    for _, group in itertools.groupby(ranked, key=lambda s: s.score):
+        matched, floaters = _pair_group(floaters + list(group))
+        pairs += matched
+
+    # Nobody is below the last group to float down to, so undo the lowest pairs until everyone can be paired.
+    pool = floaters
+    while pool and pairs:
+        pool = list(pairs.pop()) + pool
+        matched, left = _pair_group(pool)
+        if not left:
+            pairs += matched
+            pool = []
+    if pool:
+        matched, left = _pair_group(pool)
+        logging.warning(f'Unable to pair {len(left)} players without rematches.')
+        pairs += matched + [(left[i], left[i + 1]) for i in range(0, len(left), 2)]
+
+    return Pairing([(a.player_id, b.player_id) for a, b in pairs], bye.player_id if bye is not None else None)
+
+
+def pair_round_in_pool(standings: List[Standing]) -> Pairing:
+    """Same as pair_round, but rounds of at least PROCESS_POOL_MIN_PLAYERS players are paired in another process."""
+    if len(standings) < PROCESS_POOL_MIN_PLAYERS:
+        return pair_round(standings)
+    return _pool().submit(pair_round, standings).result()
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Forking a process with other threads running can leave locks held forever in the child.
+            _process_pool = ProcessPoolExecutor(PROCESS_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+
+def _pair_group(group: List[Standing]) -> Tuple[List[Tuple[Standing, Standing]], List[Standing]]:
+    """
+    Pairs as many of the given players, in rank order, as possible without rematches.
+    Returns the pairs, and the players left over.
+    """
+    n = len(group)
+    index = {s.player_id: i for i, s in enumerate(group)}
+    # Who each player has already played, by position in the group.
+    played = [{index[o] for o in s.opponents if o in index} for s in group]
+    mate = [-1] * n
+
+    # The top half plays the bottom half, with whoever is closest to their mirror image if that's a rematch.
+    half = n // 2
+    for i in range(half):
+        for j in _nearest(half + i, half, n):
+            if mate[j] == -1 and j not in played[i]:
+                mate[i], mate[j] = j, i
+                break
+
+    # Only the players that didn't fit are matched up the hard way.
+    if mate.count(-1) > 1:
+        for root in range(n):
+            if mate[root] == -1:
+                _augment(root, mate, played)
+
+    pairs = [(group[i], group[mate[i]]) for i in range(n) if mate[i] > i]
+    return pairs, [group[i] for i in range(n) if mate[i] == -1]
+
+
+def _nearest(start: int, lo: int, hi: int) -> Iterator[int]:
+    """Every index in [lo, hi), by how close it is to start."""
+    for d in range(hi - lo):
+        if start + d < hi:
+            yield start + d
+        if d and start - d >= lo:
+            yield start - d
+
+
+def _augment(root: int, mate: List[int], played: List[Set[int]]):
+    """
+    Looks for a path from the unmatched root to another unmatched player that alternates
+    between unmatched and matched pairs, and flips it, so that one more player is paired.
+    Any two players in the group who haven't played each other can be paired.
+    """
+    n = len(mate)
+    parent = [-1] * n
+    # The base of the blossom each player has been contracted into, if any.
+    base = list(range(n))
+    used = [False] * n
+    used[root] = True
+    queue = collections.deque([root])
+
+    def lowest_common_ancestor(a: int, b: int) -> int:
+        seen = [False] * n
+        while True:
+            a = base[a]
+            seen[a] = True
+            if mate[a] == -1:
+                break
+            a = parent[mate[a]]
+        while True:
+            b = base[b]
+            if seen[b]:
+                return b
+            b = parent[mate[b]]
+
+    def mark_path(v: int, b: int, child: int, blossom: List[bool]):
+        while base[v] != b:
+            blossom[base[v]] = blossom[base[mate[v]]] = True
+            parent[v] = child
+            child = mate[v]
+            v = parent[mate[v]]
+
+    while queue:
+        v = queue.popleft()
+        for to in range(n):
+            if to == v or to in played[v] or base[v] == base[to] or mate[v] == to:
+                continue
+            if to == root or (mate[to] != -1 and parent[mate[to]] != -1):
+                # Found an odd cycle, contract it.
+                b = lowest_common_ancestor(v, to)
+                blossom = [False] * n
+                mark_path(v, b, to, blossom)
+                mark_path(to, b, v, blossom)
+                for i in range(n):
+                    if blossom[base[i]]:
+                        base[i] = b
+                        if not used[i]:
+                            used[i] = True
+                            queue.append(i)
+            elif parent[to] == -1:
+                parent[to] = v
+                if mate[to] == -1:
+                    # Flip the path back to the root.
+                    while to != -1:
+                        prev = parent[to]
+                        next_to = mate[prev]
+                        mate[to], mate[prev] = prev, to
+                        to = next_to
+                    return
+                used[mate[to]] = True
+                queue.append(mate[to])
@@ -1,23 +1,51 @@
 #!/usr/bin/env python3
 import asyncio
+import collections
+import http.server
+import itertools
+import json
 import os
 import os.path
 import pathlib
+import pickle
+import random
 import shutil
+import socket
+import sqlite3
+import threading
 import time
 import unittest
 import unittest.mock
+import urllib.request
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import discord
 
+import announcements
+import bracket
+import cache
 import challonge
 import data
+import engine
+import fake_challonge
 import main
+import match_graph
+import metrics
+import migrate
+import mirror
 import persistent
+import polling
+import profiling
+import ratelimit
+import registration
+import registry
+import resilience
+import swiss
+import timers
 import util
-from bracket import Bracket
+import webhooks
+from bracket import Bracket, AsyncBracket
 
 TEST_RUN_ID = uuid.uuid1()
 persistent.STATE_BACKUP_DIR = BACKUP_DIR = f'/tmp/{TEST_RUN_ID}'
@@ -34,6 +62,7 @@ class MyTest(unittest.TestCase):
         super().setUp()
 
         # Nuke and recreate backups
+        persistent.close_sqlite_databases()
         if os.path.exists(BACKUP_DIR):
             shutil.rmtree(BACKUP_DIR)
         if os.path.exists(BACKUP_FILE):
@@ -43,6 +72,11 @@ class MyTest(unittest.TestCase):
         # No need to recreate the backup file, it will be created automatically
         # when it is opened.
 
+    def closing(self, resource):
+        """Closes the given state or bracket once the test is done."""
+        self.addCleanup(resource.close)
+        return resource
+
 
 class TestAnnounceMatch(MyTest):
 
@@ -58,8 +92,8 @@ class TestAnnounceMatch(MyTest):
             p2_name: p2_challonge_id,
         })
 
-        state = persistent.State("arbitraryID12")
-        bracket = Bracket(mock_challonge, state)
+        state = self.closing(persistent.State("arbitraryID12"))
+        bracket = self.closing(Bracket(mock_challonge, state))
 
         # Create the players.
         bracket.create_players({
@@ -90,8 +124,8 @@ class TestAnnounceMatch(MyTest):
         mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[match])
 
         # Not mocked, we're testing real logic here.
-        state = persistent.State("arbitraryID12")
-        bracket = Bracket(mock_challonge, state)
+        state = self.closing(persistent.State("arbitraryID12"))
+        bracket = self.closing(Bracket(mock_challonge, state))
 
         # Mock out external dependencies.
         mock_discord_client = unittest.mock.MagicMock(spec=discord.ext.commands.Bot)
@@ -117,6 +151,254 @@ class TestAnnounceMatch(MyTest):
         _wait_for(bot.check_matches())
         output_channel.send.assert_not_called()
 
+    def test_calls_matches_in_every_tournament(self):
+        mock_discord_client = unittest.mock.MagicMock(spec=discord.ext.commands.Bot)
+        bot = main.Tournament(mock_discord_client)
+
+        channels = []
+        for i in range(2):
+            mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+            mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002"})
+            mock_challonge.list_matches = unittest.mock.MagicMock(
+                return_value=[challonge.Match(f"match-{i}", "1001", "1002")])
+            bracket = self.closing(Bracket(mock_challonge, persistent.State(f"tourney-{i}")))
+            bracket.create_players({2 * i: "Alice", 2 * i + 1: "Bob"})
+
+            channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+            channel.send.return_value.id = 1234
+            channels.append(channel)
+            bot.resume(bracket, 4206969 + i, channel)
+
+        _wait_for(bot.check_matches())
+
+        # Each tournament's match gets called in that tournament's channel.
+        for i, channel in enumerate(channels):
+            channel.send.assert_called_once()
+            self.assertIn(f"<@!{2 * i}>", channel.send.call_args[0][0])
+            self.assertIn(f"<@!{2 * i + 1}>", channel.send.call_args[0][0])
+
+    def test_resumes_deadlines_of_called_matches(self):
+        p1_discord_id, p2_discord_id = 1, 2
+        emoji = "😀"
+
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002"})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match("arbitrary_match_id", "1001", "1002")])
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({p1_discord_id: "Alice", p2_discord_id: "Bob"})
+
+        # The match was called long enough ago that the warning is overdue, and then the bot restarted.
+        m = bracket.fetch_open_matches()[0]
+        m.call_message_id = 6942096
+        m.call_time = datetime.now() - timedelta(minutes=6)
+        bracket.save_metadata(m)
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        match_call_message = unittest.mock.MagicMock(spec=discord.Message)
+        match_call_message.reactions = [_reaction(emoji)]
+        output_channel.fetch_message.return_value = match_call_message
+        util.get_user_ids = lambda _: _future({p2_discord_id})
+
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot),
+                              self.closing(Bracket(mock_challonge, persistent.State("tourneyID12"))), 4206969,
+                              output_channel,
+                              options=main.Options(warn_timer_in_minutes=5, dq_timer_in_minutes=10,
+                                                   check_in_emoji=discord.PartialEmoji(name=emoji)))
+        _wait_for(bot.check_matches())
+
+        # The match is not called again, but p1 gets the overdue warning.
+        output_channel.send.assert_called_once()
+        self.assertIn(f"<@!{p1_discord_id}>", output_channel.send.call_args[0][0])
+        self.assertIn("Please check in", output_channel.send.call_args[0][0])
+
+    def test_keeps_watching_deadlines_after_one_fails(self):
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot))
+        fired = []
+
+        async def fire_due_deadlines():
+            for _, match_id, _ in bot._deadlines.pop_due(datetime.now()):
+                fired.append(match_id)
+                if match_id == "broken":
+                    raise RuntimeError("Couldn't process the deadline.")
+
+        bot._fire_due_deadlines = fire_due_deadlines
+        bot._deadlines.schedule("tourney", "broken", timers.Deadline.WARN, datetime.now())
+        bot._deadlines.schedule("tourney", "later", timers.Deadline.WARN, datetime.now() + timedelta(seconds=0.1))
+
+        async def watch():
+            watcher = asyncio.create_task(bot._watch_deadlines())
+            for _ in range(50):
+                if "later" in fired:
+                    break
+                await asyncio.sleep(0.05)
+            watcher.cancel()
+
+        with self.assertLogs(level='ERROR'):
+            _wait_for(watch())
+        self.assertEqual(["broken", "later"], fired)
+
+    def test_tracks_checkins_from_reactions(self):
+        emoji = "😀"
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002"})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match("arbitrary_match_id", "1001", "1002")])
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({1: "Alice", 2: "Bob"})
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.send.return_value.id = 6942096
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel, options=main.Options(check_in_emoji=discord.PartialEmoji(name=emoji)))
+        _wait_for(bot.check_matches())
+
+        # Only the players in the match, reacting with the check-in emoji, count.
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, 6942096, 1, emoji)))
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, 6942096, 2, emoji)))
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, 6942096, 3, emoji)))
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, 6942096, 1, "👎")))
+        _wait_for(bot.on_raw_reaction_remove(_reaction_event(output_channel, 6942096, 2, emoji)))
+
+        # Check-ins are saved with the match.
+        self.assertEqual({1}, self.closing(persistent.State("tourneyID12")).known_matches[0].checked_in_ids)
+        output_channel.fetch_message.assert_not_called()
+
+    def test_calls_matches_opened_together_in_one_message(self):
+        emoji = "😀"
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(
+            return_value={f"Player {i}": f"100{i}" for i in range(6)})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match(f"match-{i}", f"100{2 * i}", f"100{2 * i + 1}") for i in range(3)])
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({i: f"Player {i}" for i in range(6)})
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.send.return_value.id = 6942096
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel, options=main.Options(check_in_emoji=discord.PartialEmoji(name=emoji)))
+        _wait_for(bot.check_matches())
+
+        output_channel.send.assert_called_once()
+        output_channel.send.return_value.add_reaction.assert_called_once()
+
+        # A reaction to the shared message checks the player in to their own match.
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, 6942096, 3, emoji)))
+        self.assertEqual([set(), {3}, set()], [m.checked_in_ids for m in bracket.known_matches])
+
+    def test_counts_checkins_to_calls_sent_before_the_rest(self):
+        emoji = "😀"
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(
+            return_value={f"Player {i}": f"{1000 + i}" for i in range(60)})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match(f"match-{i}", f"{1000 + 2 * i}", f"{1001 + 2 * i}") for i in range(30)])
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({i: f"Player {i}" for i in range(60)})
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel, options=main.Options(check_in_emoji=discord.PartialEmoji(name=emoji)))
+        sent = []
+
+        async def send(text):
+            if sent:
+                # Player 0 checks in to the first message while the next one is still going out.
+                await bot.on_raw_reaction_add(_reaction_event(output_channel, sent[0].id, 0, emoji))
+            sent.append(unittest.mock.MagicMock(id=len(sent) + 1))
+            return sent[-1]
+
+        output_channel.send.side_effect = send
+        _wait_for(bot.check_matches())
+
+        self.assertGreater(len(sent), 1)
+        self.assertEqual({0}, bracket.match_by_challonge_id("match-0").checked_in_ids)
+        reloaded = self.closing(persistent.State("tourneyID12"))
+        self.assertEqual({0}, reloaded.match_by_challonge_id("match-0").checked_in_ids)
+
+    def test_does_not_dq_while_challonge_is_down(self):
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002"})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match("arbitrary_match_id", "1001", "1002")])
+        mock_challonge.set_score = unittest.mock.MagicMock(side_effect=challonge.ChallongeUnavailable("down", 60))
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({1: "Alice", 2: "Bob"})
+
+        # The match was called long enough ago that p2 is due to be DQ'd.
+        m = bracket.fetch_open_matches()[0]
+        m.call_message_id = 6942096
+        m.call_time = datetime.now() - timedelta(minutes=11)
+        m.warn_time = m.call_time + timedelta(minutes=5)
+        m.checked_in_ids = {1}
+        bracket.save_metadata(m)
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.fetch_message.return_value.reactions = []
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel)
+        _wait_for(bot.check_matches())
+
+        # Nobody is told they were DQ'd, and the DQ is tried again once challonge has had time to recover.
+        mock_challonge.set_score.assert_called_once()
+        output_channel.send.assert_not_called()
+        self.assertIsNone(bracket.known_matches[0].dq_time)
+        self.assertEqual(1, bot._deadlines.pending(timers.Deadline.DQ))
+        self.assertGreater(bot._deadlines.next_deadline(), datetime.now() + timedelta(seconds=50))
+
+        # Polling stops too.
+        mock_challonge.list_matches.reset_mock()
+        _wait_for(bot.check_matches())
+        mock_challonge.list_matches.assert_not_called()
+
+    def test_submits_dqs_that_are_due_together_concurrently(self):
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(
+            return_value={f"Player {i}": str(1000 + i) for i in range(1, 9)})
+        mock_challonge.list_matches = unittest.mock.MagicMock(
+            return_value=[challonge.Match(f"m{i}", str(999 + 2 * i), str(1000 + 2 * i)) for i in range(1, 5)])
+        # Every submission has to be in flight at once to get past the barrier. One of them fails.
+        barrier = threading.Barrier(4, timeout=5)
+
+        def set_score(tourney_id, match_id, *_):
+            barrier.wait()
+            if match_id == "m3":
+                raise challonge.ChallongeUnavailable("down", 60)
+
+        mock_challonge.set_score = unittest.mock.MagicMock(side_effect=set_score)
+        bracket = self.closing(Bracket(mock_challonge, persistent.State("tourneyID12")))
+        bracket.create_players({i: f"Player {i}" for i in range(1, 9)})
+
+        # Every match was called long enough ago that nobody checked in is due to be DQ'd.
+        matches = bracket.fetch_open_matches()
+        for m in matches:
+            m.call_message_id = 6942096
+            m.call_time = datetime.now() - timedelta(minutes=11)
+            m.warn_time = m.call_time + timedelta(minutes=5)
+        bracket.save_all_metadata(matches)
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.fetch_message.return_value.reactions = []
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel)
+        with unittest.mock.patch.object(bracket._local_state, 'update_matches',
+                                        wraps=bracket._local_state.update_matches) as update_matches:
+            _wait_for(bot.check_matches())
+
+        self.assertEqual(4, mock_challonge.set_score.call_count)
+        # Every DQ is saved in one write, and the one challonge didn't take is put back in another.
+        self.assertEqual([["m1", "m2", "m3", "m4"], ["m3"]],
+                         [sorted(m.challonge_id for m in c.args[0]) for c in update_matches.call_args_list])
+        self.assertEqual([True, True, False, True], [m.dq_time is not None for m in bracket.known_matches])
+        self.assertEqual(1, bot._deadlines.pending(timers.Deadline.DQ))
+
+        # Only players that were actually DQ'd are told about it.
+        sent = "".join(c.args[0] for c in output_channel.send.call_args_list)
+        for p2_discord_id in (2, 4, 8):
+            self.assertIn(f"<@!{p2_discord_id}>", sent)
+        self.assertNotIn("<@!6>", sent)
+
     def test_warn_before_DQ_p1(self):
         """
         Scenario in which player one does not check into their match.
@@ -149,8 +431,8 @@ class TestAnnounceMatch(MyTest):
         mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[match])
 
         # Not mocked, we're testing real logic here.
-        state = persistent.State(tourney_id)
-        bracket = Bracket(mock_challonge, state)
+        state = self.closing(persistent.State(tourney_id))
+        bracket = self.closing(Bracket(mock_challonge, state))
 
         # Mock out external dependencies.
         mock_discord_client = unittest.mock.MagicMock(spec=discord.ext.commands.Bot)
@@ -179,15 +461,14 @@ class TestAnnounceMatch(MyTest):
         self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
 
         # Check p2 in, but not p1
-        match_call_message.reactions = [_reaction(emoji)]
-        util.get_user_ids = lambda _: _future({p2_discord_id})
-        output_channel.fetch_message.return_value = match_call_message
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, match_call_message.id, p2_discord_id, emoji)))
 
         # 1. p1 (and only p1!) should be warned.
         output_channel.send.reset_mock()
         time.sleep(warn_timer_in_secs)
         _wait_for(bot.check_matches())
-        output_channel.fetch_message.assert_called_with(match_call_message.id)
+        # Who checked in is already known, so discord isn't asked.
+        output_channel.fetch_message.assert_not_called()
         output_channel.send.assert_called_once()
         self.assertNotIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
         self.assertIn(f"<@!{p1_discord_id}>", output_channel.send.call_args[0][0])
@@ -245,8 +526,8 @@ class TestAnnounceMatch(MyTest):
         mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[match])
 
         # Not mocked, we're testing real logic here.
-        state = persistent.State(tourney_id)
-        bracket = Bracket(mock_challonge, state)
+        state = self.closing(persistent.State(tourney_id))
+        bracket = self.closing(Bracket(mock_challonge, state))
 
         # Mock out external dependencies.
         mock_discord_client = unittest.mock.MagicMock(spec=discord.ext.commands.Bot)
@@ -275,15 +556,14 @@ class TestAnnounceMatch(MyTest):
         self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
 
         # Check p1 in, but not p2.
-        match_call_message.reactions = [_reaction(emoji)]
-        util.get_user_ids = lambda _: _future({p1_discord_id})
-        output_channel.fetch_message.return_value = match_call_message
+        _wait_for(bot.on_raw_reaction_add(_reaction_event(output_channel, match_call_message.id, p1_discord_id, emoji)))
 
         # p2 (and only p2!) should be warned.
         output_channel.send.reset_mock()
         time.sleep(warn_timer_in_secs)
         _wait_for(bot.check_matches())
-        output_channel.fetch_message.assert_called_with(match_call_message.id)
+        # Who checked in is already known, so discord isn't asked.
+        output_channel.fetch_message.assert_not_called()
         output_channel.send.assert_called_once()
         self.assertNotIn(f"<@!{p1_discord_id}>", output_channel.send.call_args[0][0])
         self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
@@ -344,8 +624,8 @@ class TestAnnounceMatch(MyTest):
         mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[match])
 
         # Not mocked, we're testing real logic here.
-        state = persistent.State(tourney_id)
-        bracket = Bracket(mock_challonge, state)
+        state = self.closing(persistent.State(tourney_id))
+        bracket = self.closing(Bracket(mock_challonge, state))
 
         # Mock out external dependencies.
         mock_discord_client = unittest.mock.MagicMock(spec=discord.ext.commands.Bot)
@@ -374,18 +654,17 @@ class TestAnnounceMatch(MyTest):
         self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
 
         # Neither player checks in.
-        match_call_message.reactions = [_reaction(emoji)]
-        util.get_user_ids = lambda _: _future({})
-        output_channel.fetch_message.return_value = match_call_message
 
         # 1. Both players should be warned.
         output_channel.send.reset_mock()
         time.sleep(warn_timer_in_secs)
         _wait_for(bot.check_matches())
-        output_channel.fetch_message.assert_called_with(match_call_message.id)
-        self.assertGreaterEqual(output_channel.send.call_count, 2)
-        self.assertIn(f"<@!{p1_discord_id}>", output_channel.send.call_args_list[0][0][0])
-        self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args_list[1][0][0])
+        # Who checked in is already known, so discord isn't asked.
+        output_channel.fetch_message.assert_not_called()
+        # Both warnings fit in one message.
+        output_channel.send.assert_called_once()
+        self.assertIn(f"<@!{p1_discord_id}>", output_channel.send.call_args[0][0])
+        self.assertIn(f"<@!{p2_discord_id}>", output_channel.send.call_args[0][0])
 
         # Nobody should have been DQ'd yet.
         mock_challonge.set_score.assert_not_called()
@@ -407,6 +686,144 @@ class TestAnnounceMatch(MyTest):
         output_channel.send.assert_not_called()
 
 
+class TestBracketIndexes(MyTest):
+    def test_polling_does_not_rescan_state(self):
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(
+            return_value={f"player{i}": f"challonge-{i}" for i in range(4)})
+        mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[
+            challonge.Match("match-1", "challonge-0", "challonge-1"),
+            challonge.Match("match-2", "challonge-2", "challonge-3"),
+        ])
+        state = self.closing(persistent.State("arbitraryID12"))
+        bracket = self.closing(Bracket(mock_challonge, state))
+        bracket.create_players({i: f"player{i}" for i in range(4)})
+
+        with unittest.mock.patch.object(persistent.State, 'known_matches',
+                                        new_callable=unittest.mock.PropertyMock) as known_matches, \
+                unittest.mock.patch.object(persistent.State, 'players',
+                                           new_callable=unittest.mock.PropertyMock) as players:
+            open_matches = bracket.fetch_open_matches()
+            open_matches[0].call_time = datetime.now()
+            bracket.save_metadata(open_matches[0])
+            bracket.fetch_open_matches()
+            known_matches.assert_not_called()
+            players.assert_not_called()
+
+        self.assertEqual(2, bracket.player_by_discord_id(2).discord_id)
+        self.assertEqual("challonge-3", bracket.player_by_challonge_id("challonge-3").challonge_id)
+        self.assertIs(open_matches[0], bracket.match_by_challonge_id("match-1"))
+        self.assertTrue(bracket.is_open("match-2"))
+
+        # The indexes match what was saved.
+        resumed = self.closing(Bracket(mock_challonge, persistent.State("arbitraryID12")))
+        self.assertIsNotNone(resumed.match_by_challonge_id("match-1").call_time)
+        self.assertEqual(bracket.players, resumed.players)
+
+    def test_polls_return_what_changed(self):
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(
+            return_value={f"player{i}": f"challonge-{i}" for i in range(6)})
+        mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[
+            challonge.Match("match-1", "challonge-0", "challonge-1"),
+            challonge.Match("match-2", "challonge-2", "challonge-3"),
+        ])
+        state = self.closing(persistent.State("arbitraryID12"))
+        bracket = self.closing(Bracket(mock_challonge, state))
+        bracket.create_players({i: f"player{i}" for i in range(6)})
+
+        diff = bracket.poll_open_matches()
+        self.assertEqual(["match-1", "match-2"], [m.challonge_id for m in diff.opened])
+        self.assertEqual([], diff.closed + diff.unchanged)
+
+        # Nothing changed, so nothing is written.
+        written = state.bytes_written
+        diff = bracket.poll_open_matches()
+        self.assertFalse(diff.changed)
+        self.assertEqual(["match-1", "match-2"], [m.challonge_id for m in diff.unchanged])
+        self.assertEqual(written, state.bytes_written)
+
+        mock_challonge.list_matches.return_value = [
+            challonge.Match("match-2", "challonge-2", "challonge-3"),
+            challonge.Match("match-3", "challonge-4", "challonge-5"),
+        ]
+        diff = bracket.poll_open_matches()
+        self.assertEqual((["match-3"], ["match-1"], ["match-2"]),
+                         tuple([m.challonge_id for m in ms] for ms in (diff.opened, diff.closed, diff.unchanged)))
+        self.assertTrue(bracket.last_poll_changed)
+
+        mock_challonge.list_matches.return_value = None
+        self.assertEqual(["match-2", "match-3"], [m.challonge_id for m in bracket.poll_open_matches().unchanged])
+
+
+class TestAsyncBracket(MyTest):
+    def test_blocking_calls_run_off_the_event_loop(self):
+        threads_used = []
+
+        def list_matches(*_, **__):
+            threads_used.append(threading.current_thread())
+            return []
+
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.list_matches = list_matches
+        b = AsyncBracket(self.closing(Bracket(mock_challonge, persistent.State("arbitraryID12"))))
+
+        _wait_for(b.fetch_open_matches())
+
+        self.assertEqual(1, len(threads_used))
+        self.assertIsNot(threading.main_thread(), threads_used[0])
+
+    def test_mutations_are_serialized(self):
+        in_flight = []
+        max_in_flight = []
+
+        def add_players(_, names):
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            in_flight.pop()
+            return {n: f'challonge-{n}' for n in names}
+
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = add_players
+        b = AsyncBracket(self.closing(Bracket(mock_challonge, persistent.State("arbitraryID12"))))
+
+        async def add_concurrently():
+            await asyncio.gather(*[b.create_players({i: f'player{i}'}) for i in range(4)])
+
+        _wait_for(add_concurrently())
+
+        self.assertEqual(4, len(b.players))
+        self.assertEqual(1, max(max_in_flight))
+
+    def test_scores_dont_wait_behind_polls(self):
+        polls_released = threading.Event()
+
+        def list_matches(*_, **__):
+            polls_released.wait(5)
+            return []
+
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.list_matches = list_matches
+        polling_brackets = [AsyncBracket(self.closing(Bracket(mock_challonge, persistent.State(f"polling{i}"))))
+                            for i in range(bracket.BLOCKING_IO_WORKERS)]
+        b = AsyncBracket(self.closing(Bracket(mock_challonge, persistent.State("arbitraryID12"))))
+        match = data.new_match(data.new_player(1, 'p1'), data.new_player(2, 'p2'), 'match-1')
+
+        async def report_during_polls():
+            # Every tournament's poll is stuck waiting on challonge.
+            polls = [asyncio.ensure_future(p.poll_open_matches()) for p in polling_brackets]
+            try:
+                self.assertEqual([None], await asyncio.wait_for(b.save_scores([(match, 2, 0)]), 2))
+            finally:
+                polls_released.set()
+                await asyncio.gather(*polls)
+
+        _wait_for(report_during_polls())
+
+        mock_challonge.set_score.assert_called_once_with("arbitraryID12", 'match-1', 2, 0, 'p1')
+
+
 class TestReloadsState(MyTest):
     def test_resumes_main_state(self):
         main._save_state("some_tournament_id", 1234)
@@ -430,27 +847,1306 @@ class TestReloadsState(MyTest):
             data.new_player(1, "arbitrary-id2"),
             match_id)
         m.call_time = datetime.now()
-        s = persistent.State(tourney_id, tourney_link)
+        s = self.closing(persistent.State(tourney_id, tourney_link))
         s.set_matches([m])
 
         # pretend we crashed
 
-        new_s = persistent.State(tourney_id)  # Same tourney ID as before.
+        new_s = self.closing(persistent.State(tourney_id))  # Same tourney ID as before.
         self.assertEqual(1, len(new_s.known_matches))
         self.assertIsNotNone(new_s.known_matches[0].call_time)
         self.assertEqual(tourney_link, new_s.bracket_link)
 
+    def test_updating_a_match_only_writes_that_match(self):
+        players = [data.new_player(i, f"challonge-{i}") for i in range(512)]
+        matches = [data.new_match(players[i], players[i + 1], f"match-{i}") for i in range(0, 512, 2)]
+        s = self.closing(persistent.State("arbitrary-tourney-id"))
+        s.add_players(players)
+        s.set_matches(matches)
+
+        before = s.bytes_written
+        matches[7].call_time = datetime.now()
+        s.update_matches([matches[7]])
+        self.assertLess(s.bytes_written - before, 1024)
+
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual(256, len(new_s.known_matches))
+        self.assertIsNotNone(new_s.known_matches[7].call_time)
+        # Replayed matches point at the same player objects as the player list.
+        self.assertIs(new_s.players[14], new_s.known_matches[7].p1)
+
+    def test_ignores_partially_written_journal_record(self):
+        s = self.closing(persistent.State("arbitrary-tourney-id"))
+        s.set_admin(1)
+        m = data.new_match(data.new_player(0, "id1"), data.new_player(1, "id2"), "match")
+        s.update_matches([m])
+
+        # Pretend we crashed half way through writing a record.
+        with open(f'{BACKUP_DIR}/arbitrary-tourney-id.journal', 'ab') as journal:
+            journal.write(b'\x00\x00\x01\x00garbage')
+
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual(1, new_s.admin_id)
+        self.assertEqual(1, len(new_s.known_matches))
+
+        # Changes made after recovering are not lost behind the garbage.
+        new_s.set_admin(2)
+        self.assertEqual(2, self.closing(persistent.State("arbitrary-tourney-id")).admin_id)
+
+    def test_keeps_journaling_after_close(self):
+        s = self.closing(persistent.State("arbitrary-tourney-id"))
+        s.set_admin(1)
+        s.update_matches([data.new_match(data.new_player(0, "id1"), data.new_player(1, "id2"), "match")])
+        s.close()
+
+        s.set_admin(2)
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual(2, new_s.admin_id)
+        self.assertEqual(1, len(new_s.known_matches))
+
+    def test_compacts_journal(self):
+        compact_after = persistent.COMPACT_AFTER_RECORDS
+        persistent.COMPACT_AFTER_RECORDS = 5
+        try:
+            s = self.closing(persistent.State("arbitrary-tourney-id", "challonge.com/arbitrary-link"))
+            for i in range(12):
+                s.set_admin(i)
+        finally:
+            persistent.COMPACT_AFTER_RECORDS = compact_after
+
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual(11, new_s.admin_id)
+        self.assertEqual("challonge.com/arbitrary-link", new_s.bracket_link)
+
     def test_resumes_players(self):
-        s = persistent.State("arbitrary-tourney-id")
+        s = self.closing(persistent.State("arbitrary-tourney-id"))
         p = data.Player(123, "challonge_id", 1)
         s.add_players([p])
 
         # pretend we crashed, this is the "reloaded" one.
-        new_s = persistent.State("arbitrary-tourney-id")
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
 
         self.assertEqual(1, len(new_s.players))
         self.assertEqual(p, new_s.players[0])
 
+    def test_snapshot_refers_to_players_by_key(self):
+        players = [data.new_player(i, f"challonge-{i}") for i in range(4)]
+        matches = [data.new_match(players[0], players[1], "match-0"), data.new_match(players[1], players[2], "match-1")]
+        compact_after = persistent.COMPACT_AFTER_RECORDS
+        persistent.COMPACT_AFTER_RECORDS = 2
+        try:
+            s = self.closing(persistent.State("arbitrary-tourney-id"))
+            s.add_players(players)
+            s.set_matches(matches)
+        finally:
+            persistent.COMPACT_AFTER_RECORDS = compact_after
+
+        with open(f'{BACKUP_DIR}/arbitrary-tourney-id', 'rb') as f:
+            snapshot = pickle.load(f)
+        self.assertEqual(players[1].key_id, snapshot[persistent._MATCHES][1][2])
+
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual(matches, new_s.known_matches)
+        self.assertIs(new_s.players[1], new_s.known_matches[0].p2)
+        self.assertIs(new_s.players[1], new_s.known_matches[1].p1)
+
+    def test_reads_snapshots_of_whole_objects(self):
+        # Snapshots used to hold Match objects, each with its own copy of the players.
+        players = [data.new_player(i, f"challonge-{i}") for i in range(2)]
+        m = data.new_match(data.Player(0, "challonge-0", players[0].key_id),
+                           data.Player(1, "challonge-1", players[1].key_id), "match")
+        with open(f'{BACKUP_DIR}/arbitrary-tourney-id', 'wb') as f:
+            pickle.dump({persistent._MATCHES: [m], persistent._PLAYERS: players,
+                         persistent._ADMIN: 1, persistent._LINK: "link"}, f)
+
+        new_s = self.closing(persistent.State("arbitrary-tourney-id"))
+        self.assertEqual([m], new_s.known_matches)
+        self.assertIs(new_s.players[0], new_s.known_matches[0].p1)
+
+    def test_unpickles_players_from_before_slots(self):
+        p = data.Player.__new__(data.Player)
+        p.__setstate__({'discord_id': 1, 'challonge_id': "challonge-1", 'key_id': 2})
+        self.assertEqual(data.Player(1, "challonge-1", 2), p)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_routes_by_guild_and_channel(self):
+        r = registry.Registry()
+        r.add(1, 10, "tourney-a", "a")
+        r.add(1, 11, "tourney-b", "b")
+        r.add(2, 10, "tourney-c", "c")
+
+        self.assertEqual("a", r.get(1, 10))
+        self.assertEqual("b", r.get(1, 11))
+        self.assertEqual("c", r.get(2, 10))
+        self.assertIsNone(r.get(2, 11))
+        self.assertEqual("b", r.get_by_tourney_id("tourney-b"))
+
+        # Only one tournament per channel.
+        with self.assertRaises(ValueError):
+            r.add(1, 10, "tourney-d", "d")
+
+        r.remove("tourney-a")
+        self.assertIsNone(r.get(1, 10))
+        self.assertEqual(2, len(r))
+
+    def test_one_failing_tournament_does_not_stop_the_others(self):
+        r = registry.Registry()
+        for i in range(3):
+            r.add(None, i, f"tourney-{i}", i)
+        polled = []
+
+        async def poll(t):
+            if t == 1:
+                raise RuntimeError("challonge is down, or something")
+            polled.append(t)
+
+        _wait_for(registry.PollScheduler(r, poll, lambda _: 10).poll_all())
+        self.assertEqual([0, 2], sorted(polled))
+
+
+class TestDeadlineHeap(unittest.TestCase):
+    def test_pops_only_due_deadlines_in_order(self):
+        now = datetime.now()
+        h = timers.DeadlineHeap()
+        h.schedule("t", "m1", timers.Deadline.DQ, now + timedelta(minutes=10))
+        h.schedule("t", "m1", timers.Deadline.WARN, now + timedelta(minutes=5))
+        h.schedule("t", "m2", timers.Deadline.DQ, now - timedelta(minutes=1))
+        h.schedule("t", "m2", timers.Deadline.WARN, now - timedelta(minutes=1))
+
+        # Ties go to the warning.
+        self.assertEqual([("t", "m2", timers.Deadline.WARN), ("t", "m2", timers.Deadline.DQ)], h.pop_due(now))
+        self.assertEqual(now + timedelta(minutes=5), h.next_deadline())
+        self.assertEqual([("t", "m1", timers.Deadline.WARN)], h.pop_due(now + timedelta(minutes=5)))
+        self.assertEqual(1, len(h))
+
+    def test_cancel_and_reschedule(self):
+        now = datetime.now()
+        h = timers.DeadlineHeap()
+        h.schedule("t", "m1", timers.Deadline.WARN, now)
+        h.schedule("t", "m2", timers.Deadline.WARN, now)
+        h.schedule("t", "m2", timers.Deadline.DQ, now)
+        h.cancel("t", "m2")
+        h.schedule("t", "m1", timers.Deadline.WARN, now + timedelta(minutes=1))
+
+        self.assertEqual([], h.pop_due(now))
+        self.assertEqual([("t", "m1", timers.Deadline.WARN)], h.pop_due(now + timedelta(minutes=1)))
+        self.assertIsNone(h.next_deadline())
+
+
+class TestAdaptivePoller(unittest.TestCase):
+    def test_backs_off_while_nothing_changes(self):
+        p = polling.AdaptivePoller(base_interval_in_secs=10, min_interval_in_secs=2, max_interval_in_secs=60,
+                                   backoff_factor=2)
+        self.assertEqual(10, p.interval)
+
+        now = 0
+        for expected in [20, 40, 60, 60]:
+            p.record_poll(changed=False, not_modified=True, now=now)
+            self.assertEqual(expected, p.interval)
+            now += p.interval
+
+        # Between 0 and 120 seconds we'd normally have polled 13 times, but we only polled 4 times.
+        # All of those were answered with 304s.
+        self.assertEqual(9, p.requests_skipped)
+        self.assertEqual(4, p.responses_not_modified)
+        self.assertEqual(9 + 4, p.requests_saved)
+
+        # Something changed, go back to normal.
+        p.record_poll(changed=True, now=now)
+        self.assertEqual(10, p.interval)
+
+        # We just did something, so check back soon.
+        p.tighten()
+        self.assertEqual(2, p.interval)
+
+    def test_only_relies_on_push_notifications_while_they_arrive(self):
+        p = polling.PushAwarePoller(safety_net_interval_in_secs=120, base_interval_in_secs=10)
+        p.record_poll(changed=True)
+        # We could be told about changes, but haven't been yet.
+        self.assertFalse(p.pushed)
+        self.assertEqual(10, p.interval)
+
+        p.record_push()
+        p.record_poll(changed=True)
+        self.assertTrue(p.pushed)
+        self.assertEqual(120, p.interval)
+        p.record_poll(changed=False)
+        self.assertEqual(120, p.interval)
+
+        # Something changed that we weren't told about.
+        p.record_poll(changed=True)
+        self.assertFalse(p.pushed)
+        self.assertEqual(10, p.interval)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_refills_over_time(self):
+        now = [0.0]
+        bucket = ratelimit.TokenBucket(rate_per_sec=2, capacity=3, clock=lambda: now[0])
+        self.assertTrue(all(bucket.try_acquire() for _ in range(3)))
+        self.assertFalse(bucket.try_acquire())
+        self.assertEqual(0.5, bucket.seconds_until_available())
+
+        now[0] = 0.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+        # Never holds more than its capacity.
+        now[0] = 100
+        self.assertEqual(3, bucket.tokens)
+
+
+class TestPriorityLimiter(unittest.TestCase):
+    def test_urgent_lanes_go_first(self):
+        limiter = ratelimit.PriorityLimiter(ratelimit.TokenBucket(rate_per_sec=50, capacity=1))
+        order = []
+
+        async def request(name):
+            order.append(name)
+
+        async def run():
+            polls = [asyncio.ensure_future(limiter.run(challonge.Lane.POLL, request(f"poll-{i}"))) for i in range(3)]
+            await asyncio.sleep(0)
+            write = asyncio.ensure_future(limiter.run(challonge.Lane.WRITE, request("write")))
+            await asyncio.sleep(0)
+            self.assertEqual(2, limiter.queue_depth(challonge.Lane.POLL))
+            self.assertEqual(1, limiter.queue_depth(challonge.Lane.WRITE))
+            await asyncio.gather(write, *polls)
+
+        _wait_for(run())
+        # The first poll had the only token, but the write cuts ahead of the rest.
+        self.assertEqual(["poll-0", "write", "poll-1", "poll-2"], order)
+        self.assertEqual(0, limiter.queue_depth())
+
+    def test_giving_up_leaves_the_queue(self):
+        limiter = ratelimit.PriorityLimiter(ratelimit.TokenBucket(rate_per_sec=1, capacity=1))
+
+        async def run():
+            await limiter.run(0, asyncio.sleep(0))
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(limiter.run(0, asyncio.sleep(0)), 0.01)
+
+        _wait_for(run())
+        self.assertEqual(0, limiter.queue_depth())
+
+    def test_clients_share_a_limit_per_api_key(self):
+        a, b, c = challonge.Client("key-1"), challonge.Client("key-1"), challonge.Client("key-2")
+        self.assertIs(a._limiter, b._limiter)
+        self.assertIsNot(a._limiter, c._limiter)
+        self.assertEqual({lane: 0 for lane in challonge.Lane}, a.queue_depths())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_repeated_failures_and_recovers(self):
+        now = [0.0]
+        breaker = resilience.CircuitBreaker(failure_threshold=2, reset_timeout_in_secs=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEqual(resilience.CircuitState.OPEN, breaker.state)
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(10, breaker.retry_in_secs())
+
+        # Still broken on trial, so it waits twice as long.
+        now[0] = 10
+        self.assertEqual(resilience.CircuitState.HALF_OPEN, breaker.state)
+        breaker.record_failure()
+        self.assertEqual(20, breaker.retry_in_secs())
+
+        now[0] = 30
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(resilience.CircuitState.CLOSED, breaker.state)
+
+    def test_lets_one_request_through_on_trial_at_a_time(self):
+        now = [0.0]
+        breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout_in_secs=10, clock=lambda: now[0])
+        breaker.record_failure()
+
+        now[0] = 10
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        # The trial never found out whether things recovered, so the next request gets to try.
+        breaker.record_inconclusive()
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
+
+
+class TestChallongeResilience(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake = fake_challonge.FakeChallonge().start()
+        self.real_api, self.real_delay = challonge.CHALLONGE_API, challonge.RETRY_BASE_DELAY_IN_SECS
+        challonge.CHALLONGE_API = self.fake.url
+        challonge.RETRY_BASE_DELAY_IN_SECS = 0.01
+        # Every API key gets its own circuit breakers, so don't share them between tests.
+        self.client = challonge.Client(str(uuid.uuid4()))
+        self.tourney_id, _ = self.client.create_tournament("tourney")
+        self.requests = self.fake.requests
+        self.requests.clear()
+
+    def tearDown(self):
+        challonge.CHALLONGE_API, challonge.RETRY_BASE_DELAY_IN_SECS = self.real_api, self.real_delay
+        self.fake.stop()
+        super().tearDown()
+
+    def test_retries_idempotent_requests(self):
+        self.fake.fail_next(503, 502)
+        self.assertEqual([], self.client.list_matches(self.tourney_id))
+        self.assertEqual(3, len(self.requests))
+
+    def test_does_not_retry_other_requests(self):
+        self.fake.fail_next(503)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.add_players(self.tourney_id, ["Alice"])
+        self.assertEqual(1, len(self.requests))
+
+    def test_does_not_retry_rejected_requests(self):
+        self.fake.fail_next(404)
+        with self.assertRaises(challonge.RequestRejected) as e:
+            self.client.list_matches(self.tourney_id)
+        self.assertEqual(404, e.exception.status)
+        self.assertEqual(1, len(self.requests))
+
+    def test_stops_sending_requests_while_challonge_is_down(self):
+        self.fake.fail_next(*[500] * resilience.FAILURE_THRESHOLD)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.list_matches(self.tourney_id)
+        with self.assertRaises(challonge.ChallongeUnavailable) as e:
+            self.client.list_matches(self.tourney_id)
+        self.assertGreater(e.exception.retry_in_secs, 0)
+        self.assertEqual(resilience.CircuitState.OPEN, self.client.circuit_state(self.tourney_id))
+
+        # The breaker opened part way through the second call, so it stopped retrying.
+        self.assertEqual(resilience.FAILURE_THRESHOLD, len(self.requests))
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.set_score(self.tourney_id, "match", 1, 0, "winner")
+        self.assertEqual(resilience.FAILURE_THRESHOLD, len(self.requests))
+
+    def test_trouble_with_one_tournament_does_not_stop_the_others(self):
+        self.fake.fail_next(*[500] * resilience.FAILURE_THRESHOLD)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.list_matches(self.tourney_id)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.list_matches(self.tourney_id)
+        self.assertEqual(resilience.CircuitState.OPEN, self.client.circuit_state(self.tourney_id))
+
+        self.assertEqual(resilience.CircuitState.CLOSED, self.client.circuit_state())
+        other_id, _ = self.client.create_tournament("other tourney")
+        self.assertEqual([], self.client.list_matches(other_id))
+
+    def test_rate_limiting_stops_every_tournament(self):
+        self.fake.fail_next(*[429] * resilience.FAILURE_THRESHOLD)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.list_matches(self.tourney_id)
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            self.client.list_matches(self.tourney_id)
+        self.assertEqual(resilience.CircuitState.OPEN, self.client.circuit_state())
+
+    def test_caches_player_names_until_players_change(self):
+        self.client.list_player_names_by_id(self.tourney_id)
+        self.client.list_player_names_by_id(self.tourney_id)
+        self.assertEqual(1, len(self.requests))
+
+        self.client.add_players(self.tourney_id, ["Alice"])
+        self.client.list_player_names_by_id(self.tourney_id)
+        self.assertEqual(3, len(self.requests))
+
+
+class TestFakeChallonge(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.real_api = challonge.CHALLONGE_API
+
+    def tearDown(self):
+        challonge.CHALLONGE_API = self.real_api
+        super().tearDown()
+
+    def start(self, **kwargs) -> challonge.Client:
+        fake = fake_challonge.FakeChallonge(**kwargs).start()
+        self.addCleanup(fake.stop)
+        challonge.CHALLONGE_API = fake.url
+        return challonge.Client(str(uuid.uuid4()), requests_per_sec=1000)
+
+    def test_plays_out_double_elimination(self):
+        client = self.start()
+        tourney_id, _ = client.create_tournament("tourney")
+        client.add_players(tourney_id, [f'Player {i}' for i in range(13)])
+
+        losses = collections.Counter()
+        while matches := client.list_matches(tourney_id):
+            for m in matches:
+                self.assertLess(losses[m.p1_id], 2)
+                self.assertLess(losses[m.p2_id], 2)
+                client.set_score(tourney_id, m.id, 0, 2, m.p2_id)
+                losses[m.p1_id] += 1
+
+        # Everyone but the winner is out after two losses.
+        self.assertEqual(12, list(losses.values()).count(2))
+        self.assertEqual(12 * 2 + 1, sum(losses.values()))
+
+    def test_plays_out_swiss(self):
+        client = self.start()
+        tourney_id, _ = client.create_tournament("tourney", challonge.TourneyType.SWISS)
+        client.add_players(tourney_id, [f'Player {i}' for i in range(9)])
+
+        played = []
+        rounds = 0
+        while matches := client.list_matches(tourney_id):
+            rounds += 1
+            # Everyone but the player with a bye plays each round.
+            self.assertEqual(4, len(matches))
+            for m in matches:
+                client.set_score(tourney_id, m.id, 2, 0, m.p1_id)
+                played.append(frozenset((m.p1_id, m.p2_id)))
+
+        self.assertEqual(4, rounds)
+        self.assertEqual(len(played), len(set(played)))
+
+    def test_tells_us_when_open_matches_are_unchanged(self):
+        client = self.start()
+        tourney_id, _ = client.create_tournament("tourney")
+        client.add_players(tourney_id, ["Alice", "Bob"])
+
+        self.assertEqual(1, len(client.list_matches(tourney_id, if_changed=True)))
+        self.assertIsNone(client.list_matches(tourney_id, if_changed=True))
+
+    def test_responds_with_429_over_its_rate_limit(self):
+        # Slow enough that retrying won't help.
+        client = self.start(requests_per_sec=0.1)
+        tourney_id, _ = client.create_tournament("tourney")
+        with self.assertRaises(challonge.ChallongeUnavailable):
+            client.list_matches(tourney_id)
+
+
+class TestWebhooks(MyTest):
+    def test_only_accepts_each_genuine_notification_once(self):
+        received = []
+        receiver = webhooks.Receiver("secret", received.append)
+        body = json.dumps({"id": "n1", "tournament_id": 12, "match_id": 34, "state": "open"}).encode()
+
+        self.assertEqual(401, receiver.handle(body, webhooks.sign("not the secret", body)))
+        self.assertEqual(401, receiver.handle(body, ""))
+        self.assertEqual(400, receiver.handle(b"{}", webhooks.sign("secret", b"{}")))
+        self.assertEqual(200, receiver.handle(body, webhooks.sign("secret", body)))
+        self.assertEqual(200, receiver.handle(body, webhooks.sign("secret", body)))
+        self.assertEqual([webhooks.Notification("n1", "12", "34", "open")], received)
+
+    def test_rejects_requests_without_a_usable_length(self):
+        server = webhooks.serve(webhooks.Receiver("secret", lambda n: None), 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        def status_of(headers):
+            with socket.create_connection(('127.0.0.1', server.server_port), timeout=5) as conn:
+                conn.sendall(f'POST {webhooks.PATH} HTTP/1.1\r\nHost: localhost\r\n{headers}\r\n'.encode())
+                return int(conn.recv(1024).split()[1])
+
+        self.assertEqual(400, status_of(''))
+        self.assertEqual(400, status_of('Content-Length: lots\r\n'))
+        self.assertEqual(400, status_of('Content-Length: -1\r\n'))
+        self.assertEqual(413, status_of(f'Content-Length: {webhooks.MAX_BODY_BYTES + 1}\r\n'))
+
+    def test_calls_matches_as_soon_as_we_are_told_they_opened(self):
+        real_api = challonge.CHALLONGE_API
+        self.addCleanup(setattr, challonge, 'CHALLONGE_API', real_api)
+        received = []
+
+        def on_notification(n: webhooks.Notification):
+            received.append(n)
+            bot.notify_threadsafe(n)
+
+        server = webhooks.serve(webhooks.Receiver("secret", on_notification), 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        fake = fake_challonge.FakeChallonge(webhook_url=f"http://127.0.0.1:{server.server_port}{webhooks.PATH}",
+                                            webhook_secret="secret").start()
+        self.addCleanup(fake.stop)
+        challonge.CHALLONGE_API = fake.url
+
+        client = challonge.Client(str(uuid.uuid4()), requests_per_sec=1000)
+        tourney_id, _ = client.create_tournament("tourney")
+        bracket = self.closing(Bracket(client, persistent.State(tourney_id)))
+        bracket.create_players({i: f"Player {i}" for i in range(1, 5)})
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.send.return_value.id = 6942096
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel, options=main.Options(push_notifications=True))
+
+        async def wait_for_sends(n):
+            while output_channel.send.call_count < n:
+                await asyncio.sleep(0.01)
+
+        async def wait_for_notifications(n):
+            while len({n.match_id for n in received if n.tourney_id == str(tourney_id)}) < n:
+                await asyncio.sleep(0.01)
+
+        async def play():
+            bot._loop = asyncio.get_running_loop()
+            bot._ensure_polling()
+            try:
+                # Both first round matches are called on the first poll.
+                await asyncio.wait_for(wait_for_sends(1), 5)
+                for m in fake.tournaments[tourney_id].open_matches():
+                    fake.report(tourney_id, m.id, m.players[0])
+                # The next matches are called long before the next poll would have found them.
+                await asyncio.wait_for(wait_for_sends(2), 5)
+                # Two matches closed and two opened.
+                await asyncio.wait_for(wait_for_notifications(4), 5)
+            finally:
+                bot._polling_task.cancel()
+                bot._deadline_task.cancel()
+
+        poller = next(iter(bot._tournaments)).poller
+        # Nobody has told us anything yet, so we poll as usual.
+        self.assertFalse(poller.pushed)
+        self.assertEqual(polling.BASE_POLLING_INTERVAL_IN_SECS, poller.interval)
+        _wait_for(play())
+        self.assertEqual(2, output_channel.send.call_count)
+        self.assertEqual(2, output_channel.send.call_args[0][0].count("your match has been called!"))
+        self.assertTrue(poller.pushed)
+        self.assertEqual(polling.SAFETY_NET_POLLING_INTERVAL_IN_SECS, poller.interval)
+
+
+class TestMetrics(MyTest):
+    def test_renders_prometheus_text(self):
+        counter = metrics.Counter('test_requests', 'Requests.', ['status'])
+        counter.inc(status='200')
+        counter.inc(2, status='200')
+        histogram = metrics.Histogram('test_seconds', 'Latency.', buckets=(0.1, 1))
+        histogram.observe(0.5)
+        gauge = metrics.Gauge('test_open', 'Open things.')
+        gauge.set_function(lambda: 7)
+
+        text = metrics.render()
+        self.assertIn('# TYPE test_requests_total counter\ntest_requests_total{status="200"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0\ntest_seconds_bucket{le="1"} 1\n'
+                      'test_seconds_bucket{le="+Inf"} 1\ntest_seconds_sum 0.5\ntest_seconds_count 1\n', text)
+        self.assertIn('test_open 7\n', text)
+
+    def test_publishes_what_the_bot_is_running_after_each_poll(self):
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot))
+        for i in range(2):
+            mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+            mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002"})
+            mock_challonge.list_matches = unittest.mock.MagicMock(
+                return_value=[challonge.Match(f"match-{i}", "1001", "1002")])
+            bracket = self.closing(Bracket(mock_challonge, persistent.State(f"tourney-{i}")))
+            bracket.create_players({2 * i: "Alice", 2 * i + 1: "Bob"})
+            channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+            channel.send.return_value.id = 1234
+            bot.resume(bracket, 4206969 + i, channel)
+
+        _wait_for(bot.check_matches())
+
+        # Set by the event loop, so the metrics server's thread only ever reads the numbers.
+        self.assertEqual(2, main.TOURNAMENTS.value())
+        self.assertEqual(2, main.OPEN_MATCHES.value())
+        self.assertEqual(2, main.PENDING_DEADLINES.value(kind='dq'))
+        self.assertIn('open_matches 2\n', metrics.render())
+
+    def test_counts_challonge_calls(self):
+        real_api = challonge.CHALLONGE_API
+        self.addCleanup(setattr, challonge, 'CHALLONGE_API', real_api)
+        with fake_challonge.FakeChallonge() as fake:
+            challonge.CHALLONGE_API = fake.url
+            client = challonge.Client(str(uuid.uuid4()))
+            before = challonge.CALLS.value(method='create_tournament', outcome='ok')
+            client.create_tournament("tourney")
+
+        self.assertEqual(before + 1, challonge.CALLS.value(method='create_tournament', outcome='ok'))
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as resp:
+            self.assertIn('challonge_call_seconds_count{method="create_tournament"}', resp.read().decode())
+
+
+class TestRegistration(MyTest):
+    def setUp(self):
+        super().setUp()
+        self.fake = fake_challonge.FakeChallonge().start()
+        self.addCleanup(self.fake.stop)
+        real_api = challonge.CHALLONGE_API
+        self.addCleanup(setattr, challonge, 'CHALLONGE_API', real_api)
+        challonge.CHALLONGE_API = self.fake.url
+        client = challonge.Client(str(uuid.uuid4()), requests_per_sec=1000)
+        tourney_id, _ = client.create_tournament("tourney")
+        self.bracket = self.closing(Bracket(client, persistent.State(tourney_id)))
+        self.names = {i: f'Player {i}' for i in range(1, 26)}
+
+    def participant_names(self):
+        return sorted(p['name'] for p in self.fake.tournaments[int(self.bracket.tourney_id)].participants.values())
+
+    def test_collects_everyone_who_reacted_once(self):
+        def reaction(*user_ids):
+            r = unittest.mock.MagicMock(spec=discord.Reaction)
+            r.users.return_value = _async_iter([unittest.mock.MagicMock(id=i) for i in user_ids])
+            return r
+
+        names = _wait_for(registration.collect_reactors([reaction(1, 2), reaction(2, 3)], lambda u: f'User {u.id}'))
+        self.assertEqual({1: 'User 1', 2: 'User 2', 3: 'User 3'}, names)
+
+    def test_adds_players_in_chunks(self):
+        progress = []
+
+        async def on_progress(done, total):
+            progress.append((done, total))
+
+        with unittest.mock.patch.object(registration, 'CHUNK_SIZE', 10):
+            _wait_for(registration.add_players(AsyncBracket(self.bracket), self.names, on_progress))
+        self.assertEqual([(10, 25), (20, 25), (25, 25)], progress)
+        self.assertEqual(sorted(self.names.values()), self.participant_names())
+
+    def test_picks_up_where_a_failed_chunk_left_off(self):
+        b = AsyncBracket(self.bracket)
+        with unittest.mock.patch.object(registration, 'CHUNK_SIZE', 10):
+            # Challonge goes down while adding the second chunk.
+            self.fake.fail_next(None, None, 503)
+            with self.assertRaises(challonge.ChallongeUnavailable):
+                _wait_for(registration.add_players(b, self.names))
+            self.assertEqual(10, len(self.bracket.players))
+
+            added = _wait_for(registration.add_players(b, self.names))
+        self.assertEqual(15, len(added))
+        self.assertEqual(sorted(self.names.values()), self.participant_names())
+
+    def test_recovers_players_challonge_added_without_telling_us(self):
+        self.bracket._challonge_client.add_players(self.bracket.tourney_id, ['Player 1', 'Player 2'])
+        recovered = self.bracket.recover_players({1: 'Player 1', 3: 'Player 3'})
+        self.assertEqual([1], [p.discord_id for p in recovered])
+        self.assertIsNotNone(self.bracket.player_by_discord_id(1))
+
+
+class TestProfiling(MyTest):
+    def test_samples_other_threads(self):
+        stop = threading.Event()
+
+        def spin_until_stopped():
+            while not stop.is_set():
+                pass
+
+        threading.Thread(target=spin_until_stopped, name='spinner').start()
+        try:
+            stacks = profiling.collapse(profiling.sample_stacks(0.1))
+        finally:
+            stop.set()
+        self.assertRegex(stacks, r'(?m)^spinner;.*;spin_until_stopped \(test.py:\d+\)(;.*)? \d+$')
+
+    def test_reports_where_memory_was_allocated(self):
+        kept = []
+        threading.Timer(0.05, lambda: kept.append(bytearray(10 ** 6))).start()
+        self.assertRegex(profiling.allocation_diff(0.2), r'test.py:\d+: size=\d+ KiB')
+
+    def test_only_profiles_for_the_admin(self):
+        state = self.closing(persistent.State("arbitraryID12"))
+        state.set_admin(1)
+        channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot),
+                              Bracket(unittest.mock.MagicMock(spec=challonge.Client), state), channel.id, channel)
+        ctx = unittest.mock.MagicMock(guild=channel.guild, channel=channel)
+        ctx.send = unittest.mock.AsyncMock()
+
+        ctx.author.id = 2
+        _wait_for(bot.profile.callback(bot, ctx, 1))
+        self.assertNotIn('files', ctx.send.call_args.kwargs)
+
+        ctx.author.id = 1
+        _wait_for(bot.profile.callback(bot, ctx, 1, main.PROFILE_BOTH))
+        files = ctx.send.call_args.kwargs['files']
+        self.assertEqual(['allocations', 'stacks'], sorted(f.filename.split('-')[0] for f in files))
+
+    def test_only_profiles_once_at_a_time(self):
+        state = self.closing(persistent.State("arbitraryID12"))
+        state.set_admin(1)
+        channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot),
+                              Bracket(unittest.mock.MagicMock(spec=challonge.Client), state), channel.id, channel)
+        sent = []
+
+        async def slow_send(text, **kwargs):
+            # Gives the other command a chance to run while this one is still saying it started.
+            await asyncio.sleep(0.05)
+            sent.append(text)
+
+        ctx = unittest.mock.MagicMock(guild=channel.guild, channel=channel)
+        ctx.author.id = 1
+        ctx.send = slow_send
+
+        async def profile_twice():
+            await asyncio.gather(bot.profile.callback(bot, ctx, 1), bot.profile.callback(bot, ctx, 1))
+
+        with unittest.mock.patch.object(profiling, 'sample_stacks', return_value={}):
+            _wait_for(profile_twice())
+        self.assertEqual(1, sent.count("Done profiling!"))
+        self.assertIn("Already profiling, try again once that's done.", sent)
+
+        # Profiling can be run again once it's done, even if it failed.
+        ctx.send = unittest.mock.AsyncMock(side_effect=[discord.DiscordException("oops"), None, None])
+        with self.assertRaises(discord.DiscordException):
+            _wait_for(bot.profile.callback(bot, ctx, 1))
+        with unittest.mock.patch.object(profiling, 'sample_stacks', return_value={}):
+            _wait_for(bot.profile.callback(bot, ctx, 1))
+        self.assertEqual("Done profiling!", ctx.send.call_args[0][0])
+
+
+class TestMatchGraph(unittest.TestCase):
+    def test_predicts_the_matches_results_open_up(self):
+        for entrants in (16, 13):
+            t = fake_challonge.FakeTournament(1, 'graph', 'graph', challonge.TourneyType.DOUBLE_ELIM.value, True)
+            for i in range(1, entrants + 1):
+                t.participants[i] = {'id': i, 'name': f'Player {i}'}
+            t.start(itertools.count(1))
+            graph = match_graph.MatchGraph(
+                challonge._to_bracket_match(m.to_json()) for m in t.matches.values() if not m.hidden)
+            rng = random.Random(entrants)
+
+            predicted = {m.id for m in graph.open_matches()}
+            while open_matches := t.open_matches():
+                self.assertLessEqual(predicted, {m.id for m in open_matches})
+                if entrants == 16:
+                    # Without byes, everything but a grand final reset is predicted.
+                    self.assertEqual({m.id for m in open_matches if m is not t._grand_final_reset}, predicted)
+                for m in open_matches:
+                    winner = rng.choice(m.players)
+                    t.report(m.id, '2-0', winner)
+                    predicted.discard(m.id)
+                    predicted |= {o.id for o in graph.resolve(m.id, winner)}
+
+    def test_dq_calls_the_match_it_opens_up_right_away(self):
+        mock_challonge = unittest.mock.MagicMock(spec=challonge.Client)
+        mock_challonge.add_players = unittest.mock.MagicMock(return_value={"Alice": "1001", "Bob": "1002",
+                                                                           "Carol": "1003"})
+        mock_challonge.list_matches = unittest.mock.MagicMock(return_value=[challonge.Match("m1", "1001", "1002")])
+        # Once Alice wins, she plays Carol, who already won her first match.
+        mock_challonge.list_all_matches = unittest.mock.MagicMock(return_value=[
+            challonge.BracketMatch("m1", "complete", "1001", "1002", None, None, False, False),
+            challonge.BracketMatch("m2", "complete", "1003", "1004", None, None, False, False),
+            challonge.BracketMatch("m3", "open", "1001", "1003", "m1", "m2", False, False),
+        ])
+        bracket = Bracket(mock_challonge, persistent.State("tourneyID12"))
+        self.addCleanup(bracket.close)
+        bracket.create_players({1: "Alice", 2: "Bob", 3: "Carol"})
+
+        # Bob is due to be DQ'd.
+        m = bracket.fetch_open_matches()[0]
+        m.call_message_id = 6942096
+        m.call_time = datetime.now() - timedelta(minutes=11)
+        m.warn_time = m.call_time + timedelta(minutes=5)
+        m.checked_in_ids = {1}
+        bracket.save_metadata(m)
+
+        output_channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        output_channel.fetch_message.return_value.reactions = [_reaction(main.DEFAULT_CHECK_IN_EMOJI.name)]
+        output_channel.send.return_value.id = 6942097
+        util.get_user_ids = lambda _: _future({1})
+        bot = main.Tournament(unittest.mock.MagicMock(spec=discord.ext.commands.Bot), bracket, 4206969,
+                              output_channel)
+        _wait_for(bot.check_matches())
+
+        # Alice and Carol's match is called without waiting for challonge to list it.
+        mock_challonge.set_score.assert_called_once_with("tourneyID12", "m1", 0, -1, "1001")
+        sent = "".join(c.args[0] for c in output_channel.send.call_args_list)
+        self.assertIn("<@!2>", sent)
+        self.assertIn("<@!1> <@!3> your match has been called!", sent)
+        self.assertIsNotNone(bracket.match_by_challonge_id("m3").call_time)
+        self.assertTrue(bracket.is_open("m3"))
+        self.assertFalse(bracket.is_open("m1"))
+        self.assertEqual(2, bot._deadlines.pending(timers.Deadline.WARN) + bot._deadlines.pending(timers.Deadline.DQ))
+
+
+class TestEngine(unittest.TestCase):
+    def test_round_robin_has_everyone_play_everyone_once(self):
+        b = engine.Engine(challonge.TourneyType.ROUND_ROBIN, itertools.count(1))
+        rng = random.Random(7)
+        played = []
+        open_matches = b.start(list(range(7)))
+        while open_matches:
+            playing = [p for m in open_matches for p in m.players]
+            # Nobody has to be in two places at once.
+            self.assertEqual(len(playing), len(set(playing)))
+            m = rng.choice(open_matches)
+            b.report(m.id, rng.choice(m.players))
+            played.append(frozenset(m.players))
+            open_matches = b.open_matches()
+
+        self.assertTrue(b.finished)
+        self.assertEqual({frozenset(p) for p in itertools.combinations(range(7), 2)}, set(played))
+        self.assertEqual(21, len(played))
+
+    def test_rejects_results_for_matches_that_are_not_open(self):
+        b = engine.Engine(challonge.TourneyType.SINGLE_ELIM, itertools.count(1))
+        first, second = b.start(['a', 'b', 'c', 'd'])
+        final = first.winner_to[0]
+        with self.assertRaises(ValueError):
+            b.report(final.id, 'a')
+        with self.assertRaises(ValueError):
+            b.report(first.id, 'c')
+        b.report(first.id, first.players[0])
+        self.assertEqual([final], b.report(second.id, second.players[1]))
+
+
+class TestLocalBracket(MyTest):
+    def setUp(self):
+        super().setUp()
+        self.fake = fake_challonge.FakeChallonge().start()
+        self.addCleanup(self.fake.stop)
+        real_api = challonge.CHALLONGE_API
+        self.addCleanup(setattr, challonge, 'CHALLONGE_API', real_api)
+        challonge.CHALLONGE_API = self.fake.url
+        self.client = challonge.Client(str(uuid.uuid4()), requests_per_sec=1000)
+        tourney_id, _ = self.client.create_tournament("tourney")
+        self.bracket = self.closing(Bracket(self.client, persistent.State(tourney_id)))
+        self.bracket.create_players({i: f'Player {i}' for i in range(1, 13)})
+        self.bracket.start_locally()
+        # Don't leave syncs running in the background once the test is over.
+        self.addCleanup(self.bracket.wait_for_sync, 5)
+        self.sync()
+
+    def sync(self, bracket: Bracket = None):
+        """Has the bracket sync with challonge, and waits for it to finish."""
+        bracket = bracket or self.bracket
+        bracket.wait_for_sync(5)
+        bracket.poll_open_matches()
+        bracket.wait_for_sync(5)
+
+    def challonge_pairs(self):
+        t = self.fake.tournaments[int(self.bracket.tourney_id)]
+        return {frozenset(m.players) for m in t.open_matches()}
+
+    def local_pairs(self):
+        return {frozenset((m.p1.challonge_id, m.p2.challonge_id)) for m in self.bracket.fetch_open_matches()}
+
+    def test_keeps_going_while_challonge_is_down(self):
+        self.assertEqual(self.local_pairs(), self.challonge_pairs())
+        down = challonge.ChallongeUnavailable('Challonge is down.')
+        with unittest.mock.patch.multiple(self.client, list_matches=unittest.mock.MagicMock(side_effect=down),
+                                          list_all_matches=unittest.mock.MagicMock(side_effect=down),
+                                          set_score=unittest.mock.MagicMock(side_effect=down)):
+            # Two rounds are played without challonge.
+            for _ in range(2):
+                opened = []
+                for m in self.bracket.fetch_open_matches():
+                    opened += self.bracket.save_score(m, 2, 1)
+                self.assertTrue(opened)
+            self.sync()
+            self.assertNotEqual(self.local_pairs(), self.challonge_pairs())
+
+        # Once it's back, challonge catches up.
+        self.sync()
+        self.assertEqual(self.local_pairs(), self.challonge_pairs())
+
+    def test_stops_mirroring_results_challonge_never_catches_up_to(self):
+        client = unittest.mock.MagicMock(spec=challonge.Client)
+        # Challonge seeded the bracket differently, so 1 plays 3 where we have 1 playing 2.
+        client.list_all_matches.return_value = [
+            challonge.BracketMatch('c1', 'open', '1', '3', None, None, False, False),
+            challonge.BracketMatch('c2', 'pending', None, None, 'c1', None, False, False),
+        ]
+        m = mirror.ChallongeMirror(client, 'tourney', unittest.mock.MagicMock())
+        m.push(data.Result('local-1', '1', 2, 0), '1', '2')
+
+        for _ in range(mirror.MAX_UNLINKED_SYNCS - 1):
+            m.sync({})
+            self.assertEqual(1, m.pending)
+        m.sync({})
+        self.assertEqual(0, m.pending)
+        client.set_score.assert_not_called()
+
+        # Back to only downloading the bracket when challonge says it changed.
+        client.list_all_matches.reset_mock()
+        client.list_matches.return_value = None
+        m.sync({})
+        client.list_all_matches.assert_not_called()
+
+    def test_keeps_going_while_challonge_is_slow(self):
+        self.fake.latency_in_secs = 1
+        self.addCleanup(setattr, self.fake, 'latency_in_secs', 0)
+        for _ in range(2):
+            start = time.monotonic()
+            for m in self.bracket.fetch_open_matches():
+                self.assertTrue(self.bracket.save_score(m, 2, 1))
+            # Challonge is synced in the background, rather than while the bracket is being polled.
+            self.assertLess(time.monotonic() - start, 0.5)
+        self.bracket.wait_for_sync(5)
+
+    def test_plays_out_the_bracket_with_results_from_both_sides(self):
+        rng = random.Random(12)
+        while open_matches := self.bracket.fetch_open_matches():
+            self.sync()
+            m = rng.choice(open_matches)
+            if rng.random() < 0.5:
+                self.bracket.save_score(m, 0, 2)
+                continue
+            # The players report it on challonge instead.
+            t = self.fake.tournaments[int(self.bracket.tourney_id)]
+            on_challonge = next(c for c in t.open_matches()
+                                if set(c.players) == {m.p1.challonge_id, m.p2.challonge_id})
+            self.fake.report(t.id, on_challonge.id, m.p1.challonge_id)
+            self.sync()
+            diff = self.bracket.poll_open_matches()
+            self.assertIn(m.challonge_id, [c.challonge_id for c in diff.closed])
+
+        self.sync()
+        self.assertEqual('complete', self.fake.tournaments[int(self.bracket.tourney_id)].state)
+
+    def test_picks_up_where_it_left_off(self):
+        m = self.bracket.fetch_open_matches()[0]
+        with unittest.mock.patch.object(self.client, 'set_score', side_effect=challonge.ChallongeUnavailable('')):
+            self.bracket.save_score(m, 2, 0)
+            self.sync()
+        open_ids = {m.challonge_id for m in self.bracket.fetch_open_matches()}
+
+        resumed = self.closing(Bracket(self.client, persistent.State(self.bracket.tourney_id)))
+        self.addCleanup(resumed.wait_for_sync, 5)
+        self.assertTrue(resumed.is_local)
+        self.assertEqual(open_ids, {m.challonge_id for m in resumed.fetch_open_matches()})
+        # The result that hadn't made it to challonge yet still does.
+        self.sync(resumed)
+        self.assertEqual({frozenset((m.p1.challonge_id, m.p2.challonge_id)) for m in resumed.fetch_open_matches()},
+                         self.challonge_pairs())
+
+
+class TestSwiss(MyTest):
+    def play(self, standings, pairing, rng):
+        by_id = {s.player_id: s for s in standings}
+        for a, b in pairing.pairs:
+            by_id[a].opponents.add(b)
+            by_id[b].opponents.add(a)
+            by_id[rng.choice((a, b))].score += 1
+        if pairing.bye is not None:
+            by_id[pairing.bye].score += 1
+            by_id[pairing.bye].had_bye = True
+
+    def test_pairs_thousands_of_players_by_score_without_rematches(self):
+        rng = random.Random(4001)
+        standings = [swiss.Standing(i, 0, i) for i in range(4001)]
+        for _ in range(swiss.rounds_for(len(standings))):
+            by_id = {s.player_id: s for s in standings}
+            pairing = swiss.pair_round(standings)
+            paired = [p for pair in pairing.pairs for p in pair] + [pairing.bye]
+            self.assertCountEqual(by_id, paired)
+            self.assertFalse(by_id[pairing.bye].had_bye)
+            for a, b in pairing.pairs:
+                self.assertNotIn(b, by_id[a].opponents)
+            # Only the odd player out of a score group plays someone on a different score.
+            floats = sum(by_id[a].score != by_id[b].score for a, b in pairing.pairs)
+            self.assertLessEqual(floats, len({s.score for s in standings}))
+            self.play(standings, pairing, rng)
+
+    def test_avoids_rematches_until_everyone_has_played(self):
+        rng = random.Random(10)
+        standings = [swiss.Standing(i, 0, i) for i in range(10)]
+        # With 10 players, 9 rounds is everyone playing everyone.
+        for _ in range(9):
+            pairing = swiss.pair_round(standings)
+            self.play(standings, pairing, rng)
+        self.assertTrue(all(len(s.opponents) == 9 for s in standings))
+
+    def test_pairs_big_rounds_in_another_process(self):
+        standings = [swiss.Standing(i, i % 3, i, {i ^ 1}) for i in range(200)]
+        with unittest.mock.patch.object(swiss, 'PROCESS_POOL_MIN_PLAYERS', 100):
+            self.assertEqual(swiss.pair_round(standings), swiss.pair_round_in_pool(standings))
+
+    def test_pairs_each_round_as_the_last_one_finishes(self):
+        b = engine.Engine(challonge.TourneyType.SWISS, itertools.count(1))
+        open_matches = b.start(list(range(1, 10)))
+
+        rounds = 0
+        while open_matches:
+            rounds += 1
+            self.assertEqual(4, len(open_matches))
+            opened = []
+            for m in open_matches:
+                opened += b.report(m.id, m.players[0])
+            # The next round is paired by the time the last score is in.
+            self.assertEqual(4 if rounds < 4 else 0, len(opened))
+            open_matches = opened
+        self.assertEqual(4, rounds)
+        self.assertTrue(b.finished)
+
+    def test_bracket_is_not_played_out_locally(self):
+        # Players report scores on challonge, which pairs the rounds its own way.
+        b = self.closing(Bracket(unittest.mock.MagicMock(spec=challonge.Client), persistent.State("swiss")))
+        with self.assertRaises(ValueError):
+            b.start_locally(challonge.TourneyType.SWISS)
+        self.assertFalse(b.is_local)
+
+    def test_mirror_stops_downloading_rounds_challonge_paired_differently(self):
+        client = unittest.mock.MagicMock(spec=challonge.Client)
+        # Challonge paired the round 1-3 and 2-4, where we paired 1-2 and 3-4.
+        client.list_all_matches.return_value = [
+            challonge.BracketMatch('c1', 'open', '1', '3', None, None, False, False),
+            challonge.BracketMatch('c2', 'open', '2', '4', None, None, False, False),
+        ]
+        m = mirror.ChallongeMirror(client, 'swiss', unittest.mock.MagicMock())
+        m.push(data.Result('local-1', '1', 2, 0), '1', '2')
+        m.push(data.Result('local-2', '3', 2, 1), '3', '4')
+
+        self.assertEqual([], m.sync({}))
+        client.set_score.assert_not_called()
+        self.assertEqual(0, m.pending)
+
+        # Back to only downloading the bracket when challonge says it changed.
+        client.list_all_matches.reset_mock()
+        client.list_matches.return_value = None
+        self.assertEqual([], m.sync({}))
+        client.list_matches.assert_called_once_with('swiss', if_changed=True)
+        client.list_all_matches.assert_not_called()
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = cache.TTLCache(10, 2, clock=lambda: self.now)
+
+    def test_expires_entries(self):
+        self.cache.put('a', 1)
+        self.now = 9
+        self.assertEqual(1, self.cache.get('a'))
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(2, len(self.cache))
+
+    def test_ignores_fetches_that_raced_with_an_invalidation(self):
+        generation_a, generation_b = self.cache.generation('a'), self.cache.generation('b')
+        self.cache.invalidate('a')
+        self.cache.put('a', 1, generation_a)
+        self.assertIsNone(self.cache.get('a'))
+
+        # Fetches of other keys are still cached.
+        self.cache.put('b', 2, generation_b)
+        self.assertEqual(2, self.cache.get('b'))
+
+        # Even once more keys have been invalidated since than are remembered.
+        generation_c = self.cache.generation('c')
+        for key in 'cde':
+            self.cache.invalidate(key)
+        self.cache.put('c', 3, generation_c)
+        self.assertIsNone(self.cache.get('c'))
+
+
+class TestAnnouncementQueue(unittest.TestCase):
+    def test_packs_announcements_into_as_few_messages_as_fit(self):
+        channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        queue = announcements.AnnouncementQueue(channel)
+        calls = [queue.post(f"<@!{i}> <@!{i + 1}> your match has been called!" + "." * 60,
+                            announcements.Priority.CALL) for i in range(64)]
+        _wait_for(queue.flush())
+
+        sent = [c[0][0] for c in channel.send.call_args_list]
+        self.assertEqual(4, len(sent))
+        self.assertTrue(all(len(text) <= announcements.MAX_MESSAGE_LENGTH for text in sent))
+        self.assertTrue(all(c.message is not None for c in calls))
+        self.assertEqual(4, len(queue.queueing_delays))
+        self.assertEqual(0, len(queue))
+
+    def test_sends_dqs_first(self):
+        channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        queue = announcements.AnnouncementQueue(channel)
+        queue.post("call " * 399, announcements.Priority.CALL)
+        queue.post("warn", announcements.Priority.WARN)
+        queue.post("dq", announcements.Priority.DQ)
+        _wait_for(queue.flush())
+
+        self.assertEqual(2, channel.send.call_count)
+        self.assertEqual("dq\nwarn", channel.send.call_args_list[0][0][0])
+
+    def test_stays_under_the_rate_limit(self):
+        channel = unittest.mock.MagicMock(spec=discord.TextChannel)
+        queue = announcements.AnnouncementQueue(channel, ratelimit.TokenBucket(rate_per_sec=20, capacity=1))
+        for _ in range(3):
+            queue.post("x" * announcements.MAX_MESSAGE_LENGTH, announcements.Priority.CALL)
+        start = time.monotonic()
+        _wait_for(queue.flush())
+
+        self.assertEqual(3, channel.send.call_count)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertGreaterEqual(max(queue.queueing_delays), 0.1)
+
+
+class TestHttpPool(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_ports = set()
+        test = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                test.client_ports.add(self.client_address[1])
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps({'path': self.path}).encode()
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_reuses_connections(self):
+        for i in range(3):
+            resp = util.make_request(self.base_url, '/thing.json', params={'n': i})
+            self.assertEqual(f'/thing.json?n={i}', resp['path'])
+
+        # All three requests should have gone over the same kept-alive connection.
+        self.assertEqual(1, len(self.client_ports))
+
+    def test_async_requests_from_another_loop(self):
+        async def fetch_all():
+            return await asyncio.gather(*[util.make_request_async(self.base_url, f'/{i}.json') for i in range(5)])
+
+        results = asyncio.new_event_loop().run_until_complete(fetch_all())
+        self.assertEqual([f'/{i}.json' for i in range(5)], [r['path'] for r in results])
+
+    def test_conditional_requests(self):
+        loop = asyncio.new_event_loop()
+        resp, validator = loop.run_until_complete(util.make_conditional_request_async(self.base_url, '/thing.json'))
+        self.assertEqual('/thing.json', resp['path'])
+        self.assertEqual('"v1"', validator.etag)
+
+        # Unchanged since last time, so there's nothing to decode.
+        resp, validator = loop.run_until_complete(
+            util.make_conditional_request_async(self.base_url, '/thing.json', validator=validator))
+        self.assertIsNone(resp)
+        self.assertEqual('"v1"', validator.etag)
+
+
+class TestSqliteBackend(MyTest):
+    def test_resumes_state(self):
+        p1, p2 = data.new_player(1, "challonge-1"), data.new_player(2, "challonge-2")
+        m = data.new_match(p1, p2, "match-1")
+        s = self.closing(persistent.State("tourney-a", "challonge.com/a", backend=persistent.SQLITE_BACKEND))
+        s.set_admin(1234)
+        s.add_players([p1, p2])
+        s.set_matches([m])
+
+        m.call_message_id = 5678
+        m.call_time = datetime.now()
+        s.update_matches([m])
+
+        # A second tournament in the same database doesn't get mixed up with the first.
+        other = self.closing(persistent.State("tourney-b", "challonge.com/b", backend=persistent.SQLITE_BACKEND))
+        other.add_players([data.new_player(3, "challonge-1")])
+
+        # pretend we crashed
+        persistent.close_sqlite_databases()
+        new_s = self.closing(persistent.State("tourney-a", backend=persistent.SQLITE_BACKEND))
+
+        self.assertEqual(1234, new_s.admin_id)
+        self.assertEqual("challonge.com/a", new_s.bracket_link)
+        self.assertEqual([p1, p2], new_s.players)
+        self.assertEqual([m], new_s.known_matches)
+        self.assertEqual(p2, new_s.player_by_discord_id(2))
+        self.assertEqual(p1, new_s.player_by_challonge_id("challonge-1"))
+        self.assertEqual(m, new_s.match_by_challonge_id("match-1"))
+        self.assertIsNone(new_s.player_by_discord_id(3))
+
+    def test_leaves_out_matches_with_missing_players(self):
+        p1, p2 = data.new_player(1, "challonge-1"), data.new_player(2, "challonge-2")
+        s = self.closing(persistent.State("tourney-a", "challonge.com/a", backend=persistent.SQLITE_BACKEND))
+        s.add_players([p1])
+        s.update_matches([data.new_match(p1, p2, "match-1")])
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual([], s.known_matches)
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(s.match_by_challonge_id("match-1"))
+
+    def test_migrates_pickled_tournaments(self):
+        p1, p2 = data.new_player(1, "challonge-1"), data.new_player(2, "challonge-2")
+        m = data.new_match(p1, p2, "match-1")
+        m.call_time = datetime.now()
+        old = self.closing(persistent.State("tourney-a", "challonge.com/a", backend=persistent.PICKLE_BACKEND))
+        old.set_admin(1234)
+        old.add_players([p1, p2])
+        old.update_matches([m])
+
+        self.assertEqual(["tourney-a"], migrate.pickled_tournament_ids())
+        self.assertTrue(migrate.migrate("tourney-a"))
+        # Running it again doesn't duplicate anything.
+        self.assertFalse(migrate.migrate("tourney-a"))
+
+        new_s = self.closing(persistent.State("tourney-a", backend=persistent.SQLITE_BACKEND))
+        self.assertEqual(1234, new_s.admin_id)
+        self.assertEqual("challonge.com/a", new_s.bracket_link)
+        self.assertEqual([p1, p2], new_s.players)
+        self.assertEqual([m], new_s.known_matches)
+
+    def test_keeps_challonge_ids_as_ints(self):
+        # Challonge's IDs are ints. Tournaments resumed from either backend, or migrated, have to find them again.
+        p1, p2 = data.new_player(1, 101), data.new_player(2, 102)
+        m = data.new_match(p1, p2, 201)
+        old = self.closing(persistent.State("tourney-a", "challonge.com/a", backend=persistent.PICKLE_BACKEND))
+        old.add_players([p1, p2])
+        old.update_matches([m])
+        self.assertTrue(migrate.migrate("tourney-a"))
+        s = self.closing(persistent.State("tourney-b", "challonge.com/b", backend=persistent.SQLITE_BACKEND))
+        s.add_players([p1, p2])
+        s.update_matches([m])
+
+        persistent.close_sqlite_databases()
+        for tournament_id in ("tourney-a", "tourney-b"):
+            new_s = self.closing(persistent.State(tournament_id, backend=persistent.SQLITE_BACKEND))
+            self.assertEqual([101, 102], [p.challonge_id for p in new_s.players])
+            self.assertEqual([201], [m.challonge_id for m in new_s.known_matches])
+            self.assertEqual(p1, new_s.player_by_challonge_id(101))
+            self.assertEqual(m, new_s.match_by_challonge_id(201))
+
+    def test_recovers_int_ids_from_databases_that_stored_them_as_text(self):
+        p1, p2 = data.new_player(1, 101), data.new_player(2, "local-player")
+        s = self.closing(persistent.State("tourney-a", "challonge.com/a", backend=persistent.SQLITE_BACKEND))
+        s.add_players([p1, p2])
+        s.update_matches([data.new_match(p1, p2, 201)])
+        persistent.close_sqlite_databases()
+
+        # Turn it into a database from before the ID columns were untyped, like they all used to be.
+        conn = sqlite3.connect(os.path.join(BACKUP_DIR, persistent.SQLITE_FILE_NAME))
+        for table in ('players', 'matches'):
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+            conn.executescript(f"""
+                ALTER TABLE {table} RENAME TO untyped;
+                {sql.replace('challonge_id', 'challonge_id TEXT', 1)};
+                INSERT INTO {table} SELECT * FROM untyped;
+                DROP TABLE untyped;
+            """)
+        self.assertEqual('101', conn.execute("SELECT challonge_id FROM players WHERE discord_id = 1").fetchone()[0])
+        conn.close()
+
+        new_s = self.closing(persistent.State("tourney-a", backend=persistent.SQLITE_BACKEND))
+        self.assertEqual([101, "local-player"], [p.challonge_id for p in new_s.players])
+        self.assertEqual([201], [m.challonge_id for m in new_s.known_matches])
+        self.assertEqual(p1, new_s.player_by_challonge_id(101))
+
 
 def _reaction(emoji_unicode: str) -> discord.Reaction:
     mock_reaction = unittest.mock.MagicMock(spec=discord.Reaction)
@@ -458,9 +2154,24 @@ def _reaction(emoji_unicode: str) -> discord.Reaction:
     return mock_reaction
 
 
+def _reaction_event(channel, message_id: int, user_id: int, emoji_unicode: str) -> discord.RawReactionActionEvent:
+    event = unittest.mock.MagicMock(spec=discord.RawReactionActionEvent)
+    event.guild_id = channel.guild.id
+    event.channel_id = channel.id
+    event.message_id = message_id
+    event.user_id = user_id
+    event.emoji = discord.PartialEmoji(name=emoji_unicode)
+    return event
+
+
 def _wait_for(func):
     l = asyncio.get_event_loop()
-    l.run_until_complete(func)
+    return l.run_until_complete(func)
+
+
+async def _async_iter(items):
+    for i in items:
+        yield i
 
 
 def _future(value):
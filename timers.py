@@ -0,0 +1,68 @@
+"""Keeps track of when called matches are due to be warned or DQ'd."""
+import enum
+import heapq
+import itertools
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+class Deadline(enum.IntEnum):
+    # Ordered so that if a match's warn and DQ fall due at the same time, the warning goes out first.
+    WARN = 0
+    DQ = 1
+
+
+# (tourney ID, match challonge ID, which deadline)
+DueEvent = Tuple[str, str, Deadline]
+
+
+class DeadlineHeap:
+    """
+    A min-heap of warn and DQ deadlines for every called match, across every tournament.
+
+    Finding out what is due costs O(log n) per due event, rather than a scan
+    over every open match. Cancelled or rescheduled deadlines are left in the
+    heap and skipped when they reach the top.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, Deadline, int, str, str]] = []
+        self._live: Dict[Tuple[str, str, Deadline], datetime] = {}
+        self._tiebreaker = itertools.count()
+
+    def schedule(self, tourney_id: str, match_id: str, kind: Deadline, when: datetime):
+        """Schedules (or reschedules) the given deadline for a match."""
+        self._live[(tourney_id, match_id, kind)] = when
+        heapq.heappush(self._heap, (when, kind, next(self._tiebreaker), tourney_id, match_id))
+
+    def cancel(self, tourney_id: str, match_id: str):
+        """Cancels every deadline for the given match."""
+        for kind in Deadline:
+            self._live.pop((tourney_id, match_id, kind), None)
+
+    def next_deadline(self) -> Optional[datetime]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[DueEvent]:
+        """Removes and returns every deadline at or before now, earliest first."""
+        due = []
+        while (when := self.next_deadline()) is not None and when <= now:
+            _, kind, _, tourney_id, match_id = heapq.heappop(self._heap)
+            del self._live[(tourney_id, match_id, kind)]
+            due.append((tourney_id, match_id, kind))
+        return due
+
+    def pending(self, kind: Deadline) -> int:
+        """Returns how many deadlines of the given kind are scheduled."""
+        return sum(1 for (_, _, k) in self._live if k == kind)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def _drop_stale(self):
+        while self._heap:
+            when, kind, _, tourney_id, match_id = self._heap[0]
+            if self._live.get((tourney_id, match_id, kind)) == when:
+                return
+            heapq.heappop(self._heap)
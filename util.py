@@ -1,9 +1,31 @@
+import asyncio
+import atexit
+import contextlib
 import json
-from typing import Set
-from urllib import error, request
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Set, Dict, Optional, Tuple
+from urllib import error
 
+import aiohttp
 import discord
 
+import metrics
+
+# Keep-alive connections to the same host are reused instead of paying for a
+# fresh TCP+TLS handshake on every request.
+HTTP_MAX_CONNECTIONS = 10
+HTTP_KEEPALIVE_IN_SECS = 60
+HTTP_TIMEOUT_IN_SECS = 30
+
+HTTP_REQUESTS = metrics.Counter('http_requests', 'HTTP requests sent through the pool, by status.',
+                                ['method', 'status'])
+HTTP_REQUEST_SECONDS = metrics.Histogram('http_request_seconds', 'How long HTTP requests sent through the pool took.',
+                                         ['method'])
+DISCORD_CALLS = metrics.Counter('discord_calls', 'Calls to discord, by whether they succeeded.', ['call', 'outcome'])
+DISCORD_CALL_SECONDS = metrics.Histogram('discord_call_seconds', 'How long calls to discord took.', ['call'])
+
 
 async def get_user_ids(r: discord.Reaction) -> Set[int]:
     """
@@ -13,11 +35,129 @@ async def get_user_ids(r: discord.Reaction) -> Set[int]:
     is a pain, and we want to mock it out.
     """
     pids = set()
-    async for u in r.users():
-        pids.add(u.id)
+    with discord_call('reaction_users'):
+        async for u in r.users():
+            pids.add(u.id)
     return pids
 
 
+@contextlib.contextmanager
+def discord_call(call: str):
+    """Counts and times the call to discord made in the body of the with block."""
+    outcome = 'error'
+    with DISCORD_CALL_SECONDS.time(call=call):
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            DISCORD_CALLS.inc(call=call, outcome=outcome)
+
+
+@dataclass
+class Response:
+    status: int
+    reason: str
+    headers: Dict[str, str]
+    body: bytes
+
+
+@dataclass
+class Validator:
+    """What a server told us to identify the version of a resource we already have."""
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class HttpPool:
+    """
+    A bounded pool of persistent HTTP connections.
+
+    The pool owns a background thread running its own event loop. All network
+    I/O happens there, so the pool can be shared by coroutines on any other
+    event loop (like the bot's) as well as by plain blocking callers.
+    """
+
+    def __init__(self,
+                 max_connections: int = HTTP_MAX_CONNECTIONS,
+                 keepalive_in_secs: float = HTTP_KEEPALIVE_IN_SECS,
+                 timeout_in_secs: float = HTTP_TIMEOUT_IN_SECS):
+        self._max_connections = max_connections
+        self._keepalive_in_secs = keepalive_in_secs
+        self._timeout_in_secs = timeout_in_secs
+        self._loop = None
+        self._session = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='http-pool', daemon=True).start()
+        return self._loop
+
+    def _in_pool_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def run_async(self, coro):
+        """
+        Awaits the given coroutine on the pool's event loop, from any event loop.
+        """
+        loop = self._ensure_started()
+        if self._in_pool_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def run(self, coro):
+        """
+        Runs the given coroutine on the pool's event loop and blocks until it finishes.
+
+        Must not be called from the pool's own thread, or it will deadlock.
+        """
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def request(self, method: str, url: str, body: Optional[bytes] = None,
+                      headers: Optional[Dict[str, str]] = None) -> Response:
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = await self.run_async(self._request(method, url, body, headers or {}))
+            status = str(response.status)
+            return response
+        finally:
+            HTTP_REQUESTS.inc(method=method, status=status)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+
+    async def _request(self, method, url, body, headers) -> Response:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_connections,
+                                             keepalive_timeout=self._keepalive_in_secs)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self._timeout_in_secs))
+        async with self._session.request(method, url, data=body, headers=headers) as resp:
+            return Response(resp.status, resp.reason, resp.headers.copy(), await resp.read())
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            self.run(self._session.close())
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+_default_pool = HttpPool()
+atexit.register(_default_pool.close)
+
+
+def default_pool() -> HttpPool:
+    return _default_pool
+
+
 def make_request(base_url,
                  additional_url,
                  params={},
@@ -30,32 +170,82 @@ def make_request(base_url,
     The URL is just base_url + additional_url.
     If data is set, it should be a dictionary, which will be encoded as JSON.
     This will make the request a POST request instead of GET.
-    """
 
-    url = base_url + additional_url
-    first_item = True
-    for param, value in params.items():
-        if first_item:
-            url += f'?{param}={value}'
-            first_item = False
-            continue
+    Blocks until the response arrives. Coroutines should use make_request_async.
+    """
+    return _default_pool.run(
+        make_request_async(base_url, additional_url, params, data, raise_exception_on_http_error, method))
 
-        url += f'&{param}={value}'
 
+async def make_request_async(base_url,
+                             additional_url,
+                             params={},
+                             data=None,
+                             raise_exception_on_http_error=False,
+                             method=None):
+    """
+    Same as make_request, but awaitable, so the caller's event loop is free
+    while the request is in flight.
+    """
+    url = _build_url(base_url, additional_url, params)
     headers = {}
     if data is not None:
         data = json.dumps(data).encode()
         headers['Content-Type'] = 'application/json'
-    try:
-        r = request.Request(url, data, headers, method=method)
-        response = request.urlopen(r)
-    except error.HTTPError as e:
+    if method is None:
+        method = 'GET' if data is None else 'POST'
+
+    response = await _default_pool.request(method, url, data, headers)
+    if response.status >= 400 and raise_exception_on_http_error:
         # Usually we want to return any data on an HTTP error,
         # but sometimes we may wish to still treat it as an exception.
-        if raise_exception_on_http_error:
-            raise e
-        response = e
+        raise error.HTTPError(url, response.status, response.reason, response.headers, None)
 
     # Convert raw response to usable JSON object
-    response_as_string = response.read().decode('utf-8')
-    return json.loads(response_as_string)
+    return json.loads(response.body.decode('utf-8'))
+
+
+async def make_conditional_request_async(base_url,
+                                         additional_url,
+                                         params={},
+                                         validator: Optional[Validator] = None) -> Tuple[Any, Optional[Validator]]:
+    """
+    GETs the resource at base_url + additional_url, unless it hasn't changed.
+
+    If validator is set, the server is asked to skip sending the resource if
+    it is unchanged since the validator was handed out, in which case the
+    returned object is None and nothing gets decoded.
+    Also returns the validator to use next time, if the server gave us one.
+    Raises an exception on HTTP errors.
+    """
+    url = _build_url(base_url, additional_url, params)
+    headers = {}
+    if validator is not None:
+        if validator.etag is not None:
+            headers['If-None-Match'] = validator.etag
+        if validator.last_modified is not None:
+            headers['If-Modified-Since'] = validator.last_modified
+
+    response = await _default_pool.request('GET', url, None, headers)
+    if response.status == 304:
+        return None, validator
+    if response.status >= 400:
+        raise error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    new_validator = None
+    if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+        new_validator = Validator(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return json.loads(response.body.decode('utf-8')), new_validator
+
+
+def _build_url(base_url, additional_url, params) -> str:
+    url = base_url + additional_url
+    first_item = True
+    for param, value in params.items():
+        if first_item:
+            url += f'?{param}={value}'
+            first_item = False
+            continue
+
+        url += f'&{param}={value}'
+    return url
@@ -0,0 +1,114 @@
+"""
+Receives notifications that matches changed, so we can check a tournament right away instead of waiting to poll it.
+
+Notifications are POSTed as JSON to /webhook, signed with a secret shared with
+the sender: the X-Signature-256 header holds "sha256=" followed by the hex
+HMAC-SHA256 of the body. Each notification looks like:
+
+    {"id": "<unique per notification>", "tournament_id": "...", "match_id": "...", "state": "open"}
+
+Senders may deliver the same notification more than once, so they're deduplicated by ID.
+"""
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Union
+
+import cache
+import metrics
+
+SIGNATURE_HEADER = 'X-Signature-256'
+PATH = '/webhook'
+# Notifications bigger than this are rejected without being read.
+MAX_BODY_BYTES = 64 * 1024
+# How long to remember notifications for, and how many, to ignore them if they're delivered again.
+DEDUPLICATION_WINDOW_IN_SECS = 15 * 60
+MAX_REMEMBERED_NOTIFICATIONS = 10000
+
+NOTIFICATIONS = metrics.Counter('webhook_notifications', 'Webhook notifications received, by what became of them.',
+                                ['outcome'])
+
+
+@dataclass
+class Notification:
+    id: str
+    tourney_id: str
+    match_id: str
+    state: str
+
+
+def sign(secret: Union[str, bytes], body: bytes) -> str:
+    """The signature header value for the given body."""
+    key = secret.encode() if isinstance(secret, str) else secret
+    return 'sha256=' + hmac.new(key, body, hashlib.sha256).hexdigest()
+
+
+class Receiver:
+    """Verifies and deduplicates notifications, and hands each new one to on_notification."""
+
+    def __init__(self, secret: Union[str, bytes], on_notification: Callable[[Notification], None],
+                 dedup_window_in_secs: float = DEDUPLICATION_WINDOW_IN_SECS):
+        self._secret = secret
+        self._on_notification = on_notification
+        self._seen = cache.TTLCache(dedup_window_in_secs, MAX_REMEMBERED_NOTIFICATIONS)
+        self._lock = threading.Lock()
+
+    def handle(self, body: bytes, signature: str) -> int:
+        """Handles a delivered notification. Returns the HTTP status to respond with."""
+        if not signature or not hmac.compare_digest(sign(self._secret, body), signature):
+            NOTIFICATIONS.inc(outcome='bad_signature')
+            return 401
+        try:
+            fields = json.loads(body)
+            n = Notification(str(fields['id']), str(fields['tournament_id']), str(fields['match_id']),
+                             str(fields['state']))
+        except (ValueError, TypeError, KeyError):
+            NOTIFICATIONS.inc(outcome='malformed')
+            return 400
+
+        with self._lock:
+            if self._seen.get(n.id) is not None:
+                NOTIFICATIONS.inc(outcome='duplicate')
+                return 200
+            self._seen.put(n.id, True)
+        NOTIFICATIONS.inc(outcome='accepted')
+        self._on_notification(n)
+        return 200
+
+
+def serve(receiver: Receiver, port: int, host: str = '127.0.0.1') -> http.server.HTTPServer:
+    """Receives notifications at http://host:port/webhook, from a background thread."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split('?')[0] != PATH:
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers['Content-Length'])
+            except (TypeError, ValueError):
+                length = -1
+            if length < 0:
+                # Without a length we can trust, there's no telling how much to read.
+                self.send_error(400)
+                return
+            if length > MAX_BODY_BYTES:
+                self.send_error(413)
+                return
+            status = receiver.handle(self.rfile.read(length), self.headers.get(SIGNATURE_HEADER, ''))
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='webhooks', daemon=True).start()
+    logging.info(f'Receiving webhook notifications at http://{host}:{server.server_port}{PATH}')
+    return server